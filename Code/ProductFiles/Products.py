@@ -8,49 +8,147 @@ The script:
 4. Ensures compatibility with reasoners and annotations like rdfs:seeAlso.
 
 Then it generates an other Turtle file containg Shacl shapes and saves it to a file named 'Shacl_shapes.ttl'.
+
+Next to them it writes the files the local SPARQL service and the other tools of this folder read: the
+name and brand search index, the columnar snapshot of the product fields, the predicate statistics of
+the query planner, the SHACL violations of the products and the row hashes used by --incremental.
+
+    python Products.py                      # Products.ttl, Shacl_shapes.ttl and the files above
+    python Products.py --format ntriples    # Products.nt for bulk loaders, see --format for the others
+    python Products.py --workers 4          # render the products in 4 processes, same output
+    python Products.py --incremental        # only the changes since the last run, as Products.delta.ru
+    python Products.py --reprice            # the discounts changed by Pricing.csv, as Products.reprice.ru
+    python Products.py --check              # only check the CSV file
+
+python Products.py --help lists every option. The functions can also be imported without side effects,
+main() is the command line entry point.
 """
 
-import pandas as pd
+import argparse
+import contextlib
+import csv
+import functools
+import gzip
 import os
-import random
-from rdflib import Graph, Namespace, RDF, RDFS
+import re
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+
+from lazy_modules import lazy_import
+from metrics import StageRecorder, memory_families, profiled, text_bytes, write_prometheus
+from predicate_statistics import PredicateStatistics
+from pricing import PricingEngine, load_rules
+from triples import TripleBuilder, escape_iri, escape_literal, turtle_iri
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
 
 # Define file paths
 csv_file = "Products.csv"  # CSV file must be in the same folder as this script
-output_file = "Products.ttl"  # Output Turtle file
-
-# Check if the file exists
-if not os.path.exists(csv_file):
-    raise FileNotFoundError(f"File {csv_file} not found.")
-
-# Load the CSV file
-data = pd.read_csv(csv_file)
-
-# Create RDF graph
-g = Graph()
-
-# Define namespaces
-PTO = Namespace("http://www.productontology.org/id/")
-BASE = Namespace("http://www.semanticweb.org/My_Super/")
-GR = Namespace("http://purl.org/goodrelations/v1#")
-OWL = Namespace("http://www.w3.org/2002/07/owl#")
-RDF_NS = Namespace("http://www.w3.org/1999/02/rdf-syntax-ns#")
-XML = Namespace("http://www.XML/1998/namespace")
-XSD = Namespace("http://www.w3.org/2001/XMLSchema#")
-RDFS_NS = Namespace("http://www.w3.org/2000/01/rdf-schema#")
-
-# Bind namespaces
-g.bind("pto", PTO)
-g.bind("", BASE)
-g.bind("gr", GR)
-g.bind("owl", OWL)
-g.bind("rdf", RDF_NS)
-g.bind("xml", XML)
-g.bind("xsd", XSD)
-g.bind("rdfs", RDFS_NS)
-
-# Turtle statements
-turtle_statements = [
+shacl_file = "Shacl_shapes.ttl"  # Output SHACL shapes file
+manifest_file = "Products.manifest.npz"  # Row hashes of the last run, used by --incremental
+delta_file = "Products.delta.ru"  # SPARQL Update written by --incremental
+search_index_file = "Products.search.idx"  # Name and brand search index
+snapshot_file = "Products.snapshot"  # Columnar snapshot of the product fields
+violations_file = "Products.violations.txt"  # SHACL violations found while generating
+statistics_file = "Products.stats.json"  # Per-predicate statistics for the query planner
+pricing_file = "Pricing.csv"  # Discount rules, used when the file exists
+reprice_file = "Products.reprice.ru"  # SPARQL Update written by --reprice
+
+# Output formats: file name, whether lines carry a graph name (N-Quads) and whether the file is gzip-compressed
+output_formats = {
+    "turtle": ("Products.ttl", False, False),
+    "ntriples": ("Products.nt", False, False),
+    "ntriples-gz": ("Products.nt.gz", False, True),
+    "nquads": ("Products.nq", True, False),
+    "nquads-gz": ("Products.nq.gz", True, True),
+}
+
+# Graph name of the N-Quads output
+graph_name = "<http://www.semanticweb.org/My_Super>"
+
+# Compression level of the gzip-compressed formats, lower is faster
+gzip_level = 6
+
+# Number of CSV rows rendered and written at once
+chunk_size = 100_000
+
+# Size of the output file write buffer
+write_buffer_size = 1 << 20
+
+# Column types of the CSV file, fixed so that every chunk is rendered the same way
+csv_dtypes = {
+    "name": str,
+    "category": str,
+    "subcategory": str,
+    "type": str,
+    "price": "float64",
+    "brand": str,
+    "quantity": str,
+}
+
+# Strings that pandas.read_csv reads as missing values, the csv module path renders them as "nan" too
+na_values = {"", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN", "<NA>", "N/A",
+             "NA", "NULL", "NaN", "None", "n/a", "nan", "null"}
+
+# Prefix of the metrics written by --metrics
+metrics_prefix = "products_generation"
+
+# Ways of reading the CSV file: pandas writes every output, the csv module only the Turtle file
+engines = ["pandas", "stdlib"]
+
+# Characters replaced by "_" in the local names of product instances
+instance_name_characters = re.compile(r"[ ,.%]")
+
+# Products repriced by one DELETE/INSERT of the --reprice update
+reprice_batch_size = 10_000
+
+# Stock of every generated product
+initial_stock = 10
+
+# CSV columns whose 64-bit content hash is kept per product in the manifest
+manifest_fields = ['name', 'type', 'brand', 'price', 'quantity', 'category', 'subcategory']
+
+# Instance properties rewritten by the delta when the matching CSV column changes
+field_predicates = {
+    'name': ("gr:name", "xsd:string"),
+    'brand': (":hasBrand", "xsd:string"),
+    'price': (":hasPrice", "xsd:double"),
+    'quantity': (":hasQuantity", "xsd:string"),
+}
+
+# Direct links from an instance to the classes above its pto: type
+link_predicates = {
+    'category': ":inCategory",
+    'subcategory': ":inSubcategory",
+}
+
+# Prefixes of the SPARQL Update delta
+sparql_prefixes = [
+    "PREFIX : <http://www.semanticweb.org/My_Super/>",
+    "PREFIX gr: <http://purl.org/goodrelations/v1#>",
+    "PREFIX owl: <http://www.w3.org/2002/07/owl#>",
+    "PREFIX pto: <http://www.productontology.org/id/>",
+    "PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>",
+    "PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>",
+    "",
+]
+
+# Namespaces of the prefixes, used by the triple builder to expand and shorten IRIs
+namespaces = {
+    "": "http://www.semanticweb.org/My_Super/",
+    "gr": "http://purl.org/goodrelations/v1#",
+    "owl": "http://www.w3.org/2002/07/owl#",
+    "pto": "http://www.productontology.org/id/",
+    "rdf": "http://www.w3.org/1999/02/rdf-syntax-ns#",
+    "xml": "http://www.XML/1998/namespace",
+    "xsd": "http://www.w3.org/2001/XMLSchema#",
+    "rdfs": "http://www.w3.org/2000/01/rdf-schema#",
+}
+
+# Prefix statements
+prefixes = [
     "@prefix : <http://www.semanticweb.org/My_Super/> .",
     "@prefix gr: <http://purl.org/goodrelations/v1#> .",
     "@prefix owl: <http://www.w3.org/2002/07/owl#> .",
@@ -63,14 +161,6 @@ turtle_statements = [
     "",
 ]
 
-# Add ontology
-turtle_statements.append("<http://www.semanticweb.org/My_Super> a owl:Ontology .\n")
-
-# Add properties headline
-turtle_statements.append("#################################################################")
-turtle_statements.append("#    Data properties")
-turtle_statements.append("#################################################################\n")
-
 # Define properties
 properties = [
     """
@@ -234,174 +324,59 @@ gr:name a owl:DatatypeProperty ;
 """
 ]
 
-# Add properties
-turtle_statements.extend(properties)
-
-# Add classes headline
-turtle_statements.append("#################################################################")
-turtle_statements.append("#    Classes")
-turtle_statements.append("#################################################################\n")
-
-# Add class gr:ProductOrService
-turtle_statements.append("###  http://purl.org/goodrelations/v1#ProductOrService")
-turtle_statements.append("gr:ProductOrService a owl:Class .\n")
-
-# Add class Order
-turtle_statements.append("""
+# Properties of the materialized category hierarchy
+hierarchy_properties = [
+    """
+###  http://www.semanticweb.org/My_Super#inCategory
+:inCategory a owl:ObjectProperty ;
+            rdfs:domain gr:ProductOrService ;
+            rdfs:comment "Connects a product with the category of its type, so it can be found without following rdfs:subClassOf." .
+""",
+    """
+###  http://www.semanticweb.org/My_Super#inSubcategory
+:inSubcategory a owl:ObjectProperty ;
+               rdfs:domain gr:ProductOrService ;
+               rdfs:comment "Connects a product with the subcategory of its type, so it can be found without following rdfs:subClassOf." .
+""",
+    """
+###  http://www.semanticweb.org/My_Super#productCount
+:productCount a owl:AnnotationProperty ;
+              rdfs:range xsd:integer ;
+              rdfs:comment "The number of products in a category, subcategory or type class." .
+"""
+]
+# Define classes that do not depend on the CSV file
+base_classes = [
+    "###  http://purl.org/goodrelations/v1#ProductOrService",
+    "gr:ProductOrService a owl:Class .\n",
+    """
 ###  http://www.semanticweb.org/My_Super#Order
 :Order a owl:Class ;
         rdfs:comment "Represents an order in the e-shop.".
-""")
-
-# Add class OrderItem
-turtle_statements.append("""
+""",
+    """
 ###  http://www.semanticweb.org/My_Super#OrderItem
 :OrderItem a owl:Class ;
         rdfs:comment "Represents an item in an order in the e-shop.".
-""")
-
-
-# Add class User
-turtle_statements.append("""
+""",
+    """
 ###  http://www.semanticweb.org/My_Super#User
 :User a owl:Class ;
       rdfs:comment "Represents a user of the e-shop." .
-""")
-
-# Add subclasses of User
-turtle_statements.append("""
+""",
+    """
 ###  http://www.semanticweb.org/My_Super#NormalUser
 :NormalUser a owl:Class ;
             rdfs:subClassOf :User ;
             rdfs:comment "Represents a normal user of the e-shop." .
-""")
-
-turtle_statements.append("""
+""",
+    """
 ###  http://www.semanticweb.org/My_Super#AdminUser
 :AdminUser a owl:Class ;
            rdfs:subClassOf :User ;
            rdfs:comment "Represents an admin user of the e-shop." .
-""")
-
-# Extract unique values from category column
-unique_categories = data['category'].drop_duplicates()
-
-# Create classes from category column
-for category in unique_categories:
-    class_name = category.replace(" ", "_")
-    class_uri = f":{class_name}"
-    
-    # Add comment for each category class
-    turtle_statements.append(f"###  http://www.semanticweb.org/My_Super#{class_name}")
-    
-    # Add class and subclass relation
-    turtle_statements.append(f"{class_uri} a owl:Class ;")
-    turtle_statements.append(f"               rdfs:subClassOf gr:ProductOrService .\n")
-
-# Extract unique values from category and subcategory columns
-subcategory_to_category = data[['subcategory', 'category']].drop_duplicates()
-
-# Create classes from subcategory column
-for _, row in subcategory_to_category.iterrows():
-    subcategory_name = row['subcategory'].replace(" ", "_")
-    category_name = row['category'].replace(" ", "_")
-    
-    subcategory_uri = f":{subcategory_name}"
-    category_uri = f":{category_name}"
-    
-    # Add comment for each subcategory class
-    turtle_statements.append(f"###  http://www.semanticweb.org/My_Super#{subcategory_name}")
-    
-    # Add class and subclass relation
-    turtle_statements.append(f"{subcategory_uri} a owl:Class ;")
-    turtle_statements.append(f"                  rdfs:subClassOf {category_uri} .\n")
-
-# Create classes from type and subcategory columns
-type_to_subcategory = data[['type', 'subcategory']].drop_duplicates()
-for _, row in type_to_subcategory.iterrows():
-    class_name = row['type'].replace(" ", "_")
-    subclass_of = row['subcategory'].replace(" ", "_")
-    
-    class_uri = f"pto:{class_name}"
-    subclass_uri = f":{subclass_of}"
-    
-    # Add comment for each type class
-    turtle_statements.append(f"###  http://www.productontology.org/id/{class_name}")
-    
-    # Add class and subclass relation
-    turtle_statements.append(f"{class_uri} a owl:Class ;")
-    turtle_statements.append(f"             rdfs:subClassOf {subclass_uri} .\n")
-
-
-# Add instances headline
-turtle_statements.append("#################################################################")
-turtle_statements.append("#    Instances")
-turtle_statements.append("#################################################################\n")
-
-# Create instances from data
-for _, row in data.iterrows():
-    # Replace empty and special characters
-    instance_name = row['name']
-    for char in [" ",",",".","%"]:
-        instance_name = instance_name.replace(char, "_")
-    instance_uri = f":{instance_name}"
-    
-    
-    # Get data from CSV
-    product_id = row['id']
-    is_available = "true" # Original availabilty
-    stock = 10  # Original stock
-    belongs_to_class = f"pto:{row['type'].replace(' ', '_')}"  # class from type column
-    brand = row['brand']
-    price = row['price']
-    discount_price = random.choice([0, 5, 10, 15, 20, 25, 30])  # Επιλογή τυχαίας τιμής από τη λίστα
-    quantity = row['quantity']  
-    product_name = row['name']  # Original name with special characters
-
-    
-    turtle_statements.append(f"###  {instance_uri}")
-
-    # Add instance and its properties
-    turtle_statements.append(f"{instance_uri} a {belongs_to_class} ;")
-    turtle_statements.append(f"             a owl:NamedIndividual ;")
-    turtle_statements.append(f"             :hasProductID \"{product_id}\"^^xsd:string ;")
-    turtle_statements.append(f"             :isAvailable \"{is_available}\"^^xsd:boolean ;")
-    turtle_statements.append(f"             :hasStock \"{stock}\"^^xsd:integer ;")
-    turtle_statements.append(f"             :hasBrand \"{brand}\"^^xsd:string ;")
-    turtle_statements.append(f"             :hasPrice \"{price}\"^^xsd:double ;")
-    turtle_statements.append(f"             :hasDiscountPrice \"{discount_price}\"^^xsd:double ;")
-    turtle_statements.append(f"             :hasQuantity \"{quantity}\"^^xsd:string ;")
-    turtle_statements.append(f"             gr:name \"{product_name}\"^^xsd:string .\n")
-
-# Add User instances
-turtle_statements.append("#################################################################")
-turtle_statements.append("#    User Instances")
-turtle_statements.append("#################################################################\n")
-
-admin_instance_uri = ":Admin1"  # URI for AdminUser
-
-turtle_statements.append(f"###  {admin_instance_uri}")
-turtle_statements.append(f"{admin_instance_uri} a :AdminUser ;")
-turtle_statements.append(f"             :hasName \"Vasilis\"^^xsd:string ;")
-turtle_statements.append(f"             :hasSurname \"Voudrislis\"^^xsd:string ;")
-turtle_statements.append(f"             :hasUsername \"admin\"^^xsd:string ;")
-turtle_statements.append(f"             :hasPassword \"password\"^^xsd:string .\n")
-
-normal_instance_uri = ":User1"  # URI for NormalUser
-
-turtle_statements.append(f"###  {normal_instance_uri}")
-turtle_statements.append(f"{normal_instance_uri} a :NormalUser ;")
-turtle_statements.append(f"             :hasName \"Vasilis\"^^xsd:string ;")
-turtle_statements.append(f"             :hasSurname \"Voudrislis\"^^xsd:string ;")
-turtle_statements.append(f"             :hasUsername \"user\"^^xsd:string ;")
-turtle_statements.append(f"             :hasPassword \"password\"^^xsd:string ;")
-turtle_statements.append(f"             :hasAddress \"123 Main Street, Cityville\"^^xsd:string .\n")
-
-
-# Add rdfs:seeAlso Headline
-turtle_statements.append("#################################################################")
-turtle_statements.append("#    See Also References for Classes")
-turtle_statements.append("#################################################################\n")
+""",
+]
 
 #Add some rdfs:seeAlso annotations because pto is deprecated
 class_seealso = {
@@ -414,21 +389,6 @@ class_seealso = {
     "Duster": "http://www.productontology.org/id/Housekeeping"
 }
 
-for class_name, seealso_value in class_seealso.items():
-    class_uri = f"pto:{class_name.replace(' ', '_')}"  
-    if "http" in seealso_value:
-        turtle_statements.append(f"{class_uri} rdfs:seeAlso <{seealso_value}> .\n")
-    else:
-        turtle_statements.append(f"{class_uri} rdfs:seeAlso \"{seealso_value}\"^^xsd:string .\n")
-
-
-
-# Save turtle file
-with open(output_file, "w", encoding="utf-8") as f:
-    f.write("\n".join(turtle_statements))
-
-print(f"Products Turtle file saved as {output_file}")
-
 ttl_content = """\
 #################################################################
 #    SHACL Shapes
@@ -573,11 +533,1032 @@ ttl_content = """\
     ] .
 """
 
-# Save the content to a Turtle file
-ttl_filename = "Shacl_shapes.ttl"
-with open(ttl_filename, "w", encoding="utf-8") as file:
-    file.write(ttl_content)
+def read_hierarchy(csv_path, chunksize=chunk_size):
+    """Read the category, subcategory and type columns in chunks and drop duplicates, keeping CSV order.
+
+    The 'products' column counts the products of every category, subcategory and type combination.
+    """
+    columns = ['category', 'subcategory', 'type']
+    parts = [
+        chunk.groupby(columns, sort=False, dropna=False).size()
+        for chunk in pd.read_csv(csv_path, usecols=columns, dtype=str, chunksize=chunksize)
+    ]
+    if not parts:
+        return pd.DataFrame(columns=columns + ['products'])
+    counts = pd.concat(parts).groupby(level=columns, sort=False, dropna=False).sum()
+    return counts.rename('products').reset_index()
+
+
+def hierarchy_rows(hierarchy):
+    """Return the (category, subcategory, type, products) rows of a hierarchy read by read_hierarchy."""
+    return list(hierarchy[['category', 'subcategory', 'type', 'products']].itertuples(index=False, name=None))
+
+
+def class_names(values):
+    """Build the local names of the category and subcategory classes of a column."""
+    return values.str.replace(" ", "_", regex=False)
+
+
+def product_counts(rows):
+    """Return the number of products of every category, subcategory and pto: type class, by class IRI.
+
+    rows are (category, subcategory, type, products) tuples, see hierarchy_rows. The counts are in the
+    order the classes first appear, categories first.
+    """
+    counts = {}
+    for position, namespace in ((0, ""), (1, ""), (2, "pto")):
+        for row in rows:
+            # A subcategory named like its category is the same class
+            class_uri = namespaces[namespace] + row[position].replace(" ", "_")
+            counts[class_uri] = counts.get(class_uri, 0) + int(row[3])
+    return counts
+
+
+def count_statements(counts):
+    """Return the :productCount statements of the hierarchy classes."""
+    return [
+        f"{turtle_iri(class_uri, namespaces)} :productCount \"{count}\"^^xsd:integer ."
+        for class_uri, count in counts.items()
+    ]
 
-print(f"SHACL shapes successfully written to {ttl_filename}")
 
+def class_statements(unique_categories, subcategory_to_category, type_to_subcategory):
+    """Return the class statements of the category, subcategory and pto: type hierarchy.
 
+    The last two arguments are iterables of (subcategory, category) and (type, subcategory) pairs.
+    """
+    turtle_statements = []
+
+    # Create classes from category column
+    for category in unique_categories:
+        class_name = category.replace(" ", "_")
+        class_uri = turtle_iri(namespaces[""] + class_name, namespaces)
+
+        # Add comment for each category class
+        turtle_statements.append(f"###  http://www.semanticweb.org/My_Super#{class_name}")
+
+        # Add class and subclass relation
+        turtle_statements.append(f"{class_uri} a owl:Class ;")
+        turtle_statements.append(f"               rdfs:subClassOf gr:ProductOrService .\n")
+
+    # Create classes from subcategory column
+    for subcategory, category in subcategory_to_category:
+        subcategory_name = subcategory.replace(" ", "_")
+        category_name = category.replace(" ", "_")
+
+        subcategory_uri = turtle_iri(namespaces[""] + subcategory_name, namespaces)
+        category_uri = turtle_iri(namespaces[""] + category_name, namespaces)
+
+        # Add comment for each subcategory class
+        turtle_statements.append(f"###  http://www.semanticweb.org/My_Super#{subcategory_name}")
+
+        # Add class and subclass relation
+        turtle_statements.append(f"{subcategory_uri} a owl:Class ;")
+        turtle_statements.append(f"                  rdfs:subClassOf {category_uri} .\n")
+
+    # Create classes from type and subcategory columns
+    for type_name, subcategory in type_to_subcategory:
+        class_name = type_name.replace(" ", "_")
+        subclass_of = subcategory.replace(" ", "_")
+
+        class_uri = turtle_iri(namespaces["pto"] + class_name, namespaces)
+        subclass_uri = turtle_iri(namespaces[""] + subclass_of, namespaces)
+
+        # Add comment for each type class
+        turtle_statements.append(f"###  http://www.productontology.org/id/{class_name}")
+
+        # Add class and subclass relation
+        turtle_statements.append(f"{class_uri} a owl:Class ;")
+        turtle_statements.append(f"             rdfs:subClassOf {subclass_uri} .\n")
+
+    return turtle_statements
+
+
+def header_statements(hierarchy):
+    """Return the prefix, property and class statements of the ontology, given the rows of hierarchy_rows."""
+    turtle_statements = list(prefixes)
+
+    # Add ontology
+    turtle_statements.append("<http://www.semanticweb.org/My_Super> a owl:Ontology .\n")
+
+    # Add properties headline
+    turtle_statements.append("#################################################################")
+    turtle_statements.append("#    Data properties")
+    turtle_statements.append("#################################################################\n")
+
+    # Add properties
+    turtle_statements.extend(properties)
+    turtle_statements.extend(hierarchy_properties)
+
+    # Add classes headline
+    turtle_statements.append("#################################################################")
+    turtle_statements.append("#    Classes")
+    turtle_statements.append("#################################################################\n")
+
+    # Add classes gr:ProductOrService, Order, OrderItem, User and the subclasses of User
+    turtle_statements.extend(base_classes)
+
+    # Create classes from category, subcategory and type columns
+    turtle_statements.extend(class_statements(
+        dict.fromkeys(category for category, _, _, _ in hierarchy),
+        dict.fromkeys((subcategory, category) for category, subcategory, _, _ in hierarchy),
+        dict.fromkeys((type_name, subcategory) for _, subcategory, type_name, _ in hierarchy),
+    ))
+
+    # Add product counts headline
+    turtle_statements.append("#################################################################")
+    turtle_statements.append("#    Product Counts")
+    turtle_statements.append("#################################################################\n")
+
+    turtle_statements.extend(count_statements(product_counts(hierarchy)))
+    turtle_statements.append("")
+
+    # Add instances headline
+    turtle_statements.append("#################################################################")
+    turtle_statements.append("#    Instances")
+    turtle_statements.append("#################################################################\n")
+
+    return turtle_statements
+
+
+def _text(column):
+    """Convert a column to strings the same way an f-string would, missing values included."""
+    return column.astype(str).fillna("nan")
+
+
+def instance_names(names):
+    """Build the local names of the instance URIs of a column of product names."""
+    # Replace empty and special characters
+    return names.str.replace(instance_name_characters, "_", regex=True)
+
+
+def type_names(types):
+    """Build the local names of the pto: classes of a column of product types."""
+    return types.str.replace(" ", "_", regex=False)
+
+
+def instance_triples(chunk, discounts, builder=None):
+    """Add the triples of a chunk of products to a triple builder, one whole column at a time."""
+    builder = TripleBuilder(namespaces) if builder is None else builder
+    product_name = _text(chunk['name'])  # Original name with special characters
+    instance_uri = builder.iris(instance_names(product_name), "")
+
+    # Add instance and its properties
+    builder.add_records(instance_uri, [
+        (builder.iri("a"), builder.iris(type_names(_text(chunk['type'])), "pto")),  # class from type column
+        (builder.iri("a"), builder.iri("owl:NamedIndividual")),
+        (builder.iri(":hasProductID"), builder.literals(_text(chunk['id']))),
+        (builder.iri(":isAvailable"), builder.literal("true", "xsd:boolean")),  # Original availabilty
+        (builder.iri(":hasStock"), builder.literal(initial_stock, "xsd:integer")),  # Original stock
+        (builder.iri(":hasBrand"), builder.literals(_text(chunk['brand']))),
+        (builder.iri(":hasPrice"), builder.literals(_text(chunk['price']), "xsd:double")),
+        (builder.iri(":hasDiscountPrice"), builder.literals(discounts, "xsd:double")),
+        (builder.iri(":hasQuantity"), builder.literals(_text(chunk['quantity']))),
+        (builder.iri("gr:name"), builder.literals(product_name)),
+        (builder.iri(":inCategory"), builder.iris(class_names(_text(chunk['category'])), "")),
+        (builder.iri(":inSubcategory"), builder.iris(class_names(_text(chunk['subcategory'])), "")),
+    ])
+    return builder
+
+
+def render_instances(chunk, discounts):
+    """Render the Turtle statements of a chunk of products."""
+    return instance_triples(chunk, discounts).turtle()
+
+
+def render_collected(chunk, discounts, validator=None, statistics=False, graph=None, turtle=True):
+    """Render a chunk of products like render_instances or render_instances_nt, validate its triples if
+    given a validator and count them by predicate if statistics is true.
+
+    Return the rendered text, the validation report of the chunk with the 1-based CSV rows (None without
+    a validator) and the PredicateStatistics of the chunk (None without statistics).
+    """
+    builder = instance_triples(chunk, discounts)
+    rendered = builder.turtle() if turtle else builder.ntriples(graph)
+    report = validator.check(builder, chunk.index.to_numpy() + 1) if validator is not None else None
+    return rendered, report, PredicateStatistics.of(builder) if statistics else None
+
+
+def user_statements():
+    """Return the user instances.
+
+    Their passwords are written in plaintext, so the SPARQL login of Account.js works on GraphDB. The local
+    SPARQL service replaces each one by its hash at the first login of its user (see auth_service.py).
+    """
+    turtle_statements = []
+
+    # Add User instances
+    turtle_statements.append("#################################################################")
+    turtle_statements.append("#    User Instances")
+    turtle_statements.append("#################################################################\n")
+
+    admin_instance_uri = ":Admin1"  # URI for AdminUser
+
+    turtle_statements.append(f"###  {admin_instance_uri}")
+    turtle_statements.append(f"{admin_instance_uri} a :AdminUser ;")
+    turtle_statements.append(f"             :hasName \"Vasilis\"^^xsd:string ;")
+    turtle_statements.append(f"             :hasSurname \"Voudrislis\"^^xsd:string ;")
+    turtle_statements.append(f"             :hasUsername \"admin\"^^xsd:string ;")
+    turtle_statements.append(f"             :hasPassword \"password\"^^xsd:string .\n")
+
+    normal_instance_uri = ":User1"  # URI for NormalUser
+
+    turtle_statements.append(f"###  {normal_instance_uri}")
+    turtle_statements.append(f"{normal_instance_uri} a :NormalUser ;")
+    turtle_statements.append(f"             :hasName \"Vasilis\"^^xsd:string ;")
+    turtle_statements.append(f"             :hasSurname \"Voudrislis\"^^xsd:string ;")
+    turtle_statements.append(f"             :hasUsername \"user\"^^xsd:string ;")
+    turtle_statements.append(f"             :hasPassword \"password\"^^xsd:string ;")
+    turtle_statements.append(f"             :hasAddress \"123 Main Street, Cityville\"^^xsd:string .\n")
+
+    return turtle_statements
+
+
+def seealso_statements():
+    """Return the rdfs:seeAlso annotations of the pto: classes."""
+    turtle_statements = []
+
+    # Add rdfs:seeAlso Headline
+    turtle_statements.append("#################################################################")
+    turtle_statements.append("#    See Also References for Classes")
+    turtle_statements.append("#################################################################\n")
+
+    for class_name, seealso_value in class_seealso.items():
+        class_uri = f"pto:{class_name.replace(' ', '_')}"
+        if "http" in seealso_value:
+            turtle_statements.append(f"{class_uri} rdfs:seeAlso <{seealso_value}> .\n")
+        else:
+            turtle_statements.append(f"{class_uri} rdfs:seeAlso \"{seealso_value}\"^^xsd:string .\n")
+
+    return turtle_statements
+
+
+def footer_statements():
+    """Return the user instances and the rdfs:seeAlso annotations."""
+    return user_statements() + seealso_statements()
+
+
+def turtle_to_ntriples(turtle, graph=None):
+    """Convert the Turtle statements written by this script to N-Triples lines, or N-Quads lines when graph is given."""
+    builder = TripleBuilder(namespaces)
+    builder.add_turtle(turtle)
+    return builder.ntriples(graph)
+
+
+def render_instances_nt(chunk, discounts, graph=None):
+    """Render the N-Triples lines, or N-Quads lines when graph is given, of a chunk of products."""
+    return instance_triples(chunk, discounts).ntriples(graph)
+
+
+def _priced_chunks(chunks, pricing, collect=None):
+    """Yield every chunk with its discounts, passing both to collect first if given."""
+    for chunk in chunks:
+        discounts = pricing.discounts(chunk)
+        if collect is not None:
+            collect(chunk, discounts)
+        yield chunk, discounts
+
+
+def render_chunks(chunks, pricing, workers=1, render=render_instances, collect=None):
+    """Render chunks of products and yield them in CSV order, using a process pool when workers > 1.
+
+    collect is called with every chunk and its discounts, in CSV order, before the chunk is rendered.
+    """
+    if workers <= 1:
+        for chunk, discounts in _priced_chunks(chunks, pricing, collect):
+            yield render(chunk, discounts)
+        return
+
+    # Discounts are computed here, whole chunks at a time, and collected in CSV order
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for chunk, discounts in _priced_chunks(chunks, pricing, collect):
+            pending.append(pool.submit(render, chunk, discounts))
+            # Keep a bounded number of chunks in flight so memory stays flat
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _open_output(path, compressed):
+    """Open an output file for writing text through a large buffer, gzip-compressed if asked."""
+    if compressed:
+        return gzip.open(path, "wt", encoding="utf-8", compresslevel=gzip_level)
+    return open(path, "w", encoding="utf-8", buffering=write_buffer_size)
+
+
+def write_products(csv_path, ttl_path, chunksize=chunk_size, pricing=None, workers=1, manifest_path=None,
+                   output_format="turtle", search_index_path=None, snapshot_path=None, validator=None, metrics=None,
+                   statistics_path=None):
+    """Stream the CSV file in chunks and write the products file in the given format through a buffered writer.
+
+    The discounts come from pricing, a PricingEngine, the default one without rules if not given.
+    With a validator (see compile_shapes) every chunk is also validated, its violations end up in
+    validator.violations. With statistics_path the predicate statistics of all the triples are saved
+    there. The stages are recorded in metrics, a StageRecorder, if given.
+    """
+    from product_snapshot import SnapshotBuilder
+    from search_index import SearchIndexBuilder
+
+    metrics = StageRecorder() if metrics is None else metrics
+    pricing = PricingEngine() if pricing is None else pricing
+    with metrics.stage("csv_load"):
+        hierarchy = read_hierarchy(csv_path, chunksize)
+    with metrics.stage("classes") as stage:
+        rows = hierarchy_rows(hierarchy)
+        header = "\n".join(header_statements(rows))
+        stage.rows += len(rows)
+    hashes = []
+    search_index = SearchIndexBuilder()
+    snapshot = SnapshotBuilder()
+    collect = functools.partial(snapshot_chunk, snapshot) if snapshot_path else None
+    statistics = PredicateStatistics()
+    collected = validator is not None or bool(statistics_path)
+    _, quads, compressed = output_formats[output_format]
+    graph = graph_name if quads else None
+    if validator is not None:
+        # The class hierarchy tells the validator which classes are products
+        classes = TripleBuilder(namespaces)
+        classes.add_turtle(header)
+        validator.learn(classes)
+
+    def write(text, stage):
+        f.write(text)
+        stage.bytes += text_bytes(text)
+
+    def write_statements(statements, stage):
+        text = "\n".join(statements)
+        write(text if output_format == "turtle" else turtle_to_ntriples(text, graph), stage)
+
+    with _open_output(ttl_path, compressed) as f:
+        chunks = metrics.iterate("csv_load", pd.read_csv(csv_path, dtype=csv_dtypes, chunksize=chunksize))
+        if manifest_path:
+            chunks = _collect_hashes(chunks, hashes)
+        if search_index_path:
+            chunks = _collect_search(chunks, search_index)
+
+        if output_format == "turtle":
+            render = render_instances
+        else:
+            render = functools.partial(render_instances_nt, graph=graph)
+        if collected:
+            render = functools.partial(render_collected, validator=validator, statistics=bool(statistics_path),
+                                       graph=graph, turtle=output_format == "turtle")
+
+        with metrics.stage("classes") as stage:
+            write(header + "\n" if output_format == "turtle" else turtle_to_ntriples(header, graph), stage)
+        with metrics.stage("instances") as stage:
+            # Every product read is rendered
+            loaded = metrics.get("csv_load").rows
+            for rendered in render_chunks(chunks, pricing, workers, render, collect):
+                if collected:
+                    rendered, report, chunk_statistics = rendered
+                    if report is not None:
+                        validator.merge(report)
+                    if chunk_statistics is not None:
+                        statistics.merge(chunk_statistics)
+                write(rendered, stage)
+            stage.rows += metrics.get("csv_load").rows - loaded
+            write_statements(user_statements(), stage)
+        with metrics.stage("see_also") as stage:
+            if output_format == "turtle":
+                write("\n", stage)
+            write_statements(seealso_statements(), stage)
+            stage.rows += len(class_seealso)
+
+    if validator is not None:
+        with metrics.stage("instances"):
+            # The user instances
+            users = TripleBuilder(namespaces)
+            users.add_turtle("\n".join(user_statements()))
+            validator.merge(validator.check(users))
+
+    with metrics.stage("index_write") as stage:
+        if manifest_path:
+            save_manifest(manifest_path, hashes, hierarchy)
+        if search_index_path:
+            search_index.write(search_index_path)
+        if snapshot_path:
+            snapshot.write(snapshot_path)
+        if statistics_path:
+            # The classes, users and rdfs:seeAlso statements besides the products
+            for text in (header, "\n".join(user_statements()), "\n".join(seealso_statements())):
+                builder = TripleBuilder(namespaces)
+                builder.add_turtle(text)
+                statistics.merge(PredicateStatistics.of(builder))
+            statistics.write(statistics_path)
+        stage.bytes += sum(os.path.getsize(path) for path in
+                           (manifest_path, search_index_path, snapshot_path, statistics_path) if path)
+
+
+def index_chunk(search_index, chunk):
+    """Add the names and brands of a chunk of products to a search index builder."""
+    product_name = _text(chunk['name'])
+    search_index.add(instance_names(product_name), product_name, _text(chunk['brand']))
+
+
+def _collect_search(chunks, search_index):
+    """Pass the chunks through while indexing their names and brands."""
+    for chunk in chunks:
+        index_chunk(search_index, chunk)
+        yield chunk
+
+
+def write_search_index(csv_path, index_path, chunksize=chunk_size):
+    """Build the name and brand search index of the CSV file."""
+    from search_index import SearchIndexBuilder
+
+    search_index = SearchIndexBuilder()
+    for chunk in pd.read_csv(csv_path, dtype=csv_dtypes, usecols=['name', 'brand'], chunksize=chunksize):
+        index_chunk(search_index, chunk)
+    search_index.write(index_path)
+
+
+def snapshot_chunk(snapshot, chunk, discounts):
+    """Add the fields of a chunk of products, as they are written to the products file, to a snapshot builder."""
+    product_name = _text(chunk['name'])
+    snapshot.add(
+        id=_text(chunk['id']),
+        instance=instance_names(product_name),
+        name=product_name,
+        brand=_text(chunk['brand']),
+        quantity=_text(chunk['quantity']),
+        price=chunk['price'],
+        discount=discounts,
+        stock=np.full(len(chunk), initial_stock),
+        available=np.ones(len(chunk), dtype=bool),
+        category=_text(chunk['category']),
+        subcategory=_text(chunk['subcategory']),
+        type=_text(chunk['type']),
+    )
+
+
+def snapshot_discounts(snapshot_path):
+    """Return the discounts of the previous snapshot by product id, empty if there is none."""
+    from product_snapshot import ProductSnapshot
+
+    if not snapshot_path or not os.path.exists(snapshot_path):
+        return pd.Series(dtype="float64")
+    snapshot = ProductSnapshot(snapshot_path)
+    try:
+        ids = [snapshot.text('id', row) for row in range(len(snapshot))]
+        discounts = pd.Series(np.array(snapshot.column('discount')), index=ids)
+    finally:
+        snapshot.close()
+    return discounts[~discounts.index.duplicated()]
+
+
+def row_hashes(chunk):
+    """Hash every manifest field of a chunk of products, indexed by product id."""
+    hashes = pd.DataFrame({
+        field: pd.util.hash_pandas_object(chunk[field], index=False).to_numpy(dtype="uint64")
+        for field in manifest_fields
+    })
+    hashes.index = pd.Index(_text(chunk['id']).to_numpy(), name='id')
+    return hashes
+
+
+def _collect_hashes(chunks, hashes):
+    """Pass the chunks through while collecting their row hashes."""
+    for chunk in chunks:
+        hashes.append(row_hashes(chunk))
+        yield chunk
+
+
+def save_manifest(manifest_path, hashes, hierarchy):
+    """Save the row hashes and the class hierarchy of this run."""
+    hashes = pd.concat(hashes) if hashes else pd.DataFrame(columns=manifest_fields, dtype="uint64")
+    with open(manifest_path, "wb") as f:
+        np.savez_compressed(
+            f,
+            ids=hashes.index.to_numpy(dtype=str),
+            hashes=hashes.to_numpy(dtype="uint64"),
+            hierarchy=hierarchy[['category', 'subcategory', 'type']].to_numpy(dtype=str),
+            products=hierarchy['products'].to_numpy(dtype="int64"),
+        )
+
+
+def load_manifest(manifest_path):
+    """Load the row hashes and the class hierarchy saved by the previous run."""
+    with np.load(manifest_path) as manifest:
+        hashes = pd.DataFrame(
+            manifest['hashes'].reshape(-1, len(manifest_fields)),
+            index=pd.Index(manifest['ids'], name='id'),
+            columns=manifest_fields,
+        )
+        hierarchy = pd.DataFrame(manifest['hierarchy'].reshape(-1, 3), columns=['category', 'subcategory', 'type'])
+        # Manifests saved before the product counts have no 'products' column
+        if 'products' in manifest.files:
+            hierarchy['products'] = manifest['products']
+    return hashes, hierarchy
+
+
+def _new_pairs(current, previous, columns):
+    """Return the rows of current whose values in columns do not appear in previous."""
+    current = current[columns].drop_duplicates()
+    known = pd.MultiIndex.from_frame(previous[columns])
+    return current[~pd.MultiIndex.from_frame(current).isin(known)]
+
+
+def _id_literal(product_id):
+    """Render a product id as a SPARQL literal, typed xsd:string like the generated :hasProductID.
+
+    Stores that keep "id" and "id"^^xsd:string apart, like a plain rdflib Graph, would not match the
+    plain literal.
+    """
+    return f"\"{escape_literal(product_id)}\"^^xsd:string"
+
+
+def _values(ids):
+    """Render product ids as the body of a SPARQL VALUES block."""
+    return " ".join(_id_literal(product_id) for product_id in ids)
+
+
+def write_delta(csv_path, delta_path, manifest_path, chunksize=chunk_size, pricing=None, snapshot_path=None):
+    """Compare the CSV file with the manifest of the previous run and write the changes as a SPARQL Update.
+
+    Only hashes are kept in the manifest, so old values are matched by product id with DELETE ... WHERE,
+    which stays correct when a value was edited in the store in the meantime. New products, new values
+    and classes that appear for the first time are added with a single INSERT DATA.
+
+    With snapshot_path the snapshot is rewritten from the whole CSV. The discounts of the existing
+    products are not in the CSV, they are kept from the previous snapshot (NaN if it has none). New
+    products are priced by pricing, a PricingEngine, the default one without rules if not given.
+    """
+    from product_snapshot import SnapshotBuilder
+
+    pricing = PricingEngine() if pricing is None else pricing
+    old_hashes, old_hierarchy = load_manifest(manifest_path)
+    # Manifests saved before the hashes were 64-bit hold their low 32 bits
+    hash_mask = np.uint64(0xFFFFFFFF if (old_hashes.dtypes == "uint32").all() else 0xFFFFFFFFFFFFFFFF)
+    old_hash_values = old_hashes.to_numpy(dtype="uint64")
+    hierarchy = read_hierarchy(csv_path, chunksize)
+    old_discounts = snapshot_discounts(snapshot_path)
+    snapshot = SnapshotBuilder()
+
+    seen = np.zeros(len(old_hashes), dtype=bool)
+    hashes = []
+    renamed = []
+    retyped = []
+    changed = {field: [] for field in [*field_predicates, *link_predicates]}
+    inserted = []
+    changes = TripleBuilder(namespaces)
+    added = 0
+    modified = 0
+
+    for chunk in pd.read_csv(csv_path, dtype=csv_dtypes, chunksize=chunksize):
+        chunk_hashes = row_hashes(chunk)
+        hashes.append(chunk_hashes)
+
+        positions = old_hashes.index.get_indexer(chunk_hashes.index)
+        seen[positions[positions >= 0]] = True
+
+        # Products that were not in the previous run are inserted whole
+        is_new = positions < 0
+        discounts = np.array(old_discounts.reindex(chunk_hashes.index), dtype="float64")
+        if is_new.any():
+            new_rows = chunk[is_new]
+            new_discounts = pricing.discounts(new_rows)
+            inserted.append(render_instances(new_rows, new_discounts))
+            discounts[is_new] = new_discounts
+            added += len(new_rows)
+        if snapshot_path:
+            snapshot_chunk(snapshot, chunk, discounts)
+
+        # Compare the remaining products field by field and keep the ones with changes
+        differs = old_hash_values[positions[~is_new]] != chunk_hashes.to_numpy()[~is_new] & hash_mask
+        is_changed = differs.any(axis=1)
+        known = chunk[~is_new][is_changed]
+        differs = differs[is_changed]
+        modified += len(known)
+
+        instance_uri = changes.iris(instance_names(_text(known['name'])), "")
+        product_id = _text(known['id']).to_numpy()
+
+        rows = differs[:, manifest_fields.index('name')]
+        renamed.extend(zip(product_id[rows], instance_uri[rows]))
+        rows = differs[:, manifest_fields.index('type')]
+        retyped.extend(product_id[rows])
+        changes.add_records(instance_uri[rows], [
+            (changes.iri("a"), changes.iris(type_names(_text(known['type'][rows])), "pto")),
+        ])
+        for field, (predicate, datatype) in field_predicates.items():
+            rows = differs[:, manifest_fields.index(field)]
+            changed[field].extend(product_id[rows])
+            changes.add_records(instance_uri[rows], [
+                (changes.iri(predicate), changes.literals(_text(known[field][rows]), datatype)),
+            ])
+        for field, predicate in link_predicates.items():
+            rows = differs[:, manifest_fields.index(field)]
+            changed[field].extend(product_id[rows])
+            changes.add_records(instance_uri[rows], [
+                (changes.iri(predicate), changes.iris(class_names(_text(known[field][rows])), "")),
+            ])
+
+    # Products that are no longer in the CSV file
+    removed = old_hashes.index[~seen]
+
+    updates = []
+    if len(removed):
+        updates.append(
+            "# Removed products\n"
+            f"DELETE {{ ?product ?p ?o }} WHERE {{ VALUES ?id {{ {_values(removed)} }} "
+            "?product :hasProductID ?id ; ?p ?o . }"
+        )
+    if 'products' not in old_hierarchy:
+        # The previous run did not link products to their classes yet
+        updates.append(
+            "# Category and subcategory links of the existing products\n"
+            "INSERT { ?product :inCategory ?category ; :inSubcategory ?subcategory } WHERE { "
+            "?product :hasProductID ?id ; a ?type . ?type rdfs:subClassOf ?subcategory . "
+            "?subcategory rdfs:subClassOf ?category . ?category rdfs:subClassOf gr:ProductOrService . "
+            "FILTER NOT EXISTS { ?product :inCategory ?linked } }"
+        )
+    if renamed:
+        # Move references and triples of renamed products to their new URI
+        values = " ".join(
+            f"({_id_literal(product_id)} {changes.turtle_term(changes.terms[uri])})" for product_id, uri in renamed
+        )
+        updates.append(
+            "# Renamed products\n"
+            f"DELETE {{ ?s ?p ?product }} INSERT {{ ?s ?p ?new }} WHERE {{ VALUES (?id ?new) {{ {values} }} "
+            "?product :hasProductID ?id . ?s ?p ?product . }"
+        )
+        updates.append(
+            f"DELETE {{ ?product ?p ?o }} INSERT {{ ?new ?p ?o }} WHERE {{ VALUES (?id ?new) {{ {values} }} "
+            "?product :hasProductID ?id ; ?p ?o . }"
+        )
+    if retyped:
+        updates.append(
+            "# Changed pto: types\n"
+            f"DELETE {{ ?product a ?old }} WHERE {{ VALUES ?id {{ {_values(retyped)} }} "
+            "?product :hasProductID ?id ; a ?old . FILTER(STRSTARTS(STR(?old), STR(pto:))) }"
+        )
+    predicates = {field: predicate for field, (predicate, _) in field_predicates.items()}
+    predicates.update(link_predicates)
+    for field, predicate in predicates.items():
+        if changed[field]:
+            updates.append(
+                f"# Changed {predicate}\n"
+                f"DELETE {{ ?product {predicate} ?old }} WHERE {{ VALUES ?id {{ {_values(changed[field])} }} "
+                f"?product :hasProductID ?id ; {predicate} ?old . }}"
+            )
+
+    # Classes that appear for the first time
+    new_classes = [] if 'products' in old_hierarchy else list(hierarchy_properties)
+    new_classes += class_statements(
+        _new_pairs(hierarchy, old_hierarchy, ['category'])['category'],
+        _new_pairs(hierarchy, old_hierarchy, ['subcategory', 'category']).itertuples(index=False, name=None),
+        _new_pairs(hierarchy, old_hierarchy, ['type', 'subcategory']).itertuples(index=False, name=None),
+    )
+
+    # Product counts that changed, classes that lost all their products get a count of 0
+    counts = pd.Series(product_counts(hierarchy_rows(hierarchy)), dtype="int64")
+    old_counts = pd.Series(product_counts(hierarchy_rows(old_hierarchy)) if 'products' in old_hierarchy else {},
+                           dtype="int64")
+    classes = counts.index.append(old_counts.index.difference(counts.index))
+    counts = counts.reindex(classes, fill_value=0)
+    counts = counts[counts != old_counts.reindex(classes, fill_value=-1)]
+    if len(counts):
+        values = " ".join(turtle_iri(class_uri, namespaces) for class_uri in counts.index)
+        updates.append(
+            "# Changed product counts\n"
+            f"DELETE {{ ?class :productCount ?old }} WHERE {{ VALUES ?class {{ {values} }} ?class :productCount ?old . }}"
+        )
+    new_classes += count_statements(counts)
+
+    insert_data = "".join(statement + "\n" for statement in new_classes) + "".join(inserted) + changes.turtle_lines()
+    if insert_data.strip():
+        updates.append(f"INSERT DATA {{\n{insert_data}}}")
+
+    with open(delta_path, "w", encoding="utf-8", buffering=write_buffer_size) as f:
+        f.write("\n".join(sparql_prefixes) + "\n")
+        f.write(" ;\n\n".join(updates) + "\n")
+
+    save_manifest(manifest_path, hashes, hierarchy)
+    if snapshot_path:
+        snapshot.write(snapshot_path)
+    return added, modified, len(removed)
+
+
+def write_reprice(csv_path, update_path, pricing, chunksize=chunk_size, snapshot_path=None):
+    """Write the discounts the pricing rules give to the products of the CSV file as a SPARQL Update.
+
+    Products are matched by product id, reprice_batch_size of them per DELETE/INSERT, instead of one
+    update per product. With a snapshot of the previous discounts only the products whose discount
+    changes are written, and the snapshot is rewritten with the new discounts.
+    Return the number of products written.
+    """
+    from product_snapshot import SnapshotBuilder
+
+    old_discounts = snapshot_discounts(snapshot_path)
+    snapshot = SnapshotBuilder()
+    values = []
+    for chunk in pd.read_csv(csv_path, dtype=csv_dtypes, chunksize=chunksize):
+        discounts = pricing.discounts(chunk)
+        product_id = _text(chunk['id']).to_numpy()
+        # Products missing from the snapshot have a NaN old discount, which differs from every discount
+        rows = discounts != np.array(old_discounts.reindex(product_id), dtype="float64")
+        values.extend(f"({_id_literal(row_id)} \"{discount}\"^^xsd:double)"
+                      for row_id, discount in zip(product_id[rows], discounts[rows]))
+        if snapshot_path:
+            snapshot_chunk(snapshot, chunk, discounts)
+
+    updates = []
+    for start in range(0, len(values), reprice_batch_size):
+        updates.append(
+            "DELETE { ?product :hasDiscountPrice ?old } INSERT { ?product :hasDiscountPrice ?new } "
+            f"WHERE {{ VALUES (?id ?new) {{ {' '.join(values[start:start + reprice_batch_size])} }} "
+            "?product :hasProductID ?id . OPTIONAL { ?product :hasDiscountPrice ?old } }"
+        )
+
+    with open(update_path, "w", encoding="utf-8", buffering=write_buffer_size) as f:
+        f.write("\n".join(sparql_prefixes) + "\n")
+        f.write(" ;\n\n".join(updates) + "\n")
+
+    if snapshot_path:
+        snapshot.write(snapshot_path)
+    return len(values)
+
+
+def _csv_value(column, value):
+    """Convert a value read by the csv module to the text the pandas path renders for it."""
+    if value is None or value in na_values:
+        return "nan"
+    if column == 'price':
+        return str(float(value))
+    return value
+
+
+def read_csv_rows(csv_path, chunksize=chunk_size):
+    """Read the CSV file with the csv module and yield lists of up to chunksize rows, as dicts of text.
+
+    Values are converted like the pandas path converts them: prices are parsed as floats and the
+    strings pandas reads as missing become "nan".
+    """
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        chunk = []
+        for row in csv.DictReader(f):
+            chunk.append({column: _csv_value(column, value) for column, value in row.items()})
+            if len(chunk) >= chunksize:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def csv_hierarchy(csv_path, chunksize=chunk_size):
+    """Return the (category, subcategory, type, products) rows of the CSV file like hierarchy_rows, with the csv module."""
+    counts = Counter()
+    for chunk in read_csv_rows(csv_path, chunksize):
+        counts.update((row['category'], row['subcategory'], row['type']) for row in chunk)
+    return [(*classes, products) for classes, products in counts.items()]
+
+
+@functools.lru_cache(maxsize=4096)
+def _prefixed(namespace, local):
+    """Render the IRI of a local name in a namespace like the triple builder does."""
+    return turtle_iri(escape_iri(namespaces[namespace] + local), namespaces)
+
+
+def _literal(value, datatype="xsd:string"):
+    return f'"{escape_literal(str(value))}"^^{datatype}'
+
+
+def render_rows(rows, discounts):
+    """Render the Turtle statements of rows read by read_csv_rows, the same text as render_instances."""
+    statements = []
+    for row, discount in zip(rows, discounts):
+        subject = _prefixed("", instance_name_characters.sub("_", row['name']))
+        pairs = [
+            ("a", _prefixed("pto", row['type'].replace(" ", "_"))),
+            ("a", "owl:NamedIndividual"),
+            (":hasProductID", _literal(row['id'])),
+            (":isAvailable", _literal("true", "xsd:boolean")),
+            (":hasStock", _literal(initial_stock, "xsd:integer")),
+            (":hasBrand", _literal(row['brand'])),
+            (":hasPrice", _literal(row['price'], "xsd:double")),
+            (":hasDiscountPrice", _literal(discount, "xsd:double")),
+            (":hasQuantity", _literal(row['quantity'])),
+            ("gr:name", _literal(row['name'])),
+            (":inCategory", _prefixed("", row['category'].replace(" ", "_"))),
+            (":inSubcategory", _prefixed("", row['subcategory'].replace(" ", "_"))),
+        ]
+        statements.append(f"###  {subject}\n{subject} "
+                          + " ;\n             ".join(f"{predicate} {obj}" for predicate, obj in pairs) + " .\n\n")
+    return "".join(statements)
+
+
+def write_products_stdlib(csv_path, ttl_path, chunksize=chunk_size, pricing=None, metrics=None):
+    """Write the same Turtle file as write_products with the csv module, without numpy or pandas.
+
+    Only the products file is written: the manifest, the search index, the snapshot and the SHACL
+    validation need numpy. The discounts are computed row by row with PricingEngine.discount().
+    """
+    metrics = StageRecorder() if metrics is None else metrics
+    pricing = PricingEngine() if pricing is None else pricing
+    with metrics.stage("csv_load"):
+        hierarchy = csv_hierarchy(csv_path, chunksize)
+    with _open_output(ttl_path, False) as f:
+        def write(text, stage):
+            f.write(text)
+            stage.bytes += text_bytes(text)
+
+        with metrics.stage("classes") as stage:
+            write("\n".join(header_statements(hierarchy)) + "\n", stage)
+            stage.rows += len(hierarchy)
+        with metrics.stage("instances") as stage:
+            for chunk in metrics.iterate("csv_load", read_csv_rows(csv_path, chunksize)):
+                write(render_rows(chunk, [pricing.discount(row) for row in chunk]), stage)
+                stage.rows += len(chunk)
+            write("\n".join(user_statements()), stage)
+        with metrics.stage("see_also") as stage:
+            write("\n" + "\n".join(seealso_statements()), stage)
+            stage.rows += len(class_seealso)
+
+
+def check_csv(csv_path):
+    """Check that the CSV file can be generated, with the csv module: its columns, missing values, prices and ids.
+
+    Return the number of products and a list of problems, each with its 1-based CSV row like the SHACL
+    violations, empty when the file is fine.
+    """
+    columns = ['id', *csv_dtypes]
+    problems = []
+    ids = set()
+    rows = 0
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        reader = csv.DictReader(f)
+        missing = [column for column in columns if column not in (reader.fieldnames or [])]
+        if missing:
+            return 0, [f"missing columns: {', '.join(missing)}"]
+        for rows, row in enumerate(reader, 1):
+            empty = [column for column in columns if row[column] is None or row[column] in na_values]
+            if empty:
+                problems.append(f"row {rows}: missing {', '.join(empty)}")
+            if 'price' not in empty:
+                try:
+                    price = float(row['price'])
+                except ValueError:
+                    price = None
+                if price is None or not price > 0:
+                    problems.append(f"row {rows}: price {row['price']!r} is not a positive number")
+            if row['id'] in ids:
+                problems.append(f"row {rows}: id {row['id']!r} is used by an earlier product")
+            ids.add(row['id'])
+    return rows, problems
+
+
+def write_violations(path, violations):
+    """Write the SHACL violations, one per line, or remove an old report when there are none."""
+    from shacl_validator import format_violation
+
+    if not violations:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    with open(path, "w", encoding="utf-8") as f:
+        f.writelines(format_violation(violation) + "\n" for violation in violations)
+
+
+def write_shacl(ttl_filename):
+    """Save the SHACL shapes to a Turtle file."""
+    with open(ttl_filename, "w", encoding="utf-8") as file:
+        file.write(ttl_content)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate Products.ttl and Shacl_shapes.ttl from Products.csv.")
+    parser.add_argument("--csv", default=csv_file, help="input CSV file")
+    parser.add_argument("--format", choices=sorted(output_formats), default="turtle", help="output format")
+    parser.add_argument("--output", default=None, help="output file, named after the format by default")
+    parser.add_argument("--shacl", default=shacl_file, help="output SHACL shapes file")
+    parser.add_argument("--chunksize", type=int, default=chunk_size, help="CSV rows rendered and written at once")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="seed of the default discounts of the products without a pricing rule")
+    parser.add_argument("--pricing", default=pricing_file, help="discount rules CSV file, used if it exists")
+    parser.add_argument("--reprice", action="store_true",
+                        help="only write the discounts of the pricing rules as a SPARQL Update")
+    parser.add_argument("--reprice-output", default=reprice_file, help="output SPARQL Update file of --reprice")
+    parser.add_argument("--workers", type=int, default=1, help="processes used to render the product instances")
+    parser.add_argument("--manifest", default=manifest_file, help="row hash manifest of the last run")
+    parser.add_argument("--incremental", action="store_true", help="only write the changes since the last run")
+    parser.add_argument("--delta", default=delta_file, help="output SPARQL Update file of --incremental")
+    parser.add_argument("--search-index", default=search_index_file, help="output name and brand search index")
+    parser.add_argument("--snapshot", default=snapshot_file, help="output columnar snapshot of the product fields")
+    parser.add_argument("--no-validate", dest="validate", action="store_false",
+                        help="do not validate the products against the SHACL shapes")
+    parser.add_argument("--stats", default=statistics_file,
+                        help="output per-predicate statistics for the query planner of sparql_service.py")
+    parser.add_argument("--violations", default=violations_file, help="output report of the SHACL violations")
+    parser.add_argument("--engine", choices=engines, default="pandas",
+                        help="read the CSV with pandas, or with the csv module to only write the Turtle file quickly")
+    parser.add_argument("--check", action="store_true", help="only check the CSV file, without writing anything")
+    parser.add_argument("--metrics", default=None,
+                        help="also write the stage metrics to this file in the Prometheus text format")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="trace the peak Python allocations of every stage with tracemalloc (slower)")
+    parser.add_argument("--profile", default=None,
+                        help="profile the run with cProfile and save the stats to this file (not the --workers processes)")
+    args = parser.parse_args(argv)
+
+    # Check if the file exists
+    if not os.path.exists(args.csv):
+        raise FileNotFoundError(f"File {args.csv} not found.")
+
+    if args.check:
+        rows, problems = check_csv(args.csv)
+        for problem in problems[:10]:
+            print(problem)
+        print(f"{args.csv}: {rows} products, {len(problems)} problems")
+        return 1 if problems else 0
+
+    if args.engine == "stdlib" and (args.format != "turtle" or args.incremental):
+        parser.error("--engine stdlib only writes the full Turtle file")
+    if args.output is None:
+        args.output = output_formats[args.format][0]
+    try:
+        rules = load_rules(args.pricing) if os.path.exists(args.pricing) else []
+    except ValueError as error:
+        parser.error(str(error))
+    pricing = PricingEngine(rules, args.seed)
+
+    metrics = StageRecorder(args.trace_memory)
+    with profiled(args.profile) if args.profile else contextlib.nullcontext():
+        generate(args, pricing, metrics)
+    if args.profile:
+        print(f"Profile saved as {args.profile}")
+
+    for line in metrics.table():
+        print(line)
+    if args.metrics:
+        families = metrics.families(metrics_prefix) + memory_families(metrics_prefix)
+        families.append((f"{metrics_prefix}_completed_timestamp_seconds", "gauge", "Unix time the run finished.",
+                         [("", {}, time.time())]))
+        write_prometheus(args.metrics, families)
+        print(f"Metrics saved as {args.metrics}")
+    return 0
+
+
+def generate(args, pricing, metrics):
+    """Write the files of a run of main(), recording its stages in metrics."""
+    if args.reprice:
+        with metrics.stage("reprice") as stage:
+            repriced = write_reprice(args.csv, args.reprice_output, pricing, args.chunksize, args.snapshot)
+            stage.rows += repriced
+            stage.bytes += os.path.getsize(args.reprice_output)
+        print(f"Discounts of {repriced} products saved as {args.reprice_output}")
+        print(f"Product snapshot saved as {args.snapshot}")
+        return
+    if args.engine == "stdlib":
+        write_products_stdlib(args.csv, args.output, args.chunksize, pricing, metrics)
+        print(f"Products turtle file saved as {args.output}")
+        print("The manifest, search index, snapshot and predicate statistics were not updated and the products were "
+              "not validated")
+    elif args.incremental and os.path.exists(args.manifest):
+        # Save the changes since the last run
+        with metrics.stage("delta") as stage:
+            added, modified, removed = write_delta(args.csv, args.delta, args.manifest, args.chunksize, pricing,
+                                                   args.snapshot)
+            stage.rows += added + modified + removed
+            stage.bytes += os.path.getsize(args.delta)
+        print(f"Delta with {added} new, {modified} changed and {removed} removed products saved as {args.delta}")
+
+        # The search index is small, rebuild it from the whole CSV
+        with metrics.stage("index_write") as stage:
+            write_search_index(args.csv, args.search_index, args.chunksize)
+            stage.bytes += os.path.getsize(args.search_index)
+    else:
+        if args.incremental:
+            print(f"No manifest found at {args.manifest}, generating the full file")
+
+        from shacl_validator import compile_shapes, format_violation
+
+        # Save turtle file
+        validator = compile_shapes(ttl_content) if args.validate else None
+        write_products(args.csv, args.output, args.chunksize, pricing, args.workers, args.manifest, args.format,
+                       args.search_index, args.snapshot, validator, metrics, args.stats)
+        print(f"Products {args.format} file saved as {args.output}")
+        print(f"Predicate statistics saved as {args.stats}")
+        if validator is not None:
+            write_violations(args.violations, validator.violations)
+            for violation in validator.violations[:10]:
+                print(format_violation(violation))
+            if validator.violations:
+                print(f"{len(validator.violations)} SHACL violations saved as {args.violations}")
+            else:
+                print("No SHACL violations")
+    if args.engine != "stdlib":
+        print(f"Search index saved as {args.search_index}")
+        print(f"Product snapshot saved as {args.snapshot}")
+
+    # Save the content to a Turtle file
+    with metrics.stage("shacl_write") as stage:
+        write_shacl(args.shacl)
+        stage.bytes += os.path.getsize(args.shacl)
+    print(f"SHACL shapes successfully written to {args.shacl}")
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,269 @@
+"""
+Logins and sessions for the local SPARQL service, on the :NormalUser and :AdminUser instances of Products.py.
+
+On GraphDB, Account.js logs in with a SPARQL query matching :hasUsername and :hasPassword literals, and
+AccountDetails.js and Cart.js look the user up by :hasUsername again. On this service they use the
+endpoints of sparql_service.py instead, and AuthService resolves a user once per login:
+
+- usernames are indexed in a dict to their user, built from the user instances at startup and kept up
+  to date with every write (see apply()), so a login looks up one key instead of matching literals.
+- passwords are salted PBKDF2 hashes (see passwords.py). Checking one takes a few hundred milliseconds
+  of CPU on purpose, so logins are checked in a pool of threads (hashlib releases the GIL) and never
+  hold up the event loop or the store thread. An unknown username is hashed too, so it answers as
+  slowly as a wrong password. A password stored in plaintext, like the ones Products.py generates and
+  Account.js creates on GraphDB, is accepted once: the login replaces it by its hash.
+- a login opens a session: a random token mapped to the user with its role, name and addresses. Tokens
+  are kept in memory, the least recently used dropped past max_sessions and every one expired after
+  session_seconds without a request, so resolving the user of a request is one dict lookup. Sessions
+  end when the password of their user changes or the user is deleted.
+
+New accounts are created with register(), which stores the hash of the password instead of the
+password. Users are named like Account.js names them (:NormalUser3).
+
+The service writes accounts and replaced passwords through its write callback, so the same logins run
+on the store of sparql_service.py and on the router of catalog_shards.py, which keeps a graph of the
+user triples only (see user_triples()).
+
+Logins and user details are JSON objects:
+
+    {"username": "user", "password": "password", "role": "customer"}
+    {"user": "http://www.semanticweb.org/My_Super/User1", "userInstance": "User1", "username": "user",
+     "role": "customer", "name": "Vasilis", "surname": "Voudrislis", "addresses": ["123 Main Street, Cityville"]}
+
+where the role is "customer" for a :NormalUser and "shopOwner" for an :AdminUser, as in Account.js.
+"""
+
+import asyncio
+import functools
+import os
+import secrets
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from rdflib import RDF, XSD, Literal, URIRef
+
+from catalog_store import catalog_namespaces
+from order_service import HAS_USERNAME, NORMAL_USER
+from passwords import hash_password, is_password_hash, verify_password, verify_plaintext
+
+base = catalog_namespaces[""]
+
+# Properties of the user model, as defined by Products.py
+ADMIN_USER = URIRef(base + "AdminUser")
+HAS_PASSWORD = URIRef(base + "hasPassword")
+HAS_NAME = URIRef(base + "hasName")
+HAS_SURNAME = URIRef(base + "hasSurname")
+HAS_ADDRESS = URIRef(base + "hasAddress")
+
+user_predicates = {HAS_USERNAME, HAS_PASSWORD, HAS_NAME, HAS_SURNAME, HAS_ADDRESS}
+
+# User classes by the role names of Account.js
+roles = {"customer": NORMAL_USER, "shopOwner": ADMIN_USER}
+user_classes = set(roles.values())
+
+# Most sessions kept, the least recently used ones are dropped past it
+max_sessions = 10_000
+
+# Seconds without a request after which a session expires
+session_seconds = 2 * 3600
+
+
+class AuthError(Exception):
+    """An account that cannot be created, because its username is taken."""
+
+
+@functools.cache
+def _unknown_user_hash():
+    # Checked against the password of an unknown username, so it costs as much as a known one
+    return hash_password(secrets.token_urlsafe())
+
+
+def is_user_triple(triple):
+    """Return whether the logins read a triple: a user property or a user class."""
+    _, p, o = triple
+    return p in user_predicates or (p == RDF.type and o in user_classes)
+
+
+def user_triples(graph):
+    """Return the triples of the users of a graph that the logins read."""
+    return [triple for user in set(graph.subjects(HAS_USERNAME, None))
+            for triple in graph.triples((user, None, None)) if is_user_triple(triple)]
+
+
+class AuthService:
+    """Logs users in and resolves the user of a session token.
+
+    The index is read on the event loop and updated by apply() where the graph is written. Sessions are
+    only touched on the event loop.
+    """
+
+    def __init__(self, graph, write=None, max_sessions=max_sessions, session_seconds=session_seconds, workers=None):
+        self.graph = graph
+        # Coroutine function called with a function returning the (added, removed) triples of a change: runs
+        # it where the graph is not written concurrently, writes the change like an update and returns once
+        # apply() has seen it. Without it no account is created and plaintext passwords are not accepted.
+        self.write = write
+        self.max_sessions = max_sessions
+        self.session_seconds = session_seconds
+        # Hashes passwords off the event loop, one thread per core
+        self.hashers = ThreadPoolExecutor(max_workers=workers or os.cpu_count(), thread_name_prefix="auth")
+        # username -> user IRI
+        self.usernames = {}
+        # user IRI -> user details, and stored password
+        self.users = {}
+        self._passwords = {}
+        # token -> (user IRI, stored password at login, expiry time), the most recently used last
+        self.sessions = OrderedDict()
+        self.logins = 0
+        self.failed_logins = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.rehashed = 0
+        self._refresh(set(graph.subjects(HAS_USERNAME, None)))
+
+    def apply(self, changes):
+        """Update the index after a write, given its (added, s, p, o) changes."""
+        users = {s for _, s, p, o in changes if is_user_triple((s, p, o))}
+        if users:
+            self._refresh(users)
+
+    def _refresh(self, users):
+        for user in users:
+            previous = self.users.get(user)
+            if previous is not None and self.usernames.get(previous["username"]) == user:
+                del self.usernames[previous["username"]]
+            details, password = self._read(user)
+            if details is None:
+                self.users.pop(user, None)
+                self._passwords.pop(user, None)
+                continue
+            self.users[user] = details
+            self._passwords[user] = password
+            self.usernames[details["username"]] = user
+
+    def _read(self, user):
+        graph = self.graph
+        username = graph.value(user, HAS_USERNAME)
+        password = graph.value(user, HAS_PASSWORD)
+        types = set(graph.objects(user, RDF.type))
+        role = next((name for name, cls in roles.items() if cls in types), None)
+        if username is None or password is None or role is None:
+            return None, None
+        details = {
+            "user": str(user),
+            "userInstance": str(user).rsplit("/", 1)[-1],
+            "username": str(username),
+            "role": role,
+            "name": str(graph.value(user, HAS_NAME) or ""),
+            "surname": str(graph.value(user, HAS_SURNAME) or ""),
+            "addresses": sorted(map(str, graph.objects(user, HAS_ADDRESS))),
+        }
+        return details, str(password)
+
+    async def hash(self, password):
+        """Return the stored form of a new password, hashed off the event loop."""
+        return await asyncio.get_running_loop().run_in_executor(self.hashers, hash_password, password)
+
+    async def login(self, username, password, role=None):
+        """Check a username and password and return a new session token and the user, or None."""
+        user = self.usernames.get(username)
+        details = self.users.get(user)
+        stored = self._passwords.get(user)
+        known = details is not None and stored is not None and (role is None or details["role"] == role)
+        if known and not is_password_hash(stored):
+            valid = await self._replace_plaintext(user, stored, password)
+            stored = self._passwords.get(user)
+        else:
+            valid = await asyncio.get_running_loop().run_in_executor(
+                self.hashers, verify_password, password, stored if known else _unknown_user_hash())
+        if not (known and valid):
+            self.failed_logins += 1
+            return None
+        self.logins += 1
+        token = secrets.token_urlsafe(32)
+        now = time.monotonic()
+        sessions = self.sessions
+        sessions[token] = (user, stored, now + self.session_seconds)
+        # The least recently used sessions are first, and so are the expired ones
+        while sessions and (len(sessions) > self.max_sessions or next(iter(sessions.values()))[2] < now):
+            sessions.popitem(last=False)
+            self.evictions += 1
+        return token, details
+
+    async def _replace_plaintext(self, user, stored, password):
+        """Check a password stored in plaintext and replace it by its hash, return whether it matched."""
+        # Hashed whether it matches or not, so it answers as slowly as a hashed password
+        hashed = await self.hash(password)
+        if self.write is None or not verify_plaintext(password, stored):
+            return False
+        replaced = []
+
+        def changes():
+            # The password may have changed since it was checked
+            old = list(self.graph.triples((user, HAS_PASSWORD, None)))
+            if [str(o) for _, _, o in old] != [stored]:
+                return [], []
+            replaced.append(user)
+            return [(user, HAS_PASSWORD, Literal(hashed, datatype=XSD.string))], old
+
+        await self.write(changes)
+        self.rehashed += len(replaced)
+        return bool(replaced)
+
+    def session(self, token):
+        """Return the user of a session token, or None if it is unknown or expired."""
+        entry = self.sessions.get(token)
+        if entry is not None:
+            user, stored, expires = entry
+            now = time.monotonic()
+            details = self.users.get(user)
+            if expires >= now and details is not None and self._passwords.get(user) == stored:
+                self.sessions[token] = (user, stored, now + self.session_seconds)
+                self.sessions.move_to_end(token)
+                self.hits += 1
+                return details
+            del self.sessions[token]
+        self.misses += 1
+        return None
+
+    def logout(self, token):
+        """End a session, return whether it was open."""
+        return self.sessions.pop(token, None) is not None
+
+    async def register(self, username, password, name, surname, address):
+        """Create a :NormalUser with a hashed password and return its details."""
+        if self.write is None:
+            raise AuthError("Accounts cannot be created on this service")
+        if username in self.usernames:
+            raise AuthError(f"Username already taken: {username}")
+        stored = await self.hash(password)
+        created = []
+
+        def changes():
+            # Checked again where no other change is written, the username may have been taken while hashing
+            if username in self.usernames:
+                raise AuthError(f"Username already taken: {username}")
+            graph = self.graph
+            number = len(set(graph.subjects(RDF.type, NORMAL_USER))) + 1
+            while (URIRef(f"{base}NormalUser{number}"), None, None) in graph:
+                number += 1
+            user = URIRef(f"{base}NormalUser{number}")
+            created.append(user)
+            return [(user, RDF.type, NORMAL_USER)] + [
+                (user, predicate, Literal(value, datatype=XSD.string))
+                for predicate, value in [(HAS_USERNAME, username), (HAS_PASSWORD, stored), (HAS_NAME, name),
+                                         (HAS_SURNAME, surname), (HAS_ADDRESS, address)]
+            ], []
+
+        await self.write(changes)
+        return self.users[created[0]]
+
+    def stats(self):
+        return {"users": len(self.users), "sessions": len(self.sessions), "logins": self.logins,
+                "failedLogins": self.failed_logins, "sessionHits": self.hits, "sessionMisses": self.misses,
+                "evictions": self.evictions, "rehashedPasswords": self.rehashed}
+
+    def close(self):
+        self.hashers.shutdown()
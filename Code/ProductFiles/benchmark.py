@@ -0,0 +1,400 @@
+"""
+Benchmarks of Products.py and of the queries the React app sends, at growing catalog sizes.
+
+For every size the benchmark:
+1. Writes a synthetic CSV shaped like Products.csv. Rows are drawn from Products.csv, so categories,
+   subcategories, types, brands and quantities keep their real distribution. Names get the product id
+   appended to stay unique and prices are moved by up to 20%.
+2. Runs Products.py on it in a separate process and records the wall time, rows per second, peak RSS
+   and the size of every output file.
+3. Loads the generated Turtle into the local store (catalog_store.py) and replays the query shapes of
+   the React app through SparqlService: header search (SPARQL and search index), category, subcategory
+   and type browsing, cart stock check, order placement and the dashboard order and inventory queries.
+
+The results are written to a JSON report. Given a previous report with --baseline, timings that got
+slower by more than --tolerance are listed and the script exits with status 1.
+
+    python benchmark.py --sizes 1000 100000 --report benchmark_report.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+# Catalog sizes benchmarked by default
+default_sizes = [1_000, 100_000, 1_000_000, 10_000_000]
+
+# Largest catalog loaded into the in-memory store for the query benchmarks
+query_max_rows = 100_000
+
+# Times every query is run, the first run is not timed
+query_repeats = 5
+
+# Orders placed before the dashboard queries run
+order_count = 20
+
+report_file = "benchmark_report.json"
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Query shapes of the React app, filled in with values of the benchmarked catalog
+frontend_queries = {
+    # Header.js
+    "search": """
+        PREFIX base: <http://www.semanticweb.org/My_Super/>
+        PREFIX gr: <http://purl.org/goodrelations/v1#>
+        SELECT ?instance ?name ?brand ?price ?discountPrice ?productId ?quantity ?stock ?available
+        WHERE {{
+          ?instance gr:name ?name ; base:hasBrand ?brand ; base:hasPrice ?price ;
+                    base:hasDiscountPrice ?discountPrice ; base:hasProductID ?productId ;
+                    base:hasQuantity ?quantity ; base:hasStock ?stock ; base:isAvailable ?available .
+          FILTER(CONTAINS(LCASE(?name), LCASE("{term}")))
+        }}""",
+    # Categories.js
+    "browse_categories": """
+        PREFIX gr: <http://purl.org/goodrelations/v1#>
+        PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+        SELECT DISTINCT ?category
+        WHERE {{
+          ?category rdfs:subClassOf gr:ProductOrService .
+          ?subcategory rdfs:subClassOf ?category .
+          ?subclass rdfs:subClassOf ?subcategory .
+        }}""",
+    # Subcategories.js
+    "browse_subcategories": """
+        PREFIX base: <http://www.semanticweb.org/My_Super/>
+        PREFIX gr: <http://purl.org/goodrelations/v1#>
+        PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+        SELECT DISTINCT ?subcategory
+        WHERE {{
+          ?category rdfs:subClassOf gr:ProductOrService .
+          ?subcategory rdfs:subClassOf ?category .
+          ?subclass rdfs:subClassOf ?subcategory .
+          FILTER(?category = base:{category})
+        }}""",
+    # Products.js
+    "browse_types": """
+        PREFIX base: <http://www.semanticweb.org/My_Super/>
+        PREFIX gr: <http://purl.org/goodrelations/v1#>
+        PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+        SELECT DISTINCT ?subclass
+        WHERE {{
+          ?subcategory rdfs:subClassOf gr:ProductOrService .
+          ?subclass rdfs:subClassOf ?subcategory .
+          FILTER(?subcategory = base:{subcategory})
+        }}""",
+    # ProductDetails.js
+    "browse_products": """
+        PREFIX base: <http://www.semanticweb.org/My_Super/>
+        PREFIX gr: <http://purl.org/goodrelations/v1#>
+        PREFIX pto: <http://www.productontology.org/id/>
+        SELECT ?instance ?name ?brand ?price ?discountPrice ?productId ?quantity ?stock ?available
+        WHERE {{
+          ?instance gr:name ?name ; base:hasBrand ?brand ; base:hasPrice ?price ;
+                    base:hasDiscountPrice ?discountPrice ; base:hasProductID ?productId ;
+                    base:hasQuantity ?quantity ; base:hasStock ?stock ; base:isAvailable ?available ;
+                    a pto:{type} .
+        }}""",
+    # Cart.js
+    "cart_stock_check": """
+        PREFIX base: <http://www.semanticweb.org/My_Super/>
+        SELECT ?product ?productId ?stock WHERE {{
+          VALUES ?productId {{ {ids} }}
+          ?product base:hasProductID ?productId ;
+                   base:hasStock ?stock .
+        }}""",
+    "cart_max_ids": """
+        PREFIX base: <http://www.semanticweb.org/My_Super/>
+        PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
+        SELECT (MAX(?orderNumber) AS ?maxOrderNumber) (MAX(?orderItemNumber) AS ?maxOrderItemNumber)
+        WHERE {{
+          ?order a base:Order ; base:hasOrderID ?orderID .
+          BIND(xsd:integer(SUBSTR(?orderID, 3)) AS ?orderNumber) .
+          ?orderItem a base:OrderItem ; base:hasOrderItemID ?orderItemID .
+          BIND(xsd:integer(SUBSTR(?orderItemID, 10)) AS ?orderItemNumber) .
+        }}""",
+    # Dashboard.js
+    "dashboard_orders": """
+        PREFIX base: <http://www.semanticweb.org/My_Super/>
+        SELECT ?orderID ?orderDate ?totalPrice
+        WHERE {{
+          ?order a base:Order ; base:hasOrderID ?orderID ;
+                 base:hasOrderDate ?orderDate ; base:hasTotalPrice ?totalPrice .
+        }}
+        ORDER BY DESC(?orderDate)""",
+    "dashboard_order_items": """
+        PREFIX base: <http://www.semanticweb.org/My_Super/>
+        PREFIX gr: <http://purl.org/goodrelations/v1#>
+        SELECT ?productName ?quantity
+        WHERE {{
+          ?order a base:Order ; base:hasOrderID "{order_id}" ; base:hasOrderItem ?orderItem .
+          ?orderItem base:hasProduct ?product ; base:hasOrderQuantity ?quantity .
+          ?product gr:name ?productName .
+        }}""",
+    "dashboard_inventory": """
+        PREFIX base: <http://www.semanticweb.org/My_Super/>
+        PREFIX gr: <http://purl.org/goodrelations/v1#>
+        SELECT DISTINCT ?productName ?stock
+        WHERE {{
+          ?product a ?type ; gr:name ?productName ; base:hasStock ?stock .
+        }}""",
+}
+
+# Order placement of Cart.js, one INSERT DATA for the order and one update per product for the stock
+order_update = """
+    PREFIX base: <http://www.semanticweb.org/My_Super/>
+    PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
+    INSERT DATA {{
+      base:Order{number} a base:Order ; base:hasOrderID "OR{number:02d}"^^xsd:string ;
+          base:hasOrderDate "{date}"^^xsd:dateTime ; base:hasTotalPrice "{total:.2f}"^^xsd:double ;
+          base:isFinalized "true"^^xsd:boolean ; base:hasNormalUser base:User1 .
+      {items}
+    }}"""
+order_item = """
+      base:Order{number} base:hasOrderItem base:OrderItem{item} .
+      base:OrderItem{item} a base:OrderItem ; base:hasOrderItemID "OrderItem{item}"^^xsd:string ;
+          base:hasOrderQuantity "1"^^xsd:integer ; base:hasOrderPrice "1.00"^^xsd:double ;
+          base:hasProduct <{product}> ."""
+stock_update = """;
+    DELETE {{ <{product}> base:hasStock ?oldStock . <{product}> base:isAvailable ?oldAvailable . }}
+    INSERT {{ <{product}> base:hasStock "9"^^xsd:integer . <{product}> base:isAvailable "true"^^xsd:boolean . }}
+    WHERE {{ <{product}> base:hasStock ?oldStock . <{product}> base:isAvailable ?oldAvailable . }}"""
+
+
+def write_synthetic_csv(path, rows, source_csv, seed=0, chunksize=100_000):
+    """Write a CSV file of rows products drawn from the products of source_csv."""
+    rng = np.random.default_rng(seed)
+    source = pd.read_csv(source_csv, dtype=str)
+    prices = source['price'].astype(float).to_numpy()
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        for start in range(0, rows, chunksize):
+            count = min(chunksize, rows - start)
+            picked = rng.integers(0, len(source), count)
+            chunk = source.iloc[picked].reset_index(drop=True)
+            ids = pd.Series(np.arange(start + 1, start + count + 1)).astype(str)
+            chunk['id'] = ids
+            chunk['name'] = chunk['name'] + " " + ids
+            chunk['price'] = np.round(prices[picked] * rng.uniform(0.8, 1.2, count), 2)
+            chunk.to_csv(f, index=False, header=start == 0)
+
+
+def _run_measured(command, cwd):
+    """Run a command and return its wall time in seconds and peak RSS in bytes."""
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    # wait4 returns the resource usage of this child only
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    if os.waitstatus_to_exitcode(status):
+        raise RuntimeError(f"{' '.join(command)} failed:\n{process.stderr.read().decode(errors='replace')}")
+    process.stderr.close()
+    return elapsed, usage.ru_maxrss * 1024
+
+
+def bench_generation(csv_path, workdir, rows, workers=1):
+    """Run Products.py on a CSV file and measure it."""
+    outputs = {
+        "turtle": os.path.join(workdir, "Products.ttl"),
+        "manifest": os.path.join(workdir, "Products.manifest.npz"),
+        "search_index": os.path.join(workdir, "Products.search.idx"),
+    }
+    command = [
+        sys.executable, os.path.join(script_dir, "Products.py"),
+        "--csv", csv_path, "--output", outputs["turtle"], "--shacl", os.path.join(workdir, "Shacl_shapes.ttl"),
+        "--manifest", outputs["manifest"], "--search-index", outputs["search_index"],
+        "--seed", "0", "--workers", str(workers),
+    ]
+    elapsed, peak_rss = _run_measured(command, workdir)
+    return {
+        "seconds": elapsed,
+        "rows_per_second": rows / elapsed if elapsed else None,
+        "peak_rss_bytes": peak_rss,
+        "csv_bytes": os.path.getsize(csv_path),
+        "output_bytes": {name: os.path.getsize(path) for name, path in outputs.items() if os.path.exists(path)},
+    }
+
+
+def _summary(timings):
+    """Summarize timings in milliseconds."""
+    timings = np.array(timings)
+    return {
+        "runs": len(timings),
+        "mean_ms": float(timings.mean()),
+        "median_ms": float(np.median(timings)),
+        "p95_ms": float(np.percentile(timings, 95)),
+        "min_ms": float(timings.min()),
+    }
+
+
+def _timed(function, repeats):
+    """Call function once to warm up, then repeats times, and return its result and timings."""
+    result = function()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+    return result, _summary(timings)
+
+
+def _result_rows(body):
+    """Count the bindings of a serialized SELECT result."""
+    return len(json.loads(body)["results"]["bindings"])
+
+
+def bench_queries(workdir, csv_path, rows, repeats=query_repeats, seed=0):
+    """Load the generated catalog into the local store and time the query shapes of the React app."""
+    from rdflib import URIRef
+
+    from catalog_store import catalog_namespaces, load_catalog
+    from search_index import SearchIndex
+    from sparql_service import SparqlService
+
+    rng = np.random.default_rng(seed)
+    sample = pd.read_csv(csv_path, dtype=str, nrows=min(rows, 10_000))
+    pick = lambda column: sample[column].iloc[rng.integers(0, len(sample))]
+    words = sample['name'].str.lower().str.findall(r"[^\W\d]{4,}").explode().dropna()
+
+    start = time.perf_counter()
+    graph = load_catalog([os.path.join(workdir, "Products.ttl"), os.path.join(workdir, "Shacl_shapes.ttl")])
+    load_seconds = time.perf_counter() - start
+    service = SparqlService(graph, search_index=SearchIndex(os.path.join(workdir, "Products.search.idx")))
+    results = {"load": {"seconds": load_seconds, "triples": len(graph)}, "queries": {}}
+
+    def run_query(name, text):
+        body, timing = _timed(lambda: service.query(text, "application/sparql-results+json")[1], repeats)
+        timing["rows"] = _result_rows(body)
+        results["queries"][name] = timing
+
+    term = words.iloc[rng.integers(0, len(words))] if len(words) else "milk"
+    run_query("search", frontend_queries["search"].format(term=term))
+    body, timing = _timed(lambda: service.search(term), repeats)
+    timing["rows"] = _result_rows(body)
+    results["queries"]["search_index"] = timing
+
+    run_query("browse_categories", frontend_queries["browse_categories"].format())
+    run_query("browse_subcategories", frontend_queries["browse_subcategories"].format(
+        category=pick('category').replace(" ", "_")))
+    run_query("browse_types", frontend_queries["browse_types"].format(subcategory=pick('subcategory').replace(" ", "_")))
+    run_query("browse_products", frontend_queries["browse_products"].format(type=pick('type').replace(" ", "_")))
+    ids = " ".join(f'"{product_id}"' for product_id in sample['id'].iloc[rng.integers(0, len(sample), 5)])
+    run_query("cart_stock_check", frontend_queries["cart_stock_check"].format(ids=ids))
+
+    # Place orders the way Cart.js does, then run the dashboard queries on them
+    products = [str(product) for product in graph.subjects(URIRef(catalog_namespaces[""] + "hasStock"))]
+    timings = []
+    for number in range(1, order_count + 1):
+        items = [products[i] for i in rng.integers(0, len(products), 3)]
+        text = order_update.format(
+            number=number, date=f"2026-01-{number % 28 + 1:02d}T10:00:00Z", total=3.0,
+            items="".join(order_item.format(number=number, item=number * 10 + i, product=product)
+                          for i, product in enumerate(items)),
+        ) + "".join(stock_update.format(product=product) for product in items)
+        start = time.perf_counter()
+        service.update(text)
+        timings.append((time.perf_counter() - start) * 1000)
+    results["queries"]["cart_place_order"] = _summary(timings)
+
+    run_query("cart_max_ids", frontend_queries["cart_max_ids"].format())
+    run_query("dashboard_orders", frontend_queries["dashboard_orders"].format())
+    run_query("dashboard_order_items", frontend_queries["dashboard_order_items"].format(order_id="OR01"))
+    run_query("dashboard_inventory", frontend_queries["dashboard_inventory"].format())
+    service.executor.shutdown()
+    service.search_index.close()
+    return results
+
+
+def compare(report, baseline, tolerance):
+    """Return the timings of report that are slower than in baseline by more than tolerance."""
+    def timings(runs):
+        found = {}
+        for run in runs:
+            found[(run["rows"], "generation")] = run["generation"]["seconds"]
+            for name, timing in run.get("queries", {}).get("queries", {}).items():
+                found[(run["rows"], name)] = timing["median_ms"] / 1000
+        return found
+
+    old = timings(baseline["runs"])
+    regressions = []
+    for key, seconds in timings(report["runs"]).items():
+        if key in old and old[key] and seconds > old[key] * (1 + tolerance):
+            regressions.append({"rows": key[0], "benchmark": key[1], "baseline_seconds": old[key], "seconds": seconds})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark Products.py and the frontend queries on synthetic catalogs.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=default_sizes, help="catalog sizes in rows")
+    parser.add_argument("--source", default=os.path.join(script_dir, "Products.csv"), help="CSV the rows are drawn from")
+    parser.add_argument("--workers", type=int, default=1, help="--workers passed to Products.py")
+    parser.add_argument("--query-max-rows", type=int, default=query_max_rows,
+                        help="largest catalog the query benchmarks are run on")
+    parser.add_argument("--repeats", type=int, default=query_repeats, help="timed runs of every query")
+    parser.add_argument("--workdir", default=None, help="keep the generated files in this folder")
+    parser.add_argument("--report", default=report_file, help="output JSON report")
+    parser.add_argument("--baseline", default=None, help="previous report to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    args = parser.parse_args(argv)
+
+    report = {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "pandas": pd.__version__,
+            "numpy": np.__version__,
+        },
+        "runs": [],
+    }
+    workdir = args.workdir or tempfile.mkdtemp(prefix="products-benchmark-")
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        for rows in args.sizes:
+            size_dir = os.path.join(workdir, str(rows))
+            os.makedirs(size_dir, exist_ok=True)
+            csv_path = os.path.join(size_dir, "Products.csv")
+            print(f"{rows} rows: writing synthetic CSV")
+            write_synthetic_csv(csv_path, rows, args.source)
+            print(f"{rows} rows: running Products.py")
+            run = {"rows": rows, "generation": bench_generation(csv_path, size_dir, rows, args.workers)}
+            if rows <= args.query_max_rows:
+                print(f"{rows} rows: replaying frontend queries")
+                run["queries"] = bench_queries(size_dir, csv_path, rows, args.repeats)
+            report["runs"].append(run)
+            # Keep the report up to date, large sizes take long
+            with open(args.report, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+            if not args.workdir:
+                shutil.rmtree(size_dir)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report["peak_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            report["regressions"] = compare(report, json.load(f), args.tolerance)
+    with open(args.report, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Benchmark report saved as {args.report}")
+
+    for regression in report.get("regressions", []):
+        print(f"Regression: {regression['benchmark']} at {regression['rows']} rows took "
+              f"{regression['seconds'] * 1000:.1f} ms instead of {regression['baseline_seconds'] * 1000:.1f} ms")
+    if report.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
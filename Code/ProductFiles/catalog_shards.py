@@ -0,0 +1,882 @@
+"""
+Category-sharded serving of the catalog: the products are split by category between worker processes,
+each one holding its own store, indexes and query cache, and a router answers the HTTP requests.
+
+One SparqlService evaluates one query at a time, on one core. With --shards N, sparql_service.py starts
+N shard processes and a replica instead:
+
+- a product is a subject with :hasProductID. Every category (a direct subclass of gr:ProductOrService)
+  belongs to one shard, the biggest categories first to the shard with the fewest products, and a
+  shard keeps the products of its categories only. A product belongs to the category of :inCategory,
+  or else the one its classes are subclasses of, like pto:Milk under :Milk under :Dairy_Products. A
+  product of a category unknown at startup, or of none, goes to the shard picked by a hash of it.
+- everything else (the class hierarchy, the shapes, users and orders) is in every shard.
+- the replica keeps the whole catalog and answers the queries that cannot be split between shards.
+
+The router knows the predicates and classes of the products of every shard and routes every query:
+
+- a query that reads no product, like the categories of Categories.js, goes to the least busy worker.
+- a query whose products all have a class or category of one shard, like the products of one type of
+  ProductDetails.js, goes to that shard.
+- a query whose products are each found in one shard, like the search of Header.js or the inventory
+  of Dashboard.js, is scattered: every shard evaluates the graph pattern and the router evaluates
+  the solution modifiers, ORDER BY, LIMIT, DISTINCT, GROUP BY and aggregates, over their rows. LIMIT
+  under ORDER BY is applied by the shards too, and COUNT, MAX, MIN and SAMPLE without GROUP BY are
+  computed per shard and combined by the router.
+- any other query, joining two products or with a product pattern inside OPTIONAL or EXISTS of a
+  pattern that is not, goes to the replica. explain=true shows the route of a query.
+
+Search fans out to every shard and the results are merged in the order of the search index, the
+products written since it was built last, then cut to the limit. Updates and uploaded data are applied in two phases: every worker applies and validates
+the change, and it is committed on all of them only if all of them accepted it and agree on the shard
+of every product it touched, otherwise it is rolled back on all of them. A product cannot move to
+another shard: changing its category while sharded is rejected.
+
+Logins are answered by the router, from a graph of the user triples of the replica kept up to date with
+every committed change. Accounts and rehashed passwords are written like any other update.
+
+Orders, bulk imports and the dashboard change or read the whole catalog at once and are only served
+without --shards.
+"""
+
+import asyncio
+import copyreg
+import itertools
+import json
+import multiprocessing
+import pickle
+import signal
+import zlib
+from collections import Counter, OrderedDict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from rdflib import RDF, RDFS, BNode, Graph, URIRef, Variable
+from rdflib.plugins.sparql.operators import TrueFilter
+from rdflib.plugins.sparql.parserutils import CompValue, Expr
+from rdflib.plugins.sparql.processor import prepareQuery, prepareUpdate
+from rdflib.plugins.sparql.sparql import Prologue, Query
+
+from auth_service import AuthService, is_user_triple, max_sessions, session_seconds, user_triples
+from catalog_store import catalog_namespaces, load_catalog, normalize_values
+from metrics import memory_families, prometheus_text
+from order_service import HAS_PRODUCT_ID
+from predicate_statistics import PredicateStatistics
+from query_cache import QueryCache, max_bytes, max_entries, triple_keys, update_keys, write_keys
+from search_index import SearchIndex
+from shacl_validator import ValidationError
+from sparql_service import (AuthEndpoints, HTTPError, HTTPService, Response, SparqlService, add_prefixes,
+                            data_formats, metrics_prefix, parse_data, query_text, repository_name, search_fields,
+                            search_params, serialize_result)
+
+base = catalog_namespaces[""]
+PRODUCT_OR_SERVICE = URIRef(catalog_namespaces["gr"] + "ProductOrService")
+IN_CATEGORY = URIRef(base + "inCategory")
+IN_SUBCATEGORY = URIRef(base + "inSubcategory")
+
+# Predicates whose object restricts a query to the shards with products having it
+class_predicates = (RDF.type, IN_CATEGORY, IN_SUBCATEGORY)
+
+# Most parsed queries and their routes kept by the router
+max_routes = 1024
+
+# Seconds a worker process is given to exit once its pipe is closed
+exit_timeout = 10
+
+# Nodes of the algebra the router can evaluate over the rows of the shards
+_merge_nodes = {"SelectQuery", "AskQuery", "ConstructQuery", "Project", "Distinct", "Reduced", "Slice", "OrderBy",
+                "Extend", "Filter", "Group", "AggregateJoin"}
+
+# Aggregates computed per shard, and the aggregate of the router combining them
+_partial_aggregates = {
+    "Aggregate_Count": "Aggregate_Sum",
+    "Aggregate_Max": "Aggregate_Max",
+    "Aggregate_Min": "Aggregate_Min",
+    "Aggregate_Sample": "Aggregate_Sample",
+}
+
+# A graph pattern whose solutions are each found in one shard, the one of the product anchor is bound to,
+# and only in the shards of shards
+_Split = namedtuple("_Split", "anchor shards")
+
+
+def _comp_value(name, function, items, attributes):
+    value = CompValue(name) if function is None else Expr(name, function)
+    OrderedDict.update(value, items)
+    vars(value).update(attributes)
+    return value
+
+
+def _true_filter():
+    return TrueFilter
+
+
+def _reduce_comp_value(value):
+    if value is TrueFilter:
+        # The filter of an OPTIONAL without one evaluates a lambda
+        return _true_filter, ()
+    # CompValue answers every missing attribute with None, which pickle takes for a __setstate__ method, and
+    # EXISTS keeps its translated graph pattern in an attribute, so the algebra is pickled by hand
+    attributes = dict(vars(value))
+    name = attributes.pop("name")
+    function = attributes.pop("_evalfn", None)
+    attributes.pop("ctx", None)
+    return _comp_value, (name, function and function.__func__, list(OrderedDict.items(value)), attributes)
+
+
+copyreg.pickle(CompValue, _reduce_comp_value)
+copyreg.pickle(Expr, _reduce_comp_value)
+
+
+def _is_variable(term):
+    return isinstance(term, (Variable, BNode))
+
+
+def category_of(graph, cls):
+    """Return the category a class is under, the subclass of gr:ProductOrService it descends from, or None."""
+    seen = set()
+    while cls is not None and cls not in seen:
+        seen.add(cls)
+        parents = sorted(graph.objects(cls, RDFS.subClassOf))
+        if PRODUCT_OR_SERVICE in parents:
+            return cls
+        cls = parents[0] if parents else None
+    return None
+
+
+def product_category(graph, product):
+    """Return the category of a product: its :inCategory, else the category of its classes, or None."""
+    categories = sorted(graph.objects(product, IN_CATEGORY))
+    if not categories:
+        categories = sorted(filter(None, (category_of(graph, cls) for cls in graph.objects(product, RDF.type))))
+    return categories[0] if categories else None
+
+
+class ShardLayout:
+    """The shard of every category, and so of every product."""
+
+    def __init__(self, shards, categories):
+        self.shards = shards
+        # category -> shard
+        self.categories = categories
+
+    @classmethod
+    def of(cls, graph, shards):
+        """Assign the categories of a catalog to shards, the biggest first to the shard with the fewest products."""
+        counts = Counter(product_category(graph, product) for product in set(graph.subjects(HAS_PRODUCT_ID, None)))
+        counts.pop(None, None)
+        loads = [0] * shards
+        categories = {}
+        for category, count in sorted(counts.items(), key=lambda item: (-item[1], item[0])):
+            shard = loads.index(min(loads))
+            categories[category] = shard
+            loads[shard] += count
+        return cls(shards, categories)
+
+    def shard_of(self, graph, product):
+        category = product_category(graph, product)
+        shard = self.categories.get(category)
+        if shard is None:
+            key = category if category is not None else product
+            shard = zlib.crc32(str(key).encode("utf-8")) % self.shards
+        return shard
+
+
+def keep_shard(graph, layout, shard):
+    """Remove the products of the other shards from a catalog graph."""
+    for product in set(graph.subjects(HAS_PRODUCT_ID, None)):
+        if layout.shard_of(graph, product) != shard:
+            graph.remove((product, None, None))
+
+
+class ShardError(Exception):
+    """A request a worker process failed. invalid is set if the request broke a shape or moved a product."""
+
+    def __init__(self, message, invalid=False):
+        super().__init__(message)
+        self.invalid = invalid
+
+
+class ShardWorker:
+    """The catalog of a worker process, answering the requests of the router sent over a pipe.
+
+    shard is the index of the shard, None for the replica, which keeps every product.
+    """
+
+    def __init__(self, service, layout, shard=None):
+        self.service = service
+        self.graph = service.graph
+        self.layout = layout
+        self.shard = shard
+        # Journal and cache keys of the change prepared and not yet committed or aborted
+        self.pending = None
+
+    def run(self, connection):
+        """Answer the requests of the router until it closes the pipe."""
+        connection.send(("ok", self.describe()))
+        while True:
+            try:
+                operation, args = connection.recv()
+            except EOFError:
+                break
+            try:
+                reply = ("ok", getattr(self, operation)(*args))
+            except (ValidationError, ShardError) as error:
+                reply = ("invalid", str(error))
+            except Exception as error:
+                reply = ("error", str(error))
+            connection.send(reply)
+
+    def describe(self, triples=None):
+        """Return the predicates and classes of the products in triples, and of the other subjects."""
+        graph = self.graph
+        products = {}
+        description = {"products": set(), "shared": set(), "classes": set(), "shared_classes": set()}
+        for s, p, o in graph if triples is None else triples:
+            is_product = products.get(s)
+            if is_product is None:
+                is_product = products[s] = (s, HAS_PRODUCT_ID, None) in graph
+            if is_product:
+                description["products"].add(p)
+                if p in class_predicates:
+                    description["classes"].add((p, o))
+            else:
+                description["shared"].add(p)
+                if p == RDF.type:
+                    description["shared_classes"].add(o)
+        return description
+
+    def query(self, text, accept):
+        """Evaluate a whole query, or answer it from the query cache."""
+        cache = self.service.cache
+        key = cache.key(text, accept)
+        cached = cache.get(key)
+        return cached if cached is not None else self.service.query(text, accept, key)
+
+    def explain(self, text):
+        return self.service.explain(text)
+
+    def rows(self, part):
+        """Evaluate a pickled graph pattern scattered by the router and return its solutions."""
+        query = Query(Prologue(), CompValue("SelectQuery", p=pickle.loads(part), PV=[], datasetClause=None))
+        if self.service.planner is not None:
+            query = self.service.planner.plan(query)
+        return [{var: value for var, value in row.items() if value is not None}
+                for row in self.graph.query(query).bindings]
+
+    def search(self, text, mode, limit):
+        return json.loads(self.service.search(text, mode, limit))["results"]["bindings"]
+
+    def users(self):
+        return user_triples(self.graph)
+
+    def prepare(self, kind, payload):
+        """Apply and validate an update (its text) or data (its triples) without committing it.
+
+        Return the shard of every product the change touched, the replica returns none.
+        """
+        graph = self.graph
+        store = graph.store
+        store.journal = journal = []
+        try:
+            if kind == "update":
+                prepared = prepareUpdate(add_prefixes(payload))
+                normalize_values(prepared.algebra)
+                graph.update(prepared)
+                keys = update_keys(prepared.algebra)
+            else:
+                for triple in payload:
+                    graph.add(triple)
+                keys = None
+            self.service.validate(journal)
+            owners = self._owners(journal) if self.shard is not None else {}
+        except Exception:
+            store.rollback(journal)
+            store.journal = None
+            raise
+        self.pending = journal, keys
+        return owners
+
+    def _owners(self, journal):
+        graph = self.graph
+        terms = graph.store.terms
+        added = {(terms[s], terms[p], terms[o]) for is_added, s, p, o in journal if is_added}
+        owners = {}
+        for subject in {terms[s] for _, s, _, _ in journal}:
+            if (subject, HAS_PRODUCT_ID, None) not in graph:
+                continue
+            shard = owners[subject] = self.layout.shard_of(graph, subject)
+            # A product of this shard before the change keeps triples the change did not add
+            if shard != self.shard and any(triple not in added for triple in graph.triples((subject, None, None))):
+                raise ShardError(f"{subject.n3()} cannot move from shard {self.shard} to shard {shard}: "
+                                 "the category of a product cannot change while the catalog is sharded")
+        return owners
+
+    def commit(self, owners):
+        """Commit the prepared change, without the products it touched that belong to other shards.
+
+        Return the description of the triples it added, and the (added, s, p, o) changes of users.
+        """
+        journal, keys = self.pending
+        self.pending = None
+        graph = self.graph
+        store = graph.store
+        try:
+            if self.shard is not None:
+                for subject, shard in owners.items():
+                    if shard != self.shard:
+                        graph.remove((subject, None, None))
+        finally:
+            store.journal = None
+        terms = store.terms
+        changes = [(added, terms[s], terms[p], terms[o]) for added, s, p, o in journal]
+        service = self.service
+        service.dashboard.apply(changes)
+        if service.search_delta is not None:
+            service.search_delta.apply(changes)
+        if service.planner is not None:
+            service.planner.apply(changes)
+        if keys is None:
+            keys = write_keys(triple_keys([(s, p, o) for _, s, p, o in changes]))
+        service.cache.invalidate(keys)
+        description = self.describe([(s, p, o) for added, s, p, o in changes if added and (s, p, o) in graph])
+        return description, [change for change in changes if is_user_triple(change[1:])]
+
+    def abort(self):
+        """Roll back the prepared change."""
+        journal, _ = self.pending
+        self.pending = None
+        store = self.graph.store
+        store.rollback(journal)
+        store.journal = None
+
+    def stats(self):
+        return {"triples": len(self.graph), "cache": self.service.cache.stats()}
+
+
+def run_worker(connection, shard, shards, data, options):
+    """Entry point of a worker process: load the catalog, keep the products of the shard and serve the router."""
+    # Ctrl+C reaches every process of the terminal, the router stops the workers by closing their pipes
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    graph = load_catalog(data)
+    layout = ShardLayout.of(graph, shards)
+    if shard is not None:
+        keep_shard(graph, layout, shard)
+    search_index = SearchIndex(options["search_index"]) if options["search_index"] else None
+    statistics = PredicateStatistics.load(options["statistics"]) if options["statistics"] else None
+    cache = QueryCache(options["cache_entries"], options["cache_bytes"])
+    service = SparqlService(graph, search_index=search_index, cache=cache, validation=options["validation"],
+                            statistics=statistics, plan=options["plan"])
+    ShardWorker(service, layout, shard).run(connection)
+
+
+class WorkerClient:
+    """A worker process and the pipe to it. Requests are sent by one thread, so they never interleave."""
+
+    def __init__(self, context, name, shard, shards, data, options):
+        self.name = name
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=run_worker, args=(child, shard, shards, data, options),
+                                       name=f"catalog-{name}", daemon=True)
+        self.process.start()
+        child.close()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"shard-{name}")
+        # Requests sent or waiting to be sent, and all the requests sent
+        self.pending = 0
+        self.requests = 0
+
+    def ready(self):
+        """Wait for the worker to load its catalog and return its description."""
+        return self._reply()
+
+    def _reply(self):
+        try:
+            status, value = self.connection.recv()
+        except EOFError:
+            raise ShardError(f"Worker {self.name} exited")
+        if status != "ok":
+            raise ShardError(value, status == "invalid")
+        return value
+
+    def call(self, operation, *args):
+        self.connection.send((operation, args))
+        return self._reply()
+
+    async def request(self, operation, *args):
+        """Send a request to the worker and wait for its answer."""
+        self.pending += 1
+        self.requests += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, self.call, operation, *args)
+        finally:
+            self.pending -= 1
+
+    def transaction(self, kind, payload, prepared, decision):
+        """Prepare a change and set the prepared future, then commit or abort it as the decision future says.
+
+        The worker answers nothing else in between. The decision is the shard of every product, or None to
+        abort. Return what the commit returns, or None.
+        """
+        try:
+            prepared.set_result(self.call("prepare", kind, payload))
+        except Exception as error:
+            prepared.set_exception(error)
+            decision.result()
+            return None
+        owners = decision.result()
+        if owners is None:
+            self.call("abort")
+            return None
+        return self.call("commit", owners)
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+        self.connection.close()
+        self.process.join(exit_timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+def _exists_patterns(expression):
+    """Yield the graph patterns of the EXISTS and NOT EXISTS of an expression."""
+    if isinstance(expression, CompValue):
+        if expression.name in ("Builtin_EXISTS", "Builtin_NOTEXISTS"):
+            # The translated pattern is an attribute, the key keeps the parsed one
+            yield expression.graph
+            return
+        values = OrderedDict.values(expression)
+    elif isinstance(expression, (list, tuple)):
+        values = expression
+    else:
+        return
+    for value in values:
+        yield from _exists_patterns(value)
+
+
+def _expressions(node):
+    """Return the values of an algebra node that are not graph patterns under it."""
+    return [value for key, value in OrderedDict.items(node) if key not in ("p", "p1", "p2")]
+
+
+def _replace(node, depth, replacement):
+    """Return a copy of the chain of nodes depth times .p under node, with the last one replaced."""
+    if depth == 0:
+        return replacement
+    copy = CompValue(node.name)
+    OrderedDict.update(copy, OrderedDict.items(node))
+    copy["p"] = _replace(OrderedDict.__getitem__(node, "p"), depth - 1, replacement)
+    return copy
+
+
+class Route:
+    """Where a query is evaluated.
+
+    kind is "any" (any worker, the query reads no product of a shard), "shard" (the one shard of shards),
+    "replica" or "scatter": every shard of shards evaluates part, and the router evaluates the query with
+    the node depth times .p under its root replaced by their rows, aggregated by aggregates if the shards
+    computed partial aggregates.
+    """
+
+    def __init__(self, kind, shards=(), part=None, depth=0, aggregates=None):
+        self.kind = kind
+        self.shards = shards
+        # Pickled once, sent with every scatter
+        self.part = pickle.dumps(part) if part is not None else None
+        self.depth = depth
+        self.aggregates = aggregates
+
+    def query(self, prepared, rows):
+        """Return the query the router evaluates over the rows of the shards."""
+        values = CompValue("ToMultiSet", p=CompValue("values", res=rows))
+        if self.aggregates is not None:
+            values = CompValue("AggregateJoin", A=self.aggregates, p=CompValue("Group", p=values))
+        return Query(prepared.prologue, _replace(prepared.algebra, self.depth, values))
+
+    def __str__(self):
+        if self.kind == "any":
+            return "any worker: the query reads no product of a shard"
+        if self.kind == "shard":
+            return f"shard {self.shards[0]}: every product the query reads is in it"
+        if self.kind == "replica":
+            return "replica: the query cannot be split between the shards"
+        merged = "partial aggregates combined" if self.aggregates is not None else "rows merged"
+        return f"scattered to shards {', '.join(map(str, self.shards))}, {merged} by the router"
+
+
+class ShardCatalog:
+    """What the router knows of the products of the shards, and the routes of queries it derives from it.
+
+    The sets only grow: a predicate or class that is gone from a shard is still routed to it.
+    """
+
+    def __init__(self, shards):
+        self.shards = shards
+        # Predicates of products, and of the other subjects
+        self.product_predicates = set()
+        self.shared_predicates = set()
+        # (predicate, object) of class_predicates -> shards with products having it
+        self.classes = {}
+        # Classes of the other subjects
+        self.shared_classes = set()
+
+    def learn(self, shard, description):
+        self.product_predicates |= description["products"]
+        self.shared_predicates |= description["shared"]
+        self.shared_classes |= description["shared_classes"]
+        for key in description["classes"]:
+            self.classes.setdefault(key, set()).add(shard)
+
+    def _may_be_product(self, triple):
+        _, p, o = triple
+        if _is_variable(p):
+            return True
+        if p == RDF.type and not _is_variable(o):
+            return (p, o) in self.classes
+        return p in self.product_predicates
+
+    def _only_product(self, triple):
+        _, p, o = triple
+        if _is_variable(p):
+            return False
+        if p == RDF.type:
+            return not _is_variable(o) and (p, o) in self.classes and o not in self.shared_classes
+        return p in self.product_predicates and p not in self.shared_predicates
+
+    def _pattern(self, triples):
+        products = [triple for triple in triples if self._may_be_product(triple)]
+        if not products:
+            return "shared"
+        anchors = {s for s, _, _ in products}
+        # The patterns that may match a product must be about one subject that is surely a product
+        if len(anchors) != 1 or not any(map(self._only_product, products)):
+            return None
+        shards = frozenset(range(self.shards))
+        for _, p, o in products:
+            if p in class_predicates and not _is_variable(o):
+                shards &= self.classes.get((p, o), frozenset())
+        return _Split(anchors.pop(), shards)
+
+    @staticmethod
+    def _join(left, right):
+        if left is None or right is None:
+            return None
+        if left == "shared":
+            return right
+        if right == "shared":
+            return left
+        if left.anchor == right.anchor:
+            return _Split(left.anchor, left.shards & right.shards)
+        return None
+
+    def _check_exists(self, split, node):
+        """Return split if every EXISTS of the expressions of node can be evaluated where split is."""
+        for pattern in _exists_patterns(_expressions(node)):
+            inner = self.classify(pattern)
+            if inner != "shared" and not (isinstance(split, _Split) and isinstance(inner, _Split)
+                                          and inner.anchor == split.anchor):
+                return None
+        return split
+
+    def classify(self, node):
+        """Return "shared" for a graph pattern with the same solutions in every shard, a _Split for one whose
+        solutions are each found in one shard, and None for one that cannot be split."""
+        name = node.name
+        if name == "BGP":
+            return self._pattern(node.triples)
+        if name in ("Join", "LeftJoin", "Minus", "Union"):
+            left, right = self.classify(node.p1), self.classify(node.p2)
+            if name == "Join":
+                return self._join(left, right)
+            if name == "Union":
+                if left == right == "shared":
+                    return "shared"
+                if isinstance(left, _Split) and isinstance(right, _Split):
+                    # Two anchors make a new one no other pattern has
+                    anchor = left.anchor if left.anchor == right.anchor else object()
+                    return _Split(anchor, left.shards | right.shards)
+                return None
+            # The solutions come from p1, p2 only extends or removes them
+            if self._join(left, right) is None or (left == "shared" and right != "shared"):
+                return None
+            return self._check_exists(left, node)
+        if name in ("Filter", "Extend"):
+            return self._check_exists(self.classify(node.p), node)
+        if name == "ToMultiSet" and node.p.name == "values":
+            return "shared"
+        if name in ("ToMultiSet", "Project"):
+            split = self.classify(node.p)
+            if name == "Project" and isinstance(split, _Split) and split.anchor not in node.PV:
+                return None
+            return split
+        # Modifiers, aggregates and anything else: only if every pattern under them is shared
+        parts = [value for key, value in OrderedDict.items(node) if key in ("p", "p1", "p2")]
+        if not parts or any(self.classify(part) != "shared" for part in parts):
+            return None
+        return self._check_exists("shared", node)
+
+    def route(self, algebra):
+        """Return the Route of the algebra of a prepared query."""
+        if algebra.name not in ("SelectQuery", "AskQuery", "ConstructQuery"):
+            return Route("replica")
+        split = self.classify(algebra.p)
+        if split == "shared":
+            return Route("any")
+        # Look for the pattern to scatter under nodes the router can evaluate
+        chain = [algebra]
+        part = algebra.p
+        while split is None:
+            if part.name not in _merge_nodes or any(_exists_patterns(_expressions(part))):
+                return Route("replica")
+            chain.append(part)
+            part = part.p
+            split = self.classify(part)
+        if not isinstance(split, _Split):
+            return Route("replica")
+        shards = sorted(split.shards)
+        if len(shards) <= 1:
+            return Route("shard", shards) if shards else Route("any")
+        depth = len(chain)
+        parent = chain[-1]
+        if parent.name == "Group" and parent.expr is None and chain[-2].name == "AggregateJoin" and all(
+                aggregate.name in _partial_aggregates
+                and not (aggregate.name == "Aggregate_Count" and aggregate.distinct) for aggregate in chain[-2].A):
+            aggregates = [CompValue(_partial_aggregates[aggregate.name], vars=aggregate.res, res=aggregate.res,
+                                    distinct=[]) for aggregate in chain[-2].A]
+            return Route("scatter", shards, chain[-2], depth - 2, aggregates)
+        # LIMIT of the rows in order of the query, each shard sends the first ones of its rows
+        for index, node in enumerate(chain):
+            if node.name == "Slice" and node.length is not None and all(
+                    above.name in ("Project", "OrderBy") for above in chain[index + 1:]):
+                order = next((above for above in chain[index + 1:] if above.name == "OrderBy"), None)
+                if order is not None:
+                    part = CompValue("OrderBy", p=part, expr=order.expr)
+                part = CompValue("Slice", p=part, start=0, length=node.start + node.length)
+                break
+        else:
+            if algebra.name == "AskQuery" and depth == 1:
+                part = CompValue("Slice", p=part, start=0, length=1)
+        return Route("scatter", shards, part, depth)
+
+
+class ShardedService(HTTPService, AuthEndpoints):
+    """Serves the queries, updates, search and logins of a SparqlService from shard processes and a replica."""
+
+    def __init__(self, data, shards, repository=repository_name, search_index=None, statistics=None,
+                 validation="reject", cache_entries=max_entries, cache_bytes=max_bytes, plan=True,
+                 max_sessions=max_sessions, session_seconds=session_seconds):
+        super().__init__()
+        # One thread: parses and merges, and owns self.plans and self.catalog
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="router")
+        options = {"search_index": search_index, "statistics": statistics, "validation": validation,
+                   "cache_entries": cache_entries, "cache_bytes": cache_bytes, "plan": plan}
+        # Workers are started, not forked, so they do not inherit the threads of the router
+        context = multiprocessing.get_context("spawn")
+        self.shards = [WorkerClient(context, str(shard), shard, shards, data, options) for shard in range(shards)]
+        self.replica = WorkerClient(context, "replica", None, shards, data, options)
+        self.workers = [*self.shards, self.replica]
+        self.catalog = ShardCatalog(shards)
+        try:
+            for shard, client in enumerate(self.shards):
+                self.catalog.learn(shard, client.ready())
+            self.replica.ready()
+            # The users of the logins, only written by write() on the event loop
+            self.users = Graph()
+            for triple in self.replica.call("users"):
+                self.users.add(triple)
+        except Exception:
+            self.close()
+            raise
+        self.search_index = SearchIndex(search_index) if search_index else None
+        # query text -> (prepared query, Route), the most recently used last
+        self.plans = OrderedDict()
+        self.routed = Counter()
+        self.write_lock = asyncio.Lock()
+        self.auth = AuthService(self.users, self.write_change, max_sessions, session_seconds)
+        repository_path = f"/repositories/{repository}"
+        self.route("GET", repository_path, self.handle_query)
+        self.route("POST", repository_path, self.handle_query)
+        self.route("POST", repository_path + "/statements", self.handle_update)
+        self.route_auth(repository_path)
+        self.route("GET", "/metrics", self.handle_metrics)
+        if self.search_index is not None:
+            self.route("GET", repository_path + "/search", self.handle_search)
+
+    async def run(self, function, *args):
+        """Run a function on the router thread."""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    def plan(self, text):
+        """Parse a query and return it with its Route."""
+        entry = self.plans.get(text)
+        if entry is not None:
+            self.plans.move_to_end(text)
+            return entry
+        prepared = prepareQuery(add_prefixes(text))
+        normalize_values(prepared.algebra)
+        entry = self.plans[text] = prepared, self.catalog.route(prepared.algebra)
+        if len(self.plans) > max_routes:
+            self.plans.popitem(last=False)
+        return entry
+
+    def worker(self, route):
+        if route.kind == "shard":
+            return self.shards[route.shards[0]]
+        if route.kind == "replica":
+            return self.replica
+        return min(self.workers, key=lambda client: client.pending)
+
+    def merge(self, prepared, route, rows, accept):
+        """Evaluate a scattered query over the rows of the shards and return its media type and serialized result."""
+        return serialize_result(Graph().query(route.query(prepared, rows)), accept)
+
+    def merge_search(self, text, mode, limit, results):
+        """Merge the search results of the shards in the order of the search index, products it lacks last."""
+        rows = self.search_index.search(text.strip().lower(), mode)
+        positions = {base + local: position for position, local in enumerate(self.search_index.instances(rows))}
+        bindings = sorted(itertools.chain.from_iterable(results),
+                          key=lambda binding: positions.get(binding["instance"]["value"], len(positions)))
+        if limit is not None:
+            del bindings[limit:]
+        result = {"head": {"vars": ["instance", *search_fields]}, "results": {"bindings": bindings}}
+        return json.dumps(result).encode("utf-8")
+
+    def learn(self, descriptions):
+        for shard, description in enumerate(descriptions):
+            self.catalog.learn(shard, description)
+        self.plans.clear()
+
+    async def query(self, text, accept=""):
+        """Route or scatter a query and return its media type and serialized result."""
+        prepared, route = await self.run(self.plan, text)
+        self.routed[route.kind] += 1
+        if route.kind != "scatter":
+            return await self.worker(route).request("query", text, accept)
+        rows = await asyncio.gather(*(self.shards[shard].request("rows", route.part) for shard in route.shards))
+        return await self.run(self.merge, prepared, route, list(itertools.chain.from_iterable(rows)), accept)
+
+    async def explain(self, text):
+        """Return the route of a query and its plan on the replica as text."""
+        _, route = await self.run(self.plan, text)
+        return f"Route: {route}\n" + await self.replica.request("explain", text)
+
+    async def write(self, kind, payload):
+        """Apply an update or data on every worker, committed on all of them or rolled back on all of them."""
+        async with self.write_lock:
+            await self._write(kind, payload)
+
+    async def _write(self, kind, payload):
+        loop = asyncio.get_running_loop()
+        decision = Future()
+        prepared = [Future() for _ in self.workers]
+        done = []
+        for client, future in zip(self.workers, prepared):
+            client.requests += 1
+            done.append(loop.run_in_executor(client.executor, client.transaction, kind, payload, future, decision))
+        owners = None
+        try:
+            votes = await asyncio.gather(*map(asyncio.wrap_future, prepared), return_exceptions=True)
+            error = next((vote for vote in votes if isinstance(vote, BaseException)), None)
+            if error is None:
+                owners = {}
+                for vote in votes:
+                    for subject, shard in vote.items():
+                        if owners.setdefault(subject, shard) != shard:
+                            error = ShardError(f"Shards {owners[subject]} and {shard} both claim {subject.n3()}",
+                                               invalid=True)
+                if error is not None:
+                    owners = None
+        finally:
+            decision.set_result(owners)
+        committed = await asyncio.gather(*done)
+        if error is not None:
+            raise error
+        # Every worker has the users, the replica reports their changes
+        users = committed[-1][1]
+        for added, s, p, o in users:
+            (self.users.add if added else self.users.remove)((s, p, o))
+        self.auth.apply(users)
+        await self.run(self.learn, [description for description, _ in committed[:len(self.shards)]])
+
+    async def write_change(self, changes):
+        """Write the (added, removed) triples returned by changes() as one update, for the logins."""
+        async with self.write_lock:
+            added, removed = changes()
+            operations = []
+            for name, triples in [("DELETE", removed), ("INSERT", added)]:
+                if triples:
+                    data = " ".join(f"{s.n3()} {p.n3()} {o.n3()} ." for s, p, o in triples)
+                    operations.append(f"{name} DATA {{ {data} }}")
+            if operations:
+                try:
+                    await self._write("update", " ;\n".join(operations))
+                except ShardError as error:
+                    if error.invalid:
+                        raise HTTPError(400, str(error))
+                    raise
+
+    async def handle_query(self, request):
+        text = query_text(request)
+        try:
+            if request.param("explain") in ("true", "1"):
+                return Response(200, await self.explain(text), "text/plain;charset=UTF-8")
+            media_type, body = await self.query(text, request.headers.get("accept", ""))
+        except ShardError as error:
+            raise HTTPError(400, str(error) if error.invalid else f"MALFORMED QUERY: {error}")
+        except Exception as error:
+            raise HTTPError(400, f"MALFORMED QUERY: {error}")
+        return Response(200, body, f"{media_type};charset=UTF-8")
+
+    async def handle_update(self, request):
+        if request.content_type == "application/sparql-update":
+            kind, payload = "update", request.body.decode("utf-8")
+        elif request.content_type == "application/x-www-form-urlencoded":
+            kind, payload = "update", request.param("update")
+        elif request.content_type in data_formats:
+            try:
+                payload = await self.run(parse_data, request.body, data_formats[request.content_type])
+            except Exception as error:
+                raise HTTPError(400, f"MALFORMED DATA: {error}")
+            kind = "data"
+        else:
+            raise HTTPError(415, f"Unsupported content type: {request.content_type}")
+        if not payload:
+            if kind == "data":
+                return Response(204)
+            raise HTTPError(400, "Missing parameter: update")
+        try:
+            await self.write(kind, payload)
+        except ShardError as error:
+            if error.invalid:
+                raise HTTPError(400, str(error))
+            raise HTTPError(400, f"MALFORMED {'QUERY' if kind == 'update' else 'DATA'}: {error}")
+        return Response(204)
+
+    async def handle_search(self, request):
+        text, mode, limit = search_params(request)
+        results = await asyncio.gather(*(client.request("search", text, mode, limit) for client in self.shards))
+        body = await self.run(self.merge_search, text, mode, limit, results)
+        return Response(200, body, "application/sparql-results+json;charset=UTF-8")
+
+    def metric_families(self):
+        """Return the request, routing, worker, login and memory metrics of the router."""
+        prefix = metrics_prefix
+        families = self.metrics.families(prefix)
+        families += [
+            (f"{prefix}_routed_queries_total", "counter",
+             "Queries by route: one shard, any worker, scattered or replica.",
+             [("", {"route": kind}, count) for kind, count in sorted(self.routed.items())]),
+            (f"{prefix}_worker_requests_total", "counter", "Requests sent to each worker process.",
+             [("", {"worker": client.name}, client.requests) for client in self.workers]),
+            (f"{prefix}_worker_pending", "gauge", "Requests sent to each worker process and not answered yet.",
+             [("", {"worker": client.name}, client.pending) for client in self.workers]),
+        ]
+        families += self.auth_families(prefix)
+        return families + memory_families(prefix)
+
+    async def handle_metrics(self, request):
+        return Response(200, prometheus_text(self.metric_families()), "text/plain; version=0.0.4; charset=utf-8")
+
+    def close(self):
+        """Stop the worker processes."""
+        for client in self.workers:
+            client.close()
+        self.executor.shutdown()
@@ -0,0 +1,407 @@
+"""
+An indexed in-process triple store for the catalog generated by Products.py.
+
+CatalogStore is an rdflib Store, so rdflib's SPARQL engine can query and update it. Every term is
+interned once and triples are kept as integer ids in three permutation indexes:
+
+- SPO: subject -> predicate -> objects
+- POS: predicate -> object -> subjects
+- OSP: object -> subject -> predicates
+
+Literals typed xsd:string are stored as plain literals, which RDF 1.1 defines as the same term, so
+"17" in a query matches "17"^^xsd:string in the data like it does on GraphDB. The VALUES blocks of
+queries and updates are put in the same form with normalize_values() before they are evaluated.
+
+A triple pattern is answered from the index whose leading position is bound, so lookups such as
+"all products with this :hasProductID" or "all triples of this product" never scan the whole catalog.
+
+While store.journal is a list, every triple added or removed is appended to it, so an update can be
+validated afterwards and undone with rollback().
+
+A store can also start from a snapshot (see store_persistence.py) instead of parsing the catalog: its
+terms and a SortedTriples of its triples, memory-mapped from the snapshot file, are the base of the
+store. Terms of the base are only decoded when a triple using them is returned, and a pattern is
+answered from the base by binary search on the column sorted by its bound positions. The dict indexes
+then only hold the triples added since, and the base triples removed since are kept in a set, so
+opening a snapshot does not depend on the size of the catalog.
+"""
+
+from bisect import bisect_left, bisect_right
+from collections import Counter
+
+from rdflib import XSD, Graph, Literal
+from rdflib.plugins.sparql.parserutils import CompValue
+from rdflib.store import Store
+
+# Namespaces bound on every catalog graph, so queries can use them without PREFIX lines like on GraphDB
+catalog_namespaces = {
+    "": "http://www.semanticweb.org/My_Super/",
+    "base": "http://www.semanticweb.org/My_Super/",
+    "gr": "http://purl.org/goodrelations/v1#",
+    "owl": "http://www.w3.org/2002/07/owl#",
+    "pto": "http://www.productontology.org/id/",
+    "rdf": "http://www.w3.org/1999/02/22-rdf-syntax-ns#",
+    "rdfs": "http://www.w3.org/2000/01/rdf-schema#",
+    "xsd": "http://www.w3.org/2001/XMLSchema#",
+    "sh": "http://www.w3.org/ns/shacl#",
+}
+
+
+def _no_contexts():
+    return iter(())
+
+
+def normalize(term):
+    """Return the canonical form of a term: as in RDF 1.1, "x"^^xsd:string is the plain literal "x"."""
+    if isinstance(term, Literal) and term.datatype == XSD.string:
+        return Literal(str(term))
+    return term
+
+
+def normalize_values(algebra):
+    """Put the terms of the VALUES blocks of a prepared query or update algebra in canonical form, in place.
+
+    Solutions are joined by term equality, so "x"^^xsd:string in VALUES would not join the "x" of the store.
+    """
+    if isinstance(algebra, list):
+        for operation in algebra:
+            normalize_values(operation)
+    elif isinstance(algebra, CompValue) and algebra.name not in ("InsertData", "DeleteData"):
+        if algebra.name == "values":
+            algebra["res"] = [{variable: normalize(term) for variable, term in row.items()} for row in algebra.res]
+        for value in algebra.values():
+            normalize_values(value)
+    return algebra
+
+
+class TermTable:
+    """The interned terms by id: the terms of a base, decoded when first used, followed by the terms added since.
+
+    base has the length of its term table and decode(term_id), like SnapshotTerms of store_persistence.py.
+    """
+
+    def __init__(self, base=None):
+        self.base = base
+        self.base_size = len(base) if base is not None else 0
+        self.decoded = {}
+        self.added = []
+
+    def __len__(self):
+        return self.base_size + len(self.added)
+
+    def __getitem__(self, term_id):
+        if term_id >= self.base_size:
+            return self.added[term_id - self.base_size]
+        term = self.decoded.get(term_id)
+        if term is None:
+            term = self.decoded[term_id] = self.base.decode(term_id)
+        return term
+
+    def append(self, term):
+        self.added.append(term)
+
+
+# Rows of a SortedTriples range converted to Python ints at a time
+sorted_chunk_rows = 4096
+
+# Ranges of a SortedTriples column at most this long are searched as Python lists, faster than numpy for few rows
+small_range_rows = 64
+
+
+class SortedTriples:
+    """Triples of term ids that never change, as columns sorted in the order of each of the three indexes.
+
+    orders maps "spo", "pos" and "osp" to three numpy arrays of the same length: the positions of the
+    triples in that order, sorted by the first column, then the second and the third. offsets maps them
+    to the first row of every term id in the first column, followed by the number of rows, so the rows
+    of a term are found without a search. A pattern is the range of rows starting with its bound ids.
+    """
+
+    def __init__(self, spo, pos, osp, offsets):
+        self.orders = {"spo": spo, "pos": pos, "osp": osp}
+        self.offsets = offsets
+        self.size = len(spo[0])
+
+    def __len__(self):
+        return self.size
+
+    def range(self, order, keys):
+        """Return the first and the end row of an order whose leading columns are keys."""
+        if not keys:
+            return 0, self.size
+        offsets = self.offsets[order]
+        if keys[0] >= len(offsets) - 1:
+            return 0, 0
+        start, end = int(offsets[keys[0]]), int(offsets[keys[0] + 1])
+        for column, key in zip(self.orders[order][1:], keys[1:]):
+            if start == end:
+                break
+            if end - start <= small_range_rows:
+                part = column[start:end].tolist()
+                start, end = start + bisect_left(part, key), start + bisect_right(part, key)
+            else:
+                part = column[start:end]
+                start, end = start + int(part.searchsorted(key, "left")), start + int(part.searchsorted(key, "right"))
+        return start, end
+
+    def __contains__(self, triple):
+        start, end = self.range("spo", triple)
+        return start < end
+
+    def count(self, order, keys):
+        start, end = self.range(order, keys)
+        return end - start
+
+    def rows(self, order, keys=()):
+        """Yield the rows of an order whose leading columns are keys, as tuples of ints in the order's positions."""
+        columns = self.orders[order]
+        start, end = self.range(order, keys)
+        for chunk in range(start, end, sorted_chunk_rows):
+            stop = min(chunk + sorted_chunk_rows, end)
+            yield from zip(*(column[chunk:stop].tolist() for column in columns))
+
+
+class CatalogStore(Store):
+    """rdflib store with interned term ids and SPO, POS and OSP indexes."""
+
+    context_aware = False
+    formula_aware = False
+    transaction_aware = False
+    graph_aware = False
+
+    def __init__(self, configuration=None, identifier=None, base_terms=None, base_triples=None):
+        super().__init__(configuration)
+        self.identifier = identifier
+        # base_terms also finds the id of a term with find(term), base_triples is a SortedTriples
+        self.base_terms = base_terms
+        self.base_triples = base_triples
+        self.terms = TermTable(base_terms)
+        self.ids = {}
+        self.spo = {}
+        self.pos = {}
+        self.osp = {}
+        # Triples of every predicate in the indexes
+        self.predicate_counts = Counter()
+        # Triples of the base removed since, and how many of them use every predicate
+        self.removed = set()
+        self.removed_predicates = Counter()
+        self.size = len(base_triples) if base_triples is not None else 0
+        # (added, s, p, o) id tuples of the changes, recorded while it is a list
+        self.journal = None
+        self._namespace = {}
+        self._prefix = {}
+
+    def term_id(self, term):
+        """Return the id of a normalized term, or None if it is not in the term table."""
+        term_id = self.ids.get(term)
+        if term_id is None and self.base_terms is not None:
+            term_id = self.base_terms.find(term)
+            if term_id is not None:
+                self.ids[term] = term_id
+        return term_id
+
+    def intern(self, term):
+        """Return the id of a term, adding it to the term table the first time it is seen."""
+        term = normalize(term)
+        term_id = self.term_id(term)
+        if term_id is None:
+            term_id = self.ids[term] = len(self.terms)
+            self.terms.append(term)
+        return term_id
+
+    def add(self, triple, context=None, quoted=False):
+        """Add a triple to the three indexes."""
+        Store.add(self, triple, context, quoted)
+        self.add_ids(*(self.intern(term) for term in triple))
+
+    def add_ids(self, s, p, o):
+        """Add a triple of term ids to the three indexes, returning False if it was already there."""
+        if o in self.spo.get(s, {}).get(p, ()):
+            return False
+        if (s, p, o) in self.removed:
+            # A removed triple of the base comes back
+            self.removed.discard((s, p, o))
+            self.removed_predicates[p] -= 1
+        elif self.base_triples is not None and (s, p, o) in self.base_triples:
+            return False
+        else:
+            self.spo.setdefault(s, {}).setdefault(p, set()).add(o)
+            self.pos.setdefault(p, {}).setdefault(o, set()).add(s)
+            self.osp.setdefault(o, {}).setdefault(s, set()).add(p)
+            self.predicate_counts[p] += 1
+        self.size += 1
+        if self.journal is not None:
+            self.journal.append((True, s, p, o))
+        return True
+
+    def remove_ids(self, s, p, o):
+        """Remove a triple of term ids that is in the store from the three indexes, dropping emptied entries."""
+        if o in self.spo.get(s, {}).get(p, ()):
+            for index, a, b, c in ((self.spo, s, p, o), (self.pos, p, o, s), (self.osp, o, s, p)):
+                second = index[a]
+                third = second[b]
+                third.discard(c)
+                if not third:
+                    del second[b]
+                    if not second:
+                        del index[a]
+            self.predicate_counts[p] -= 1
+        else:
+            self.removed.add((s, p, o))
+            self.removed_predicates[p] += 1
+        self.size -= 1
+        if self.journal is not None:
+            self.journal.append((False, s, p, o))
+
+    def rollback(self, journal):
+        """Undo the changes of a journal, last change first."""
+        recording, self.journal = self.journal, None
+        try:
+            for added, s, p, o in reversed(journal):
+                if added:
+                    self.remove_ids(s, p, o)
+                else:
+                    self.add_ids(s, p, o)
+        finally:
+            self.journal = recording
+
+    def remove(self, triple_pattern, context=None):
+        """Remove every triple matching a pattern."""
+        for s, p, o in list(self.match_ids(*self._pattern_ids(triple_pattern))):
+            self.remove_ids(s, p, o)
+
+    def _pattern_ids(self, triple_pattern):
+        """Translate the bound terms of a pattern to ids; -1 for a term that is not in the store."""
+        ids = []
+        for term in triple_pattern:
+            term_id = None if term is None else self.term_id(normalize(term))
+            ids.append(-1 if term is not None and term_id is None else term_id)
+        return tuple(ids)
+
+    def match_ids(self, s, p, o):
+        """Yield the id triples matching a pattern of ids, where None is unbound, using the best index.
+
+        Index entries are copied before they are iterated, so triples can be removed while a SPARQL
+        DELETE WHERE still iterates over the matches.
+        """
+        if -1 in (s, p, o):
+            return
+        if s is not None:
+            predicates = self.spo.get(s, {})
+            for p2 in (tuple(predicates) if p is None else (p,)):
+                objects = predicates.get(p2, ())
+                if o is None:
+                    for o2 in tuple(objects):
+                        yield s, p2, o2
+                elif o in objects:
+                    yield s, p2, o
+        elif p is not None:
+            objects = self.pos.get(p, {})
+            for o2 in (tuple(objects) if o is None else (o,)):
+                for s2 in tuple(objects.get(o2, ())):
+                    yield s2, p, o2
+        elif o is not None:
+            for s2, predicates in tuple(self.osp.get(o, {}).items()):
+                for p2 in tuple(predicates):
+                    yield s2, p2, o
+        else:
+            for s2, predicates in tuple(self.spo.items()):
+                for p2, objects in tuple(predicates.items()):
+                    for o2 in tuple(objects):
+                        yield s2, p2, o2
+        if self.base_triples is not None:
+            yield from self._match_base(s, p, o)
+
+    def _match_base(self, s, p, o):
+        """Yield the id triples of the base matching a pattern of ids, except the removed ones."""
+        base = self.base_triples
+        if s is not None and o is not None and p is None:
+            rows = ((s2, p2, o2) for o2, s2, p2 in base.rows("osp", (o, s)))
+        elif s is not None:
+            rows = base.rows("spo", (s,) if p is None else (s, p) if o is None else (s, p, o))
+        elif p is not None:
+            rows = ((s2, p2, o2) for p2, o2, s2 in base.rows("pos", (p,) if o is None else (p, o)))
+        elif o is not None:
+            rows = ((s2, p2, o2) for o2, s2, p2 in base.rows("osp", (o,)))
+        else:
+            rows = base.rows("spo")
+        removed = self.removed
+        for triple in rows:
+            if triple not in removed:
+                yield triple
+
+    def count(self, s=None, p=None, o=None):
+        """Count the triples matching a pattern of terms, from the index sizes where possible.
+
+        A predicate alone, or a predicate with a subject or an object, is counted without iterating
+        over the triples, unless triples of the base using the predicate were removed.
+        """
+        s, p, o = self._pattern_ids((s, p, o))
+        if -1 in (s, p, o):
+            return 0
+        base = self.base_triples
+        if s is None and o is None:
+            if p is None:
+                return self.size
+            count = self.predicate_counts[p]
+            if base is not None:
+                count += base.count("pos", (p,)) - self.removed_predicates[p]
+            return count
+        if p is not None and (s is None or o is None) and not self.removed_predicates[p]:
+            if s is None:
+                count = len(self.pos.get(p, {}).get(o, ()))
+                return count + base.count("pos", (p, o)) if base is not None else count
+            count = len(self.spo.get(s, {}).get(p, ()))
+            return count + base.count("spo", (s, p)) if base is not None else count
+        return sum(1 for _ in self.match_ids(s, p, o))
+
+    def triples(self, triple_pattern, context=None):
+        """Yield the triples matching a pattern, as rdflib expects from a store."""
+        terms = self.terms
+        for s, p, o in self.match_ids(*self._pattern_ids(triple_pattern)):
+            yield (terms[s], terms[p], terms[o]), _no_contexts()
+
+    def __len__(self, context=None):
+        return self.size
+
+    def contexts(self, triple=None):
+        return iter(())
+
+    def bind(self, prefix, namespace, override=True):
+        bound_namespace = self._namespace.get(prefix)
+        bound_prefix = self._prefix.get(namespace)
+        if bound_prefix is None and bound_namespace is not None:
+            bound_prefix = self._prefix.get(bound_namespace)
+        if not override and (bound_prefix is not None or bound_namespace is not None):
+            return
+        if bound_prefix is not None:
+            self._namespace.pop(bound_prefix, None)
+        if bound_namespace is not None:
+            self._prefix.pop(bound_namespace, None)
+        self._prefix[namespace] = prefix
+        self._namespace[prefix] = namespace
+
+    def namespace(self, prefix):
+        return self._namespace.get(prefix)
+
+    def prefix(self, namespace):
+        return self._prefix.get(namespace)
+
+    def namespaces(self):
+        yield from self._namespace.items()
+
+
+def catalog_graph(store=None):
+    """Create an rdflib Graph on a CatalogStore with the catalog namespaces bound."""
+    graph = Graph(store=CatalogStore() if store is None else store)
+    for prefix, namespace in catalog_namespaces.items():
+        graph.bind(prefix, namespace, override=True, replace=True)
+    return graph
+
+
+def load_catalog(paths, graph=None):
+    """Parse RDF files (Turtle, N-Triples, ...) into a catalog graph and return it."""
+    graph = catalog_graph() if graph is None else graph
+    for path in paths:
+        graph.parse(path)
+    return graph
@@ -0,0 +1,213 @@
+"""
+Aggregates of the admin dashboard, kept up to date as orders and stock changes are written.
+
+Dashboard.js reads every order, then the items of the selected order with one more query per order,
+then the stock of every product. DashboardAggregates keeps what it shows materialized over the
+:Order / :OrderItem / :hasStock model of Products.py:
+
+- every order with its id, day, total, number of items and units, and the items of every order
+- revenue and number of orders per day
+- units sold and revenue per product
+- the products whose stock is at or below a threshold
+
+It is built once from the store and then maintained from the changes of every write, as
+(added, subject, predicate, object) tuples: the orders, order items and products a change touches are
+marked dirty, their old contribution is taken out of the aggregates and their current one, read from
+the store, is put in. The cost of a write depends on what it touches, not on the size of the order
+history, and summary() answers the whole dashboard in one read.
+
+Amounts are kept in cents, so adding and removing contributions never drifts.
+"""
+
+import heapq
+from collections import Counter
+
+from rdflib import RDF, URIRef
+
+from catalog_store import catalog_namespaces
+from order_service import (HAS_ORDER_DATE, HAS_ORDER_ID, HAS_ORDER_ITEM, HAS_ORDER_ITEM_ID, HAS_ORDER_PRICE,
+                           HAS_ORDER_QUANTITY, HAS_PRODUCT, HAS_STOCK, HAS_TOTAL_PRICE, ORDER, ORDER_ITEM)
+
+GR_NAME = URIRef(catalog_namespaces["gr"] + "name")
+
+# Products with at most this stock are listed as low on stock
+low_stock_threshold = 3
+
+# Properties whose changes make an order, an order item or a product dirty
+order_predicates = {HAS_ORDER_ID, HAS_ORDER_DATE, HAS_TOTAL_PRICE, HAS_ORDER_ITEM}
+item_predicates = {HAS_ORDER_ITEM_ID, HAS_ORDER_QUANTITY, HAS_ORDER_PRICE, HAS_PRODUCT}
+product_predicates = {HAS_STOCK, GR_NAME}
+
+
+def _cents(value):
+    try:
+        return round(float(value) * 100)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _integer(value, default=0):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class DashboardAggregates:
+    """Materialized order, revenue, sales and stock aggregates of a catalog graph."""
+
+    def __init__(self, graph, low_stock=low_stock_threshold):
+        self.graph = graph
+        self.low_stock_threshold = low_stock
+        self.rebuild()
+
+    def rebuild(self):
+        """Compute every aggregate from the store."""
+        # Contributions of every order, item and product, as last read from the store
+        self.orders = {}
+        self.items = {}
+        self.stock = {}
+        self.order_items = {}
+        self.revenue_by_day = Counter()
+        self.orders_by_day = Counter()
+        self.units_by_product = Counter()
+        self.revenue_by_product = Counter()
+        self.low_stock = set()
+        graph = self.graph
+        self._refresh(set(graph.subjects(RDF.type, ORDER)), set(graph.subjects(RDF.type, ORDER_ITEM)),
+                      set(graph.subjects(HAS_STOCK, None)))
+
+    def apply(self, changes):
+        """Update the aggregates after a write, given its (added, s, p, o) changes."""
+        orders, items, products = set(), set(), set()
+        for _, s, p, o in changes:
+            if p in order_predicates or (p == RDF.type and o == ORDER):
+                orders.add(s)
+                if p == HAS_ORDER_ITEM:
+                    items.add(o)
+            elif p in item_predicates or (p == RDF.type and o == ORDER_ITEM):
+                items.add(s)
+            elif p in product_predicates:
+                products.add(s)
+        if orders or items or products:
+            self._refresh(orders, items, products)
+
+    def _refresh(self, orders, items, products):
+        for item in items:
+            self._set_item(item, self._read_item(item))
+        for order in orders:
+            self._set_order(order, self._read_order(order))
+        for product in products:
+            self._set_stock(product, self._read_stock(product))
+
+    def _read_order(self, order):
+        graph = self.graph
+        if (order, RDF.type, ORDER) not in graph:
+            return None
+        date = graph.value(order, HAS_ORDER_DATE)
+        return {"id": str(graph.value(order, HAS_ORDER_ID) or ""), "date": str(date or ""),
+                "day": str(date or "")[:10], "total": _cents(graph.value(order, HAS_TOTAL_PRICE))}
+
+    def _read_item(self, item):
+        graph = self.graph
+        if (item, RDF.type, ORDER_ITEM) not in graph:
+            return None
+        return {"order": graph.value(None, HAS_ORDER_ITEM, item), "product": graph.value(item, HAS_PRODUCT),
+                "quantity": _integer(graph.value(item, HAS_ORDER_QUANTITY)),
+                "price": _cents(graph.value(item, HAS_ORDER_PRICE))}
+
+    def _read_stock(self, product):
+        stock = self.graph.value(product, HAS_STOCK)
+        return None if stock is None else _integer(stock)
+
+    def _set_order(self, order, record):
+        old = self.orders.pop(order, None)
+        if old is not None:
+            self.revenue_by_day[old["day"]] -= old["total"]
+            self.orders_by_day[old["day"]] -= 1
+            if not self.orders_by_day[old["day"]]:
+                del self.orders_by_day[old["day"]]
+                del self.revenue_by_day[old["day"]]
+        if record is not None:
+            self.orders[order] = record
+            self.revenue_by_day[record["day"]] += record["total"]
+            self.orders_by_day[record["day"]] += 1
+
+    def _set_item(self, item, record):
+        old = self.items.pop(item, None)
+        if old is not None:
+            self._count_item(item, old, -1)
+        if record is not None:
+            self.items[item] = record
+            self._count_item(item, record, 1)
+
+    def _count_item(self, item, record, sign):
+        product, order = record["product"], record["order"]
+        if product is not None:
+            self.units_by_product[product] += sign * record["quantity"]
+            self.revenue_by_product[product] += sign * record["price"]
+            if not self.units_by_product[product] and not self.revenue_by_product[product]:
+                del self.units_by_product[product]
+                del self.revenue_by_product[product]
+        if order is not None:
+            order_items = self.order_items.setdefault(order, set())
+            if sign > 0:
+                order_items.add(item)
+            else:
+                order_items.discard(item)
+                if not order_items:
+                    del self.order_items[order]
+
+    def _set_stock(self, product, stock):
+        if stock is None:
+            self.stock.pop(product, None)
+        else:
+            self.stock[product] = stock
+        if stock is not None and stock <= self.low_stock_threshold:
+            self.low_stock.add(product)
+        else:
+            self.low_stock.discard(product)
+
+    def _name(self, product):
+        name = self.graph.value(product, GR_NAME)
+        return str(name) if name is not None else str(product).rsplit("/", 1)[-1]
+
+    def summary(self, limit=None):
+        """Return the dashboard as one JSON-ready dict, with the limit latest orders and best-selling products."""
+        def newest(entry):
+            return entry[1]["date"], entry[1]["id"]
+
+        def best_selling(entry):
+            return entry[1], str(entry[0])
+
+        orders = self.orders.items()
+        latest = (heapq.nlargest(limit, orders, key=newest) if limit is not None
+                  else sorted(orders, key=newest, reverse=True))
+        order_list = []
+        for order, record in latest:
+            items = [self.items[item] for item in self.order_items.get(order, ())]
+            order_list.append({
+                "orderId": record["id"],
+                "date": record["date"],
+                "total": record["total"] / 100,
+                "units": sum(item["quantity"] for item in items),
+                "items": sorted(({"productName": self._name(item["product"]), "quantity": item["quantity"],
+                                  "price": item["price"] / 100} for item in items if item["product"] is not None),
+                                key=lambda entry: entry["productName"]),
+            })
+        sold = self.units_by_product.items()
+        best = (heapq.nlargest(limit, sold, key=best_selling) if limit is not None
+                else sorted(sold, key=best_selling, reverse=True))
+        return {
+            "totals": {"orders": len(self.orders), "revenue": sum(self.revenue_by_day.values()) / 100,
+                       "units": sum(self.units_by_product.values())},
+            "orders": order_list,
+            "revenueByDay": [{"day": day, "revenue": self.revenue_by_day[day] / 100, "orders": count}
+                             for day, count in sorted(self.orders_by_day.items())],
+            "unitsSold": [{"product": str(product), "productName": self._name(product), "units": units,
+                           "revenue": self.revenue_by_product[product] / 100} for product, units in best],
+            "lowStockThreshold": self.low_stock_threshold,
+            "lowStock": sorted(({"product": str(product), "productName": self._name(product),
+                                 "stock": self.stock[product]} for product in self.low_stock),
+                               key=lambda entry: (entry["stock"], entry["productName"])),
+        }
@@ -0,0 +1,28 @@
+"""
+Deferred imports of the heavy dependencies, so scripts that do not need them start quickly.
+
+Importing pandas takes most of a second and numpy a good part of one, which is paid by every run of
+Products.py even when it only prints its help, checks the CSV file or renders a small catalog with the
+csv module. lazy_import() returns the module object right away and only executes it the first time
+one of its attributes is used, with importlib's LazyLoader, so the code using it stays the same as
+with a plain import.
+"""
+
+import importlib.util
+import sys
+
+
+def lazy_import(name):
+    """Return a module that is imported the first time one of its attributes is used."""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named {name!r}", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
@@ -0,0 +1,264 @@
+"""
+Timings and memory of the generator stages and request metrics of the local query service.
+
+StageRecorder times the named stages of a run (CSV load, class emission, instance emission, ...) and
+keeps per stage the wall time, the rows processed, the bytes written and the peak memory. Stages can
+be nested, the time of an inner stage is not counted again in the outer one. Recording a stage costs
+two clock reads and a getrusage call, so it is always on. Two heavier hooks are opt-in:
+
+- trace_memory starts tracemalloc, which adds the peak of the Python allocations of every stage but
+  slows allocations down
+- profiled() runs a block under cProfile and saves the stats for pstats or snakeviz
+
+RequestMetrics counts the requests of sparql_service.py by endpoint and status and keeps a latency
+histogram per endpoint. Both are exported in the Prometheus text format by prometheus_text(): the
+service answers it on GET /metrics, and Products.py --metrics writes it to a file that the textfile
+collector of node_exporter can pick up after a nightly run.
+"""
+
+import os
+import time
+import tracemalloc
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows has no resource module, the peak RSS is left out there
+    resource = None
+
+# Upper bounds in seconds of the request latency histogram buckets
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def peak_rss():
+    """Return the peak resident memory of this process in bytes, or None where it is not available."""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def text_bytes(text):
+    """Return the size of a string encoded as UTF-8, without encoding ASCII text."""
+    return len(text) if text.isascii() else len(text.encode("utf-8"))
+
+
+@contextmanager
+def profiled(path):
+    """Profile the calling thread with cProfile while the block runs and save the stats to path."""
+    import cProfile
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value) if value == value and abs(value) != float("inf") else str(value).replace("inf", "Inf")
+    return str(int(value))
+
+
+def prometheus_text(families):
+    """Render metric families in the Prometheus text exposition format.
+
+    families is a list of (name, type, help, samples), where every sample is a (suffix, labels, value)
+    tuple: suffix is appended to the name ("_bucket", "_sum", ... or ""), labels is a dict.
+    """
+    lines = []
+    for name, kind, help_text, samples in families:
+        if not samples:
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for suffix, labels, value in samples:
+            labels = ",".join(f'{key}="{_label(label)}"' for key, label in labels.items())
+            lines.append(f"{name}{suffix}{{{labels}}} {_number(value)}" if labels else f"{name}{suffix} {_number(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path, families):
+    """Write metric families to a file atomically, so a collector never reads a half-written file."""
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "w", encoding="utf-8") as f:
+        f.write(prometheus_text(families))
+    os.replace(temporary, path)
+
+
+def memory_families(prefix):
+    """Return the peak RSS and, while tracemalloc traces, the Python allocations of this process."""
+    families = []
+    rss = peak_rss()
+    if rss is not None:
+        families.append((f"{prefix}_peak_rss_bytes", "gauge", "Peak resident memory of the process.", [("", {}, rss)]))
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        families.append((f"{prefix}_traced_bytes", "gauge", "Python allocations traced by tracemalloc.",
+                         [("", {"kind": "current"}, current), ("", {"kind": "peak"}, peak)]))
+    return families
+
+
+class Stage:
+    """The totals of one named stage."""
+
+    __slots__ = ("name", "calls", "seconds", "rows", "bytes", "peak_rss", "peak_traced")
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.peak_rss = None
+        self.peak_traced = None
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.rows and self.seconds else None
+
+
+class StageRecorder:
+    """Records the stages of a run, in the order they first ran.
+
+    with recorder.stage("instances") as stage: times a block, which adds to stage.rows and stage.bytes
+    what it processed and wrote. iterate() times the production of every item of an iterable, like the
+    chunks of a CSV reader, without timing what is done with the items.
+    """
+
+    def __init__(self, trace_memory=False):
+        self.stages = {}
+        self.trace_memory = trace_memory
+        # Open stages: [stage, start time, seconds of the stages nested in it]
+        self._open = []
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def get(self, name):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = Stage(name)
+        return stage
+
+    def _traced_peak(self):
+        """Fold the tracemalloc peak since the last call into the open stages and reset it."""
+        if not self.trace_memory or not tracemalloc.is_tracing():
+            return
+        peak = tracemalloc.get_traced_memory()[1]
+        for stage, _, _ in self._open:
+            stage.peak_traced = max(stage.peak_traced or 0, peak)
+        tracemalloc.reset_peak()
+
+    @contextmanager
+    def stage(self, name):
+        """Time a block as the named stage, adding to it if it already ran."""
+        stage = self.get(name)
+        self._traced_peak()
+        self._open.append([stage, time.perf_counter(), 0.0])
+        try:
+            yield stage
+        finally:
+            self._traced_peak()
+            _, start, nested = self._open.pop()
+            elapsed = time.perf_counter() - start
+            stage.calls += 1
+            stage.seconds += elapsed - nested
+            if self._open:
+                self._open[-1][2] += elapsed
+            rss = peak_rss()
+            if rss is not None:
+                stage.peak_rss = max(stage.peak_rss or 0, rss)
+
+    def iterate(self, name, iterable):
+        """Yield the items of an iterable, timing the production of each as the named stage.
+
+        Items with a length, like DataFrame chunks or lists of rows, add it to the rows of the stage.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name) as stage:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                if hasattr(item, "__len__"):
+                    stage.rows += len(item)
+            yield item
+
+    def table(self):
+        """Return the stages as lines of a text table."""
+        lines = [f"{'Stage':<14}{'Seconds':>10}{'Rows':>12}{'Rows/s':>12}{'MB written':>12}{'Peak RSS MB':>13}"
+                 + (f"{'Peak traced MB':>16}" if self.trace_memory else "")]
+        for stage in self.stages.values():
+            rate = stage.rows_per_second
+            line = (f"{stage.name:<14}{stage.seconds:>10.3f}{stage.rows:>12}{rate or 0:>12.0f}"
+                    f"{stage.bytes / (1 << 20):>12.2f}{(stage.peak_rss or 0) / (1 << 20):>13.1f}")
+            if self.trace_memory:
+                line += f"{(stage.peak_traced or 0) / (1 << 20):>16.1f}"
+            lines.append(line)
+        return lines
+
+    def families(self, prefix):
+        """Return the stages as metric families named prefix_stage_..."""
+        stages = list(self.stages.values())
+        metrics = [
+            ("seconds", "Wall time of the stage, without its nested stages.", lambda stage: stage.seconds),
+            ("rows", "Rows processed by the stage.", lambda stage: stage.rows),
+            ("rows_per_second", "Rows processed per second of the stage.", lambda stage: stage.rows_per_second),
+            ("bytes", "Bytes written by the stage.", lambda stage: stage.bytes),
+            ("peak_rss_bytes", "Peak resident memory of the process at the end of the stage.",
+             lambda stage: stage.peak_rss),
+            ("peak_traced_bytes", "Peak of the Python allocations traced during the stage.",
+             lambda stage: stage.peak_traced),
+        ]
+        families = []
+        for metric, help_text, value in metrics:
+            samples = [("", {"stage": stage.name}, value(stage)) for stage in stages if value(stage) is not None]
+            families.append((f"{prefix}_stage_{metric}", "gauge", help_text, samples))
+        return families
+
+
+class RequestMetrics:
+    """Request counts by endpoint and status and latency histograms by endpoint.
+
+    observe() is only called from the event loop of the service, so nothing needs a lock.
+    """
+
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = tuple(buckets)
+        self.counts = Counter()
+        # Requests per bucket, the last one for slower requests than every bound, and their total time
+        self.histograms = {}
+        self.seconds = Counter()
+
+    def observe(self, endpoint, status, seconds):
+        self.counts[endpoint, status] += 1
+        histogram = self.histograms.get(endpoint)
+        if histogram is None:
+            histogram = self.histograms[endpoint] = [0] * (len(self.buckets) + 1)
+        histogram[bisect_left(self.buckets, seconds)] += 1
+        self.seconds[endpoint] += seconds
+
+    def families(self, prefix):
+        requests = [("", {"endpoint": endpoint, "status": status}, count)
+                    for (endpoint, status), count in sorted(self.counts.items())]
+        latency = []
+        for endpoint, histogram in sorted(self.histograms.items()):
+            total = 0
+            for bound, count in zip((*self.buckets, "+Inf"), histogram):
+                total += count
+                latency.append(("_bucket", {"endpoint": endpoint, "le": bound}, total))
+            latency.append(("_sum", {"endpoint": endpoint}, self.seconds[endpoint]))
+            latency.append(("_count", {"endpoint": endpoint}, total))
+        return [
+            (f"{prefix}_requests_total", "counter", "Requests answered, by endpoint and HTTP status.", requests),
+            (f"{prefix}_request_seconds", "histogram", "Time taken to answer a request, by endpoint.", latency),
+        ]
@@ -0,0 +1,294 @@
+"""
+Server-side order placement for the local SPARQL service, on the :Order / :OrderItem model of Products.py.
+
+Cart.js places an order in three round trips: it reads the stock of the products, reads MAX() of the
+order and order item ids, then posts one big SPARQL update. Two checkouts at the same time can get the
+same ids or both take the last item in stock. OrderService does the whole checkout next to the store:
+
+- Order and order item ids come from counters, found once at startup and then only incremented.
+  Orders are named like Cart.js names them (:Order5 with :hasOrderID "OR05", :OrderItem12).
+- The stock of every product of an order is checked and decremented in the same step, an order is
+  placed whole or rejected whole, and :isAvailable becomes false when the stock reaches 0.
+- Orders are placed in batches. Orders that arrive while a batch is written wait and are all placed
+  by the next one (group commit), so concurrent checkouts share one pass over the store instead of
+  queueing one by one.
+- A batch is written as one change through the write callback of the service, which validates, logs
+  and rolls back changes like it does for updates. If anything but a rejected order fails, the whole
+  batch is rolled back and every request of the batch gets the error.
+
+A request is a JSON order, or {"orders": [...]} with several, where an order is
+
+    {"username": "user", "items": [{"productId": "17", "quantity": 2}]}
+
+("user" with the instance local name of the user can be given instead of "username"). Quantities are
+positive whole numbers, 1 if missing. Every order gets back {"status": "placed", "orderId": "OR05", ...} or {"status": "rejected", "reason": "..."}.
+"""
+
+import asyncio
+import math
+import re
+from collections import Counter, deque
+from datetime import datetime, timezone
+
+from rdflib import RDF, XSD, Literal, URIRef
+
+from catalog_store import catalog_namespaces
+
+base = catalog_namespaces[""]
+
+# Properties of the order model, as defined by Products.py
+ORDER = URIRef(base + "Order")
+ORDER_ITEM = URIRef(base + "OrderItem")
+NORMAL_USER = URIRef(base + "NormalUser")
+HAS_ORDER_ID = URIRef(base + "hasOrderID")
+HAS_ORDER_DATE = URIRef(base + "hasOrderDate")
+HAS_TOTAL_PRICE = URIRef(base + "hasTotalPrice")
+IS_FINALIZED = URIRef(base + "isFinalized")
+HAS_NORMAL_USER = URIRef(base + "hasNormalUser")
+HAS_ORDER_ITEM = URIRef(base + "hasOrderItem")
+HAS_ORDER_ITEM_ID = URIRef(base + "hasOrderItemID")
+HAS_ORDER_QUANTITY = URIRef(base + "hasOrderQuantity")
+HAS_ORDER_PRICE = URIRef(base + "hasOrderPrice")
+HAS_PRODUCT = URIRef(base + "hasProduct")
+HAS_PRODUCT_ID = URIRef(base + "hasProductID")
+HAS_PRICE = URIRef(base + "hasPrice")
+HAS_STOCK = URIRef(base + "hasStock")
+IS_AVAILABLE = URIRef(base + "isAvailable")
+HAS_USERNAME = URIRef(base + "hasUsername")
+
+# Largest number of orders placed by one batch
+max_batch_orders = 1000
+
+# Numbers at the end of the ids written by Cart.js: "OR05" and "OrderItem12"
+_order_number = re.compile(r"OR(\d+)$")
+_item_number = re.compile(r"OrderItem(\d+)$")
+
+
+class OrderError(ValueError):
+    """An order that cannot be placed, the message says why."""
+
+
+def _max_number(graph, predicate, pattern):
+    numbers = (pattern.match(str(value)) for value in graph.objects(None, predicate))
+    return max((int(match.group(1)) for match in numbers if match), default=0)
+
+
+def _quantity(value):
+    """Return an order quantity as an int, or None if it is not a positive whole number."""
+    if isinstance(value, str) and value.strip().isdecimal():
+        value = int(value)
+    elif isinstance(value, float) and math.isfinite(value) and value.is_integer():
+        value = int(value)
+    if isinstance(value, bool) or not isinstance(value, int) or value <= 0:
+        return None
+    return value
+
+
+def _now():
+    """The current time written like the toISOString() of Cart.js."""
+    return datetime.now(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+class OrderService:
+    """Places orders on a catalog graph. place() runs on the store thread, submit() batches requests for it."""
+
+    def __init__(self, graph, executor=None, max_batch=max_batch_orders, write=None):
+        self.graph = graph
+        self.executor = executor
+        self.max_batch = max_batch
+        # Called on the store thread with a function placing a batch, runs it as one change and rolls it
+        # back if it fails, like SparqlService.write. Without a service the graph is written directly.
+        self.write = self._write if write is None else write
+        self._changes = []
+        # Counters continue after the highest ids already in the store
+        self.last_order = _max_number(graph, HAS_ORDER_ID, _order_number)
+        self.last_item = _max_number(graph, HAS_ORDER_ITEM_ID, _item_number)
+        self.placed = 0
+        self.rejected = 0
+        self.batches = 0
+        self._queue = deque()
+        self._flushing = False
+
+    def _next_order(self):
+        # Skip ids taken by orders that did not come through this service
+        self.last_order += 1
+        while (URIRef(f"{base}Order{self.last_order}"), None, None) in self.graph:
+            self.last_order += 1
+        return self.last_order
+
+    def _next_item(self):
+        self.last_item += 1
+        while (URIRef(f"{base}OrderItem{self.last_item}"), None, None) in self.graph:
+            self.last_item += 1
+        return self.last_item
+
+    def _write(self, write):
+        """Run write() on the graph and undo the triples it added and removed if it fails."""
+        self._changes = []
+        try:
+            write()
+        except Exception:
+            for added, s, p, o in reversed(self._changes):
+                (self.graph.remove if added else self.graph.add)((s, p, o))
+            raise
+        finally:
+            changes, self._changes = self._changes, []
+        return changes
+
+    def _add(self, triple):
+        self.graph.add(triple)
+        self._changes.append((True, *triple))
+
+    def _remove(self, pattern):
+        for triple in list(self.graph.triples(pattern)):
+            self.graph.remove(triple)
+            self._changes.append((False, *triple))
+
+    def _user(self, order):
+        if order.get("user"):
+            user = URIRef(base + str(order["user"]))
+            if (user, RDF.type, NORMAL_USER) not in self.graph:
+                raise OrderError(f"Unknown user: {order['user']}")
+            return user
+        if order.get("username"):
+            for user in self.graph.subjects(HAS_USERNAME, Literal(str(order["username"]))):
+                if (user, RDF.type, NORMAL_USER) in self.graph:
+                    return user
+            raise OrderError(f"Unknown user: {order['username']}")
+        raise OrderError("The order has no user or username")
+
+    def _items(self, order):
+        """Return the ordered quantity of every product, by product IRI and id, checking the stock."""
+        items = order.get("items")
+        if not isinstance(items, list) or not items:
+            raise OrderError("The order has no items")
+        quantities = Counter()
+        for item in items:
+            if not isinstance(item, dict) or "productId" not in item:
+                raise OrderError(f"Invalid order item: {item!r}")
+            product_id = str(item["productId"])
+            quantity = _quantity(item.get("quantity", 1))
+            if quantity is None:
+                raise OrderError(f"Invalid quantity for product {product_id}: {item.get('quantity')!r}")
+            quantities[product_id] += quantity
+
+        products = {}
+        for product_id, quantity in quantities.items():
+            product = self.graph.value(None, HAS_PRODUCT_ID, Literal(product_id))
+            if product is None:
+                raise OrderError(f"Unknown product: {product_id}")
+            stock = self.graph.value(product, HAS_STOCK)
+            stock = int(stock) if stock is not None else 0
+            if stock < quantity:
+                raise OrderError(f"Not enough stock for product {product_id}: {stock} left, {quantity} ordered")
+            products[product_id] = (product, quantity, stock)
+        return products
+
+    def place_one(self, order):
+        """Place one order, whole or not at all, and return its result."""
+        user = self._user(order)
+        products = self._items(order)
+
+        number = self._next_order()
+        order_uri = URIRef(f"{base}Order{number}")
+        order_id = f"OR{number:02d}"
+        graph = self.graph
+        total = 0.0
+        placed_items = []
+        for product_id, (product, quantity, stock) in products.items():
+            item_number = self._next_item()
+            item_uri = URIRef(f"{base}OrderItem{item_number}")
+            price = graph.value(product, HAS_PRICE)
+            item_price = round(float(price) * quantity, 2) if price is not None else 0.0
+            total += item_price
+            self._add((order_uri, HAS_ORDER_ITEM, item_uri))
+            self._add((item_uri, RDF.type, ORDER_ITEM))
+            self._add((item_uri, HAS_ORDER_ITEM_ID, Literal(f"OrderItem{item_number}", datatype=XSD.string)))
+            self._add((item_uri, HAS_ORDER_QUANTITY, Literal(str(quantity), datatype=XSD.integer)))
+            self._add((item_uri, HAS_ORDER_PRICE, Literal(f"{item_price:.2f}", datatype=XSD.double)))
+            self._add((item_uri, HAS_PRODUCT, product))
+
+            # Reserve the stock
+            stock -= quantity
+            self._remove((product, HAS_STOCK, None))
+            self._remove((product, IS_AVAILABLE, None))
+            self._add((product, HAS_STOCK, Literal(str(stock), datatype=XSD.integer)))
+            self._add((product, IS_AVAILABLE, Literal("true" if stock > 0 else "false", datatype=XSD.boolean)))
+            placed_items.append({"orderItemId": f"OrderItem{item_number}", "productId": product_id,
+                                 "quantity": quantity, "price": item_price, "stock": stock})
+
+        self._add((order_uri, RDF.type, ORDER))
+        self._add((order_uri, HAS_ORDER_ID, Literal(order_id, datatype=XSD.string)))
+        self._add((order_uri, HAS_ORDER_DATE, Literal(_now(), datatype=XSD.dateTime)))
+        self._add((order_uri, HAS_TOTAL_PRICE, Literal(f"{total:.2f}", datatype=XSD.double)))
+        self._add((order_uri, IS_FINALIZED, Literal("true", datatype=XSD.boolean)))
+        self._add((order_uri, HAS_NORMAL_USER, user))
+        return {"status": "placed", "orderId": order_id, "order": str(order_uri), "total": round(total, 2),
+                "items": placed_items}
+
+    def place(self, requests):
+        """Place the orders of several requests in one pass, in order, and return the results per request.
+
+        Every order is checked against the stock left by the orders before it, so the batch gives the
+        same result as placing the orders one after another. The batch is written as one change, if it
+        fails nothing of it is kept and the error is raised.
+        """
+        results = []
+        counts = Counter()
+
+        def place_all():
+            for orders in requests:
+                request_results = []
+                for order in orders:
+                    try:
+                        request_results.append(self.place_one(order))
+                        counts["placed"] += 1
+                    except OrderError as error:
+                        request_results.append({"status": "rejected", "reason": str(error)})
+                        counts["rejected"] += 1
+                results.append(request_results)
+
+        counters = self.last_order, self.last_item
+        try:
+            self.write(place_all)
+        except Exception:
+            # The batch was rolled back, its ids are free again
+            self.last_order, self.last_item = counters
+            raise
+        self.placed += counts["placed"]
+        self.rejected += counts["rejected"]
+        self.batches += 1
+        return results
+
+    async def submit(self, orders):
+        """Queue the orders of one request for the next batch and return their results."""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.append((orders, future))
+        if not self._flushing:
+            self._flushing = True
+            asyncio.get_running_loop().create_task(self._flush())
+        return await future
+
+    async def _flush(self):
+        """Place the queued requests batch by batch until the queue is empty."""
+        loop = asyncio.get_running_loop()
+        try:
+            while self._queue:
+                batch, size = [], 0
+                while self._queue and (not batch or size + len(self._queue[0][0]) <= self.max_batch):
+                    batch.append(self._queue.popleft())
+                    size += len(batch[-1][0])
+                try:
+                    results = await loop.run_in_executor(self.executor, self.place, [orders for orders, _ in batch])
+                except Exception as error:
+                    for _, future in batch:
+                        future.set_exception(error)
+                    continue
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+        finally:
+            self._flushing = False
+
+    def stats(self):
+        return {"placed": self.placed, "rejected": self.rejected, "batches": self.batches,
+                "lastOrder": self.last_order, "lastOrderItem": self.last_item}
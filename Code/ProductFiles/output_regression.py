@@ -0,0 +1,162 @@
+"""
+Regression check of the streamed output of Products.py.
+
+Products.py reads the CSV in chunks and renders every chunk column by column, optionally in several
+processes. This script runs it with a fixed --seed:
+1. Once with the whole CSV in one chunk and one process, as the script wrote it before it was streamed.
+   This is the baseline.
+2. Again with small chunks, with several --workers and with --engine stdlib (the csv module renders
+   the rows one by one, like the old instance loop).
+
+Every run must write the same Turtle and SHACL files, byte for byte. The first differing line of a run
+is printed and the script exits with status 1.
+
+With --expected, the runs read the Products.csv of a folder and the baseline must also match the
+Products.ttl and Shacl_shapes.ttl saved in it. tests/fixtures/regression holds every 10th product of
+Products.csv and the files this script wrote for it with --seed 7. They were checked against the script
+before it was streamed, run on the same CSV after random.seed(7): they only differ in the lines later
+changes added or changed on purpose, the :inCategory, :inSubcategory and :productCount links and the
+discounts of pricing.py. Regenerate them only for a change of the output made on purpose:
+
+    python output_regression.py --expected tests/fixtures/regression --update
+
+To compare with another version of the generator, pass its script as --baseline-script, for example
+one extracted with `git show <commit>:Code/ProductFiles/Products.py > /tmp/Products.py`. It is run
+with the same arguments as the baseline run.
+
+    python output_regression.py --seed 7
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Seed of the default discounts, fixed so that the runs can be compared
+default_seed = 7
+
+# Chunk sizes of the streamed runs, an odd one so that chunks do not line up with the categories
+streamed_chunk_sizes = [1_000, 97]
+
+# Processes of the parallel run
+streamed_workers = 2
+
+# Files compared between the runs
+compared_files = ["Products.ttl", "Shacl_shapes.ttl"]
+
+# Folder of the CSV sample and the files the generator must write for it
+fixture_dir = os.path.join(script_dir, "tests", "fixtures", "regression")
+
+
+def csv_rows(csv_path):
+    with open(csv_path, "rb") as f:
+        return sum(1 for _ in f)
+
+
+def run_generator(script, csv_path, workdir, seed, *options):
+    """Run a Products.py script in workdir and return the paths of the compared files."""
+    os.makedirs(workdir, exist_ok=True)
+    command = [
+        sys.executable, script,
+        "--csv", csv_path, "--output", "Products.ttl", "--shacl", "Shacl_shapes.ttl", "--seed", str(seed),
+        *options,
+    ]
+    # Every output of the run, like the manifest and the search index, is written to workdir
+    subprocess.run(command, cwd=workdir, check=True, stdout=subprocess.DEVNULL)
+    return [os.path.join(workdir, name) for name in compared_files]
+
+
+def first_difference(expected_path, actual_path, newlines=True):
+    """Return the line number and the two lines where two files first differ, or None if they are equal.
+
+    Unless newlines is true, CRLF and LF line ends are taken as equal.
+    """
+    with open(expected_path, "rb") as expected, open(actual_path, "rb") as actual:
+        number = 0
+        while True:
+            number += 1
+            left, right = expected.readline(), actual.readline()
+            if not newlines:
+                left, right = left.replace(b"\r\n", b"\n"), right.replace(b"\r\n", b"\n")
+            if left != right:
+                return number, left, right
+            if not left:
+                return None
+
+
+def runs(csv_path, seed, baseline_script=None):
+    """Return the name, script and options of every run, the baseline first."""
+    one_chunk = ["--chunksize", str(csv_rows(csv_path) + 1)]
+    script = os.path.join(script_dir, "Products.py")
+    result = [("baseline", baseline_script or script, one_chunk)]
+    if baseline_script:
+        result.append(("current", script, one_chunk))
+    for size in streamed_chunk_sizes:
+        result.append((f"chunksize {size}", script, ["--chunksize", str(size)]))
+    result.append((f"{streamed_workers} workers", script,
+                   ["--chunksize", str(streamed_chunk_sizes[-1]), "--workers", str(streamed_workers)]))
+    result.append(("stdlib engine", script, ["--chunksize", str(streamed_chunk_sizes[-1]), "--engine", "stdlib"]))
+    return result
+
+
+def compare(name, expected, paths, newlines=True):
+    """Print how the files of a run differ from the expected ones, return 1 if they do and 0 if not."""
+    differences = [(path, first_difference(left, path, newlines)) for left, path in zip(expected, paths)]
+    differences = [(path, difference) for path, difference in differences if difference]
+    if not differences:
+        print(f"{name}: identical")
+        return 0
+    for path, (line, left, right) in differences:
+        print(f"{name}: {os.path.basename(path)} differs at line {line}")
+        print(f"  expected: {left!r}")
+        print(f"  {name}: {right!r}")
+    return 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check that the streamed output of Products.py matches a one-chunk run.")
+    parser.add_argument("--csv", default=os.path.join(script_dir, "Products.csv"), help="input CSV file")
+    parser.add_argument("--seed", type=int, default=default_seed, help="--seed passed to every run")
+    parser.add_argument("--baseline-script", default=None, help="other Products.py script run as the baseline")
+    parser.add_argument("--workdir", default=None, help="keep the generated files in this folder")
+    parser.add_argument("--expected", default=None,
+                        help="folder with the Products.csv to read and the files the baseline must write, "
+                             f"like {fixture_dir}")
+    parser.add_argument("--update", action="store_true", help="save the files of the baseline in the --expected folder")
+    args = parser.parse_args(argv)
+    if args.update and not args.expected:
+        parser.error("--update needs --expected")
+
+    csv_path = os.path.abspath(os.path.join(args.expected, "Products.csv") if args.expected else args.csv)
+    baseline_script = os.path.abspath(args.baseline_script) if args.baseline_script else None
+    workdir = args.workdir or tempfile.mkdtemp(prefix="products-regression-")
+    failures = 0
+    try:
+        expected = None
+        for number, (name, script, options) in enumerate(runs(csv_path, args.seed, baseline_script)):
+            paths = run_generator(script, csv_path, os.path.join(workdir, str(number)), args.seed, *options)
+            if expected is None:
+                expected = paths
+                print(f"{name}: {', '.join(f'{os.path.getsize(path)} bytes' for path in paths)}")
+                if args.update:
+                    for path in paths:
+                        shutil.copyfile(path, os.path.join(args.expected, os.path.basename(path)))
+                    print(f"Saved in {args.expected}")
+                elif args.expected:
+                    failures += compare(name, [os.path.join(args.expected, os.path.basename(path))
+                                                for path in paths], paths, newlines=False)
+                continue
+            failures += compare(name, expected, paths)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    print(f"{failures} runs differ from the baseline" if failures else "All runs match the baseline")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
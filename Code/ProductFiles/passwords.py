@@ -0,0 +1,61 @@
+"""
+Salted password hashes for the :hasPassword of the catalog users.
+
+A password is stored as one string literal holding a PBKDF2-HMAC-SHA256 hash, its iterations and a
+random 16-byte salt, the salt and hash in base64:
+
+    pbkdf2_sha256$600000$<salt>$<hash>
+
+Checking a password costs as much as hashing it, a few hundred milliseconds of CPU on purpose, so a
+stolen catalog cannot be brute-forced cheaply. hashlib releases the GIL while it hashes, so passwords
+can be checked in a thread pool next to a running service (see auth_service.py).
+
+verify_password() only accepts hashes. A plaintext :hasPassword, like the ones Products.py generates so
+that logins also work on GraphDB, is only checked by verify_plaintext() to replace it by its hash at the
+next login of its user (see auth_service.py).
+"""
+
+import base64
+import hashlib
+import hmac
+import os
+
+# Name of the hash in the stored string
+algorithm = "pbkdf2_sha256"
+
+# PBKDF2 iterations of new hashes, the OWASP recommendation for PBKDF2-HMAC-SHA256
+hash_iterations = 600_000
+
+salt_bytes = 16
+
+
+def _b64(data):
+    return base64.b64encode(data).decode("ascii")
+
+
+def hash_password(password, salt=None, iterations=hash_iterations):
+    """Return the stored form of a password, with a random salt unless one is given."""
+    salt = os.urandom(salt_bytes) if salt is None else salt
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+    return f"{algorithm}${iterations}${_b64(salt)}${_b64(digest)}"
+
+
+def is_password_hash(stored):
+    return stored.startswith(algorithm + "$")
+
+
+def verify_password(password, stored):
+    """Return whether a password matches its stored hash. A stored value that is not a hash never matches."""
+    if not is_password_hash(stored):
+        return False
+    try:
+        _, iterations, salt, digest = stored.split("$")
+        iterations, salt, digest = int(iterations), base64.b64decode(salt), base64.b64decode(digest)
+    except ValueError:
+        return False
+    return hmac.compare_digest(hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations), digest)
+
+
+def verify_plaintext(password, stored):
+    """Return whether a password matches a :hasPassword stored in plaintext, in constant time."""
+    return not is_password_hash(stored) and hmac.compare_digest(password.encode("utf-8"), stored.encode("utf-8"))
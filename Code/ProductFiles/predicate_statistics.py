@@ -0,0 +1,100 @@
+"""
+Per-predicate cardinality statistics of the catalog, collected by Products.py while it writes the data.
+
+The query planner of the local SPARQL service (see query_planner.py) orders the triple patterns of a
+query by the number of rows every pattern gives. The store counts the triples of a predicate, or of
+a predicate and one subject or object, from its indexes, but not how many distinct subjects and
+objects a predicate has, which is what tells how many triples one subject or object bound by an
+earlier pattern matches. PredicateStatistics keeps, for every predicate:
+
+- triples: the number of triples
+- subjects: the number of distinct subjects
+- objects: the number of distinct objects
+
+The statistics of every chunk of products are computed where the chunk is rendered and merged in
+CSV order. Chunks hold different products, so their subjects add up. Their objects are merged
+exactly while a predicate has at most exact_objects of them (classes, stock, availability) and added
+up past that, which keeps ids and names, nearly unique anyway, out of memory. The counts are
+estimates for planning, the service does not depend on them being exact or up to date.
+
+The statistics are saved as JSON ('Products.stats.json').
+"""
+
+import json
+
+from lazy_modules import lazy_import
+
+np = lazy_import("numpy")
+
+# Most distinct objects of a predicate merged exactly between chunks
+exact_objects = 4096
+
+
+class PredicateStatistics:
+    """Triples, distinct subjects and distinct objects of every predicate, by predicate IRI."""
+
+    def __init__(self, predicates=None):
+        # predicate IRI -> {"triples": ..., "subjects": ..., "objects": ...}
+        self.predicates = dict(predicates or {})
+        # The distinct objects of the predicates that have at most exact_objects of them
+        self.values = {}
+
+    def __len__(self):
+        return len(self.predicates)
+
+    def get(self, predicate):
+        """Return the counts of a predicate IRI as a dict, or None if it has no statistics."""
+        return self.predicates.get(str(predicate))
+
+    @classmethod
+    def of(cls, builder):
+        """Compute the statistics of the triples of a TripleBuilder."""
+        statistics = cls()
+        if not len(builder):
+            return statistics
+        subjects = np.frombuffer(builder.subjects, dtype=np.int64)
+        predicates = np.frombuffer(builder.predicates, dtype=np.int64)
+        objects = np.frombuffer(builder.objects, dtype=np.int64)
+        for predicate in np.unique(predicates):
+            is_predicate = predicates == predicate
+            values = np.unique(objects[is_predicate])
+            iri = builder.terms[predicate]
+            statistics.predicates[iri] = {
+                "triples": int(is_predicate.sum()),
+                "subjects": len(np.unique(subjects[is_predicate])),
+                "objects": len(values),
+            }
+            if len(values) <= exact_objects:
+                statistics.values[iri] = {builder.terms[value] for value in values}
+        return statistics
+
+    def merge(self, other):
+        """Add the statistics of other, those of different triples, to these ones."""
+        for iri, counts in other.predicates.items():
+            mine = self.predicates.get(iri)
+            if mine is None:
+                self.predicates[iri] = dict(counts)
+                if iri in other.values:
+                    self.values[iri] = set(other.values[iri])
+                continue
+            mine["triples"] += counts["triples"]
+            mine["subjects"] += counts["subjects"]
+            values = self.values.get(iri)
+            if values is not None and iri in other.values:
+                values |= other.values[iri]
+                mine["objects"] = len(values)
+                if len(values) > exact_objects:
+                    del self.values[iri]
+            else:
+                mine["objects"] += counts["objects"]
+                self.values.pop(iri, None)
+
+    def write(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"predicates": self.predicates}, f, indent=1, sort_keys=True)
+
+    @classmethod
+    def load(cls, path):
+        """Read statistics saved by write()."""
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f)["predicates"])
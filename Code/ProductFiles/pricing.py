@@ -0,0 +1,126 @@
+"""
+Discount rules applied to whole columns of products, instead of a random discount drawn per product.
+
+:hasDiscountPrice holds a discount percentage (ProductDetails.js shows price - price * discount / 100).
+A PricingEngine computes it for a chunk of products in one vectorized pass:
+
+- a rule gives a discount to every product of a category, subcategory, type or brand, either as a
+  percentage or as a fixed amount off the price, which becomes the percentage of that price
+- when several rules match a product the most specific one wins, in the order of rule_fields: a brand
+  rule over a type rule over a subcategory rule over a category rule
+- the products no rule matches get a default discount, picked from default_choices by a CRC-32 of the
+  seed and their product id, so a product keeps its discount from one generation to the next whatever
+  rows are added, removed or reordered around it
+
+Discounts are clipped to 0..100 and rounded to 2 decimals. discounts() works on the DataFrame chunks
+of the pandas path and discount() on the rows of the csv module path of Products.py, and both give the
+same values.
+
+Rules are read from a CSV file with the columns field, value, kind (percent or fixed) and amount:
+
+    field,value,kind,amount
+    category,Fruit and Vegetables,percent,10
+    brand,Fuji Farms,fixed,0.5
+"""
+
+import csv
+import zlib
+from collections import namedtuple
+
+from lazy_modules import lazy_import
+
+np = lazy_import("numpy")
+
+# Default discounts, in percent, of the products without a rule
+default_choices = [0, 5, 10, 15, 20, 25, 30]
+default_seed = 0
+
+# Product fields rules can match, the later ones win over the earlier ones
+rule_fields = ["category", "subcategory", "type", "brand"]
+rule_kinds = ["percent", "fixed"]
+
+Rule = namedtuple("Rule", "field value kind amount")
+
+
+def load_rules(path):
+    """Read the discount rules of a CSV file, raising ValueError with the row of an invalid rule."""
+    rules = []
+    with open(path, newline="", encoding="utf-8") as f:
+        reader = csv.DictReader(f)
+        missing = set(Rule._fields).difference(reader.fieldnames or [])
+        if missing:
+            raise ValueError(f"{path}: missing columns {', '.join(sorted(missing))}")
+        for row_number, row in enumerate(reader, 1):
+            if row['field'] not in rule_fields:
+                raise ValueError(f"{path} row {row_number}: unknown field {row['field']!r}, "
+                                 f"expected one of {', '.join(rule_fields)}")
+            if row['kind'] not in rule_kinds:
+                raise ValueError(f"{path} row {row_number}: unknown kind {row['kind']!r}, expected percent or fixed")
+            try:
+                amount = float(row['amount'])
+            except (TypeError, ValueError):
+                amount = None
+            if amount is None or not 0 <= amount < float("inf"):
+                raise ValueError(f"{path} row {row_number}: amount {row['amount']!r} is not a number >= 0")
+            rules.append(Rule(row['field'], row['value'], row['kind'], amount))
+    return rules
+
+
+def _text(column):
+    """Convert a column to strings the way Products.py does, missing values included."""
+    return column.astype(str).fillna("nan")
+
+
+class PricingEngine:
+    """Computes the discount percentages of products from rules and a seeded default."""
+
+    def __init__(self, rules=(), seed=None, choices=default_choices):
+        self.rules = list(rules)
+        self.seed = default_seed if seed is None else seed
+        self.choices = [float(choice) for choice in choices]
+        # Later rules for the same field and value replace earlier ones
+        self.tables = {field: {} for field in rule_fields}
+        for rule in self.rules:
+            self.tables[rule.field][rule.value] = rule
+
+    def _default_index(self, product_id):
+        return zlib.crc32(product_id.encode("utf-8"), self.seed & 0xFFFFFFFF) % len(self.choices)
+
+    def default_discounts(self, ids):
+        """Return the default discounts of a sequence of product ids as a float64 array."""
+        indexes = np.fromiter((self._default_index(product_id) for product_id in ids), dtype=np.int64, count=len(ids))
+        return np.asarray(self.choices, dtype="float64")[indexes]
+
+    def discounts(self, chunk):
+        """Return the discounts of a DataFrame of products, with the columns of Products.csv, as a float64 array."""
+        result = self.default_discounts(_text(chunk['id']).to_numpy())
+        price = chunk['price'].to_numpy(dtype="float64")
+        for field in rule_fields:
+            table = self.tables[field]
+            if not table:
+                continue
+            values = _text(chunk[field])
+            for kind in rule_kinds:
+                amounts = values.map({value: rule.amount for value, rule in table.items() if rule.kind == kind})
+                amounts = amounts.to_numpy(dtype="float64", na_value=np.nan)
+                matched = ~np.isnan(amounts)
+                if kind == "fixed":
+                    # The same operations as discount(), so both paths round the same way
+                    amounts = np.where(price > 0, np.divide(amounts, price, where=price > 0,
+                                                            out=np.zeros_like(amounts)) * 100, 0.0)
+                result[matched] = amounts[matched]
+        return np.round(np.clip(result, 0, 100), 2)
+
+    def discount(self, row):
+        """Return the discount of one product, given as a dict of the text values of its CSV fields."""
+        result = self.choices[self._default_index(row['id'])]
+        for field in rule_fields:
+            rule = self.tables[field].get(row[field])
+            if rule is None:
+                continue
+            if rule.kind == "percent":
+                result = rule.amount
+            else:
+                price = float(row['price'])
+                result = rule.amount / price * 100 if price > 0 else 0.0
+        return round(min(max(result, 0.0), 100.0) * 100) / 100
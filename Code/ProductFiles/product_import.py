@@ -0,0 +1,246 @@
+"""
+Bulk product import for the local SPARQL service, instead of one product at a time from InsertProducts.js.
+
+InsertProducts.js runs four queries to fill its form (the categories, subcategories and types, and
+MAX() of the product ids) and then posts one INSERT DATA per product, so onboarding the thousand
+products of a supplier takes thousands of round trips. ProductImport takes a whole CSV file with the
+columns of Products.csv (id,name,category,subcategory,type,price,brand,quantity):
+
+- every row is checked before anything is written: missing values, ids and instance names already
+  used in the store or by an earlier row, and the SHACL shapes of the store on the same triples
+  Products.py generates. Rows with problems are reported with their 1-based CSV row and left out.
+- rows with an empty id get the ids after the highest product id, allocated as one block
+- categories, subcategories and pto: types that are not in the store yet are created like
+  Products.py creates them, and the :productCount of every class is increased
+- the products are written in batches of batch_size products, the triples an INSERT DATA of the
+  batch would add. Every batch is one change on the store thread, validated and rolled back whole
+  like an update of /statements, and queries are still answered between two batches. progress is
+  updated after every batch, and the products and batches imported are counted for the metrics.
+
+The batches are added as triples rather than as SPARQL text: rdflib takes minutes to translate an
+INSERT DATA of a thousand products, it reorders the triples of the block pairwise.
+
+Discounts come from a PricingEngine, like in Products.py.
+"""
+
+import asyncio
+import io
+import time
+
+import pandas as pd
+from rdflib import RDFS, XSD, Literal, URIRef
+
+from catalog_store import catalog_namespaces
+from order_service import HAS_PRODUCT_ID
+from pricing import PricingEngine
+from Products import _text, class_statements, csv_dtypes, instance_names, instance_triples, namespaces, product_counts
+from triples import TripleBuilder
+
+base = catalog_namespaces[""]
+PRODUCT_OR_SERVICE = URIRef(catalog_namespaces["gr"] + "ProductOrService")
+PRODUCT_COUNT = URIRef(base + "productCount")
+
+# Products written by one batch
+import_batch_size = 1000
+
+# Columns of an import file, the ones of Products.csv
+import_columns = ['id', *csv_dtypes]
+
+
+class ProductImportError(ValueError):
+    """A CSV file that cannot be imported at all, the message says why."""
+
+
+def read_import(text):
+    """Read the text of an import CSV file into a DataFrame of text columns, missing values as NaN."""
+    try:
+        chunk = pd.read_csv(io.StringIO(text), dtype=str)
+    except (ValueError, pd.errors.EmptyDataError) as error:
+        raise ProductImportError(f"Invalid CSV file: {error}")
+    missing = [column for column in import_columns if column not in chunk.columns]
+    if missing:
+        raise ProductImportError(f"Missing columns: {', '.join(missing)}")
+    chunk = chunk[import_columns].reset_index(drop=True)
+    chunk['id'] = chunk['id'].str.strip()
+    return chunk
+
+
+def _max_id(graph):
+    """Return the highest integer product id of the store, 0 if there is none."""
+    numbers = (str(value) for value in graph.objects(None, HAS_PRODUCT_ID))
+    return max((int(number) for number in numbers if number.isdigit()), default=0)
+
+
+class ProductImport:
+    """Imports CSV files of products into a catalog graph.
+
+    plan() and write() run on the store thread, run() does a whole import from the event loop.
+    """
+
+    def __init__(self, graph, executor, apply, validator=None, pricing=None, batch_size=import_batch_size):
+        self.graph = graph
+        self.executor = executor
+        # Called on the store thread with the triples to add and to remove, like SparqlService.write_triples
+        self.apply = apply
+        self.validator = validator
+        self.pricing = PricingEngine() if pricing is None else pricing
+        self.batch_size = batch_size
+        self.progress = {"state": "idle"}
+        # Totals of every import, for the metrics of the service
+        self.imported = 0
+        self.batches = 0
+
+    def _new_classes(self, chunk):
+        """Return the category, subcategory and type classes of the rows that are not in the store yet."""
+        graph = self.graph
+        categories = []
+        subcategories = []
+        types = []
+        for category, subcategory, type_name in dict.fromkeys(
+                chunk[['category', 'subcategory', 'type']].itertuples(index=False, name=None)):
+            category_uri = URIRef(base + category.replace(" ", "_"))
+            subcategory_uri = URIRef(base + subcategory.replace(" ", "_"))
+            type_uri = URIRef(catalog_namespaces["pto"] + type_name.replace(" ", "_"))
+            if (category_uri, RDFS.subClassOf, PRODUCT_OR_SERVICE) not in graph and category not in categories:
+                categories.append(category)
+            if (subcategory_uri, RDFS.subClassOf, category_uri) not in graph:
+                subcategories.append((subcategory, category))
+            if (type_uri, RDFS.subClassOf, subcategory_uri) not in graph:
+                types.append((type_name, subcategory))
+        return categories, list(dict.fromkeys(subcategories)), list(dict.fromkeys(types))
+
+    def plan(self, text):
+        """Check the rows of a CSV file and allocate the ids of the accepted ones.
+
+        Return a dict with the accepted rows and their discounts, the statements and the number of the
+        new classes, the rejected rows as {"row": ..., "problems": [...]} dicts and the first and last
+        allocated id.
+        """
+        chunk = read_import(text)
+        graph = self.graph
+        problems = {}
+
+        def reject(position, problem):
+            problems.setdefault(position, []).append(problem)
+
+        required = [column for column in import_columns if column != 'id']
+        empty = chunk[required].isna().to_numpy()
+        for position in empty.any(axis=1).nonzero()[0]:
+            columns = [column for column, is_empty in zip(required, empty[position]) if is_empty]
+            reject(position, f"missing {', '.join(columns)}")
+        price = pd.to_numeric(chunk['price'], errors="coerce")
+        for position in (price.isna() & chunk['price'].notna()).to_numpy().nonzero()[0]:
+            reject(position, f"price {chunk['price'][position]!r} is not a number")
+        chunk['price'] = price
+
+        ids = {}
+        for position, product_id in chunk['id'].items():
+            if pd.isna(product_id) or not product_id:
+                continue
+            if product_id in ids:
+                reject(position, f"id {product_id!r} is used by row {ids[product_id] + 1}")
+            elif graph.value(None, HAS_PRODUCT_ID, Literal(product_id)) is not None:
+                reject(position, f"id {product_id!r} is used by an existing product")
+            ids.setdefault(product_id, position)
+
+        names = {}
+        for position, local in instance_names(_text(chunk['name'])).items():
+            if position in problems:
+                continue
+            if local in names:
+                reject(position, f"name {chunk['name'][position]!r} is the instance of row {names[local] + 1} too")
+            elif (URIRef(base + local), None, None) in graph:
+                reject(position, f"name {chunk['name'][position]!r} is the instance :{local} of an existing product")
+            names.setdefault(local, position)
+
+        accepted = chunk.drop(index=list(problems))
+        discounts = self.pricing.discounts(accepted)
+        if self.validator is not None and len(accepted):
+            # The classes of the rows tell the validator that they are products
+            classes = TripleBuilder(namespaces)
+            classes.add_turtle("\n".join(class_statements(
+                accepted['category'].unique(),
+                dict.fromkeys(accepted[['subcategory', 'category']].itertuples(index=False, name=None)),
+                dict.fromkeys(accepted[['type', 'subcategory']].itertuples(index=False, name=None)),
+            )))
+            self.validator.learn(classes)
+            report = self.validator.check(instance_triples(accepted, discounts), accepted.index.to_numpy() + 1)
+            for violation in report.violations:
+                reject(violation.row - 1, f"{violation.path} {violation.constraint}: {violation.value}")
+            is_valid = ~accepted.index.isin(list(problems))
+            accepted, discounts = accepted[is_valid], discounts[is_valid]
+
+        # One block of ids after the highest id of the store and of the file
+        accepted = accepted.copy()
+        missing_id = (accepted['id'].isna() | (accepted['id'] == "")).to_numpy()
+        allocated = [None, None]
+        if missing_id.any():
+            first = max([_max_id(graph), *(int(product_id) for product_id in ids if product_id.isdigit())]) + 1
+            last = first + int(missing_id.sum()) - 1
+            accepted.loc[missing_id, 'id'] = [str(number) for number in range(first, last + 1)]
+            allocated = [str(first), str(last)]
+
+        new_classes = self._new_classes(accepted)
+        return {
+            "rows": accepted,
+            "discounts": discounts,
+            "classes": class_statements(*new_classes),
+            "newClasses": sum(map(len, new_classes)),
+            "rejected": [{"row": int(position) + 1, "problems": problems[position]} for position in sorted(problems)],
+            "allocated": allocated,
+        }
+
+    def write(self, rows, discounts, new_classes=()):
+        """Add a batch of rows and the statements of new classes to the store, and count them in :productCount."""
+        builder = TripleBuilder(namespaces)
+        if new_classes:
+            builder.add_turtle("\n".join(new_classes))
+        instance_triples(rows, discounts, builder)
+        added = list(builder.rdf_triples())
+        removed = []
+        counts = product_counts([(*classes, 1) for classes in
+                                 rows[['category', 'subcategory', 'type']].itertuples(index=False, name=None)])
+        for class_uri, count in counts.items():
+            class_uri = URIRef(class_uri)
+            old = self.graph.value(class_uri, PRODUCT_COUNT)
+            if old is not None:
+                removed.append((class_uri, PRODUCT_COUNT, old))
+            added.append((class_uri, PRODUCT_COUNT, Literal(str(int(old or 0) + count), datatype=XSD.integer)))
+        self.apply(added, removed)
+
+    async def run(self, text):
+        """Import the products of a CSV file, batch by batch on the store thread, and return a summary.
+
+        If a batch fails, the batches before it stay imported and the summary gives the error.
+        """
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        self.progress = {"state": "checking"}
+        try:
+            plan = await loop.run_in_executor(self.executor, self.plan, text)
+        except Exception:
+            self.progress = {"state": "failed"}
+            raise
+        rows, discounts = plan["rows"], plan["discounts"]
+        batches = -(-len(rows) // self.batch_size)
+        self.progress = {"state": "importing", "products": len(rows), "imported": 0, "batches": batches, "written": 0,
+                         "rejected": len(plan["rejected"])}
+        summary = {"rows": len(rows) + len(plan["rejected"]), "imported": 0, "rejected": plan["rejected"],
+                   "newClasses": 0, "allocatedIds": plan["allocated"]}
+        for batch in range(batches):
+            part = slice(batch * self.batch_size, (batch + 1) * self.batch_size)
+            # The new classes are added with the first batch
+            try:
+                await loop.run_in_executor(self.executor, self.write, rows.iloc[part], discounts[part],
+                                           plan["classes"] if batch == 0 else ())
+            except Exception as error:
+                summary["error"] = f"Batch {batch + 1} of {batches}: {error}"
+                break
+            summary["imported"] += len(rows.iloc[part])
+            summary["newClasses"] = plan["newClasses"]
+            self.progress.update(imported=summary["imported"], written=batch + 1)
+            self.imported += len(rows.iloc[part])
+            self.batches += 1
+        summary["seconds"] = round(time.perf_counter() - start, 3)
+        self.progress["state"] = "failed" if "error" in summary else "done"
+        return summary
@@ -0,0 +1,208 @@
+"""
+A columnar snapshot of the flat product fields, written by Products.py next to Products.ttl.
+
+Listing, sorting and pricing pages only need the fields every product instance has: id, name, brand,
+price, discount, quantity, stock, availability and its category, subcategory and type. Getting them
+back out of SPARQL bindings means parsing the catalog and a query per page, so the generator also
+writes them column by column:
+
+- price, discount and stock are float64 and int64 arrays, availability a bool array
+- id, instance, name, brand and quantity are UTF-8 data with int64 offsets, like the instance names
+  of the search index
+- category, subcategory and type are dictionary-encoded: a uint32 code per product and the sorted
+  distinct values, so filtering on them compares integers and sorting by them sorts the codes
+
+The file has the layout of the search index (see write_arrays in search_index.py), so ProductSnapshot
+memory-maps it and every column is a read-only numpy view of the file, without copying or parsing
+anything at startup. Filters, sorts and pages are numpy operations on those views, only the rows of a
+returned page are decoded.
+"""
+
+import numpy as np
+import pandas as pd
+
+from search_index import map_arrays, write_arrays
+
+# Bytes at the start of every snapshot file
+magic = b"PSNAPSH1"
+
+# Columns of a snapshot by kind: fixed-size numbers, variable-length text and dictionary-encoded text
+number_columns = {"price": "float64", "discount": "float64", "stock": "int64", "available": "bool"}
+text_columns = ["id", "instance", "name", "brand", "quantity"]
+dictionary_columns = ["category", "subcategory", "type"]
+
+
+def _encode(values):
+    """Return the UTF-8 data and the int64 offsets of a column of strings."""
+    encoded = pd.Series(values, dtype=object).astype(str).str.encode("utf-8")
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum(encoded.str.len().to_numpy(dtype=np.int64), out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+class _Dictionary:
+    """Collects the codes of a dictionary-encoded column chunk by chunk."""
+
+    def __init__(self):
+        self.ids = {}
+        self.codes = []
+
+    def add(self, values):
+        codes, uniques = pd.factorize(pd.Series(values, dtype=object).astype(str))
+        ids = np.fromiter((self.ids.setdefault(value, len(self.ids)) for value in uniques), dtype=np.uint32,
+                          count=len(uniques))
+        self.codes.append(ids[codes])
+
+    def arrays(self):
+        """Return the codes renumbered in the order of the sorted values, and the sorted values."""
+        values = np.array(list(self.ids), dtype=object)
+        order = np.argsort(values, kind="stable")
+        rank = np.empty(len(values), dtype=np.uint32)
+        rank[order] = np.arange(len(values), dtype=np.uint32)
+        codes = rank[np.concatenate(self.codes)] if self.codes else np.zeros(0, dtype=np.uint32)
+        return codes, values[order]
+
+
+class SnapshotBuilder:
+    """Builds a product snapshot from chunks of products, in CSV order."""
+
+    def __init__(self):
+        self.count = 0
+        self.numbers = {column: [] for column in number_columns}
+        self.texts = {column: [] for column in text_columns}
+        self.dictionaries = {column: _Dictionary() for column in dictionary_columns}
+
+    def add(self, **columns):
+        """Add a chunk of products, given every column of the snapshot as a sequence of the chunk length."""
+        missing = set(number_columns).union(text_columns, dictionary_columns).difference(columns)
+        if missing:
+            raise ValueError(f"Missing snapshot columns: {', '.join(sorted(missing))}")
+        for column, dtype in number_columns.items():
+            self.numbers[column].append(np.asarray(columns[column], dtype=dtype))
+        for column in text_columns:
+            self.texts[column].append(pd.Series(columns[column], dtype=object).astype(str).to_numpy(dtype=object))
+        for column in dictionary_columns:
+            self.dictionaries[column].add(columns[column])
+        self.count += len(self.numbers["price"][-1])
+
+    def write(self, path):
+        """Write the snapshot file."""
+        arrays = {}
+        for column, dtype in number_columns.items():
+            parts = self.numbers[column]
+            arrays[column] = np.concatenate(parts) if parts else np.zeros(0, dtype=dtype)
+        for column in text_columns:
+            parts = self.texts[column]
+            values = np.concatenate(parts) if parts else np.zeros(0, dtype=object)
+            arrays[f"{column}_data"], arrays[f"{column}_offsets"] = _encode(values)
+        for column in dictionary_columns:
+            arrays[column], values = self.dictionaries[column].arrays()
+            arrays[f"{column}_values_data"], arrays[f"{column}_values_offsets"] = _encode(values)
+        write_arrays(path, magic, arrays, count=self.count)
+
+
+class ProductSnapshot:
+    """A memory-mapped product snapshot file.
+
+    Rows are product positions in CSV order. select() returns the rows matching filters, sort() orders
+    rows by a column and page() slices them, all without decoding text; records() decodes a page.
+    """
+
+    def __init__(self, path):
+        self._map, header, self.arrays = map_arrays(path, magic)
+        self.count = header["count"]
+        # The distinct values are few, decode them once
+        self.values = {
+            column: [self._decode(f"{column}_values", i) for i in range(len(self.arrays[f"{column}_values_offsets"]) - 1)]
+            for column in dictionary_columns
+        }
+        self._codes = {column: {value: code for code, value in enumerate(values)} for column, values in self.values.items()}
+
+    def __len__(self):
+        return self.count
+
+    def _decode(self, column, row):
+        offsets = self.arrays[f"{column}_offsets"]
+        return bytes(self.arrays[f"{column}_data"][offsets[row]:offsets[row + 1]]).decode("utf-8")
+
+    def column(self, column):
+        """Return the array of a number column, or the codes of a dictionary-encoded one."""
+        if column in number_columns or column in dictionary_columns:
+            return self.arrays[column]
+        raise KeyError(f"{column} is not a number or dictionary-encoded column")
+
+    def final_price(self, rows=None):
+        """Return the prices after the discount percentage, as ProductDetails.js shows them."""
+        price, discount = self.arrays["price"], self.arrays["discount"]
+        if rows is not None:
+            price, discount = price[rows], discount[rows]
+        return price - price * discount / 100
+
+    def text(self, column, row):
+        """Return the value of a text or dictionary-encoded column for one row."""
+        if column in dictionary_columns:
+            return self.values[column][self.arrays[column][row]]
+        return self._decode(column, row)
+
+    def codes(self, column, values):
+        """Return the codes of values of a dictionary-encoded column, leaving out unknown values."""
+        if isinstance(values, str):
+            values = [values]
+        codes = self._codes[column]
+        return np.array([codes[value] for value in values if value in codes], dtype=np.uint32)
+
+    def select(self, category=None, subcategory=None, type=None, available=None, min_price=None, max_price=None,
+               rows=None):
+        """Return the rows matching every filter given, in row order.
+
+        category, subcategory and type take a value or a list of values, prices bound the final price.
+        rows restricts the selection to some rows, like the candidates of a search.
+        """
+        mask = np.ones(self.count, dtype=bool) if rows is None else np.zeros(self.count, dtype=bool)
+        if rows is not None:
+            mask[rows] = True
+        for column, values in (("category", category), ("subcategory", subcategory), ("type", type)):
+            if values is not None:
+                mask &= np.isin(self.arrays[column], self.codes(column, values))
+        if available is not None:
+            mask &= self.arrays["available"] == bool(available)
+        if min_price is not None or max_price is not None:
+            final = self.final_price()
+            if min_price is not None:
+                mask &= final >= min_price
+            if max_price is not None:
+                mask &= final <= max_price
+        return np.flatnonzero(mask)
+
+    def sort(self, rows, by="price", descending=False):
+        """Return rows ordered by a number column, a dictionary-encoded column or "final_price".
+
+        The sort is stable, so rows with the same value keep their order.
+        """
+        keys = self.final_price(rows) if by == "final_price" else self.column(by)[rows]
+        if descending:
+            # Reverse, sort stably and reverse back, so ties still keep their row order
+            order = np.argsort(keys[::-1], kind="stable")[::-1]
+            return rows[len(rows) - 1 - order]
+        return rows[np.argsort(keys, kind="stable")]
+
+    @staticmethod
+    def page(rows, number=1, size=50):
+        """Return the rows of a 1-based page, a view of rows."""
+        start = max(number - 1, 0) * size
+        return rows[start:start + size]
+
+    def records(self, rows):
+        """Decode the fields of some rows, like the bindings the listing pages read."""
+        return [
+            {
+                **{column: self._decode(column, row) for column in text_columns},
+                **{column: self.text(column, row) for column in dictionary_columns},
+                **{column: self.arrays[column][row].item() for column in number_columns},
+            }
+            for row in rows
+        ]
+
+    def close(self):
+        self.arrays.clear()
+        self._map.close()
@@ -0,0 +1,244 @@
+"""
+A result cache for the SPARQL queries of the local service, invalidated by the updates that change them.
+
+The pages of the React app send the same few queries over and over (the product list of a category,
+the dashboard counts, the cart prices), while updates are rare and only touch a few properties: a
+checkout changes :hasStock and :isAvailable and adds orders, the admin page changes :hasPrice. So the
+serialized results are kept in a bounded LRU cache:
+
+- The key is the query text with comments dropped and whitespace collapsed outside strings and IRIs,
+  plus the Accept header, so the same query sent by two pages or reformatted hits the same entry.
+- The cache holds at most max_entries results and max_bytes of serialized results, the least recently
+  used ones are evicted first. Results bigger than max_entry_bytes are not cached.
+- Every entry remembers the predicates its query reads, taken from the triple patterns of the query
+  algebra. For rdf:type patterns with a class the class is remembered too, so placing an order does
+  not drop every cached `?product a pto:Milk`. An update only drops the entries that read a predicate
+  it writes. Queries with a variable predicate depend on everything, and so do updates like CLEAR or
+  LOAD that do not say which predicates they write.
+"""
+
+import re
+import threading
+from collections import OrderedDict
+
+from rdflib import RDF, URIRef
+from rdflib.paths import AlternativePath, InvPath, MulPath, NegatedPath, SequencePath
+from rdflib.plugins.sparql.parserutils import CompValue
+
+# Default limits of the cache
+max_entries = 1024
+max_bytes = 64 << 20
+
+# Strings and IRIs are kept as they are, comments and runs of whitespace become one space
+_query_token = re.compile(r'''
+    ("""(?:[^"\\]|\\.|"(?!""))*"""
+    |\'\'\'(?:[^'\\]|\\.|'(?!''))*\'\'\'
+    |"(?:[^"\\\n]|\\.)*"
+    |'(?:[^'\\\n]|\\.)*'
+    |<[^<>"{}|^`\\\s]*>)
+    |(?:\s|\#[^\n]*)+
+''', re.VERBOSE)
+
+# Algebra nodes whose triples are not known until the query runs
+_opaque = ("DescribeQuery", "ServiceGraphPattern")
+
+
+def normalize_query(text):
+    """Drop comments and collapse whitespace outside strings and IRIs."""
+    return _query_token.sub(lambda match: match.group(1) or " ", text).strip()
+
+
+def _path_predicates(path):
+    """Return the predicates of a property path, or None when it can match any predicate."""
+    if isinstance(path, URIRef):
+        return {path}
+    if isinstance(path, NegatedPath):
+        return None
+    if isinstance(path, (SequencePath, AlternativePath)):
+        parts = path.args
+    elif isinstance(path, InvPath):
+        parts = [path.arg]
+    elif isinstance(path, MulPath):
+        parts = [path.path]
+    else:
+        return None
+    predicates = set()
+    for part in parts:
+        part = _path_predicates(part)
+        if part is None:
+            return None
+        predicates |= part
+    return predicates
+
+
+def triple_keys(triples):
+    """Return the dependency keys of triple patterns, or None when they can touch any predicate.
+
+    A key is a predicate IRI, or (rdf:type, class) for a pattern with rdf:type and a class. Patterns
+    with rdf:type and a variable class have the key rdf:type, which every rdf:type write matches.
+    """
+    keys = set()
+    for _, predicate, value in triples:
+        if predicate == RDF.type:
+            keys.add((RDF.type, value) if isinstance(value, URIRef) else RDF.type)
+            continue
+        predicates = _path_predicates(predicate)
+        if predicates is None:
+            return None
+        keys |= predicates
+    return keys
+
+
+def query_keys(algebra):
+    """Return the dependency keys of the triple patterns of a query algebra, or None for any."""
+    keys = set()
+    stack = [algebra]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, CompValue):
+            if node.name in _opaque:
+                return None
+            if "triples" in node:
+                triples = triple_keys(node["triples"])
+                if triples is None:
+                    return None
+                keys |= triples
+            stack.extend(value for name, value in node.items() if name != "triples")
+        elif isinstance(node, dict):
+            stack.extend(node.values())
+        elif isinstance(node, (list, tuple)):
+            stack.extend(node)
+    return keys
+
+
+def update_keys(algebra):
+    """Return the keys an update can invalidate, or None when it can change any predicate."""
+    keys = set()
+    for operation in algebra:
+        if operation.name in ("InsertData", "DeleteData", "DeleteWhere"):
+            templates = [operation]
+        elif operation.name == "Modify":
+            templates = [operation.delete, operation.insert]
+        else:
+            return None
+        for template in templates:
+            if template is None:
+                continue
+            triples = list(template.triples or [])
+            for quads in (template.quads or {}).values():
+                triples.extend(quads)
+            written = triple_keys(triples)
+            if written is None:
+                return None
+            keys |= written
+    return write_keys(keys)
+
+
+def write_keys(keys):
+    """Add to the keys of written triples the rdf:type key, which class-less type patterns depend on.
+
+    A write of rdf:type with a variable class can add any class, so it can invalidate everything.
+    """
+    if keys is None or RDF.type in keys:
+        return None
+    if any(isinstance(key, tuple) for key in keys):
+        return keys | {RDF.type}
+    return keys
+
+
+class QueryCache:
+    """A bounded LRU cache of serialized query results with predicate-based invalidation.
+
+    get() is called from the event loop and put() and invalidate() from the store thread, so the
+    entries are guarded by a lock. A result is put on the store thread right after its query is
+    evaluated and an update invalidates right after it runs, so a result never outlives an update it
+    does not see.
+    """
+
+    def __init__(self, max_entries=max_entries, max_bytes=max_bytes, max_entry_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_bytes // 4 if max_entry_bytes is None else max_entry_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        # Keys of the entries by dependency key, and the entries that depend on everything
+        self.readers = {}
+        self.any_readers = set()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.skipped = 0
+
+    @staticmethod
+    def key(text, accept=""):
+        return normalize_query(text), accept.replace(" ", "").lower()
+
+    def get(self, key):
+        """Return the cached (media type, body) of a key, or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, keys):
+        """Cache a (media type, body) result whose query depends on keys (None for everything)."""
+        size = len(value[1])
+        if not self.max_entries or size > self.max_entry_bytes:
+            self.skipped += 1
+            return
+        with self.lock:
+            self._drop(key)
+            self.entries[key] = (value, keys)
+            self.size += size
+            if keys is None:
+                self.any_readers.add(key)
+            else:
+                for dependency in keys:
+                    self.readers.setdefault(dependency, set()).add(key)
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self._drop(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return False
+        (_, body), keys = entry
+        self.size -= len(body)
+        if keys is None:
+            self.any_readers.discard(key)
+        else:
+            for dependency in keys:
+                readers = self.readers[dependency]
+                readers.discard(key)
+                if not readers:
+                    del self.readers[dependency]
+        return True
+
+    def invalidate(self, keys):
+        """Drop the entries that depend on any of keys, or every entry when keys is None."""
+        with self.lock:
+            if keys is None:
+                stale = list(self.entries)
+            else:
+                stale = set(self.any_readers)
+                for dependency in keys:
+                    stale |= self.readers.get(dependency, set())
+            for key in stale:
+                self.invalidations += self._drop(key)
+
+    def clear(self):
+        self.invalidate(None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"entries": len(self.entries), "bytes": self.size, "maxEntries": self.max_entries,
+                "maxBytes": self.max_bytes, "hits": self.hits, "misses": self.misses,
+                "hitRate": round(self.hits / lookups, 4) if lookups else 0.0, "evictions": self.evictions,
+                "invalidations": self.invalidations, "uncacheable": self.skipped}
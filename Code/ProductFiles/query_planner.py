@@ -0,0 +1,617 @@
+"""
+Query planning for the local SPARQL service: the algebra rdflib translates a query to is rewritten
+before it is evaluated on the catalog store.
+
+rdflib evaluates a query the way it is written: a FILTER is tested on every row of the graph
+pattern under it, and the triple patterns of a group are only ordered by their number of bound
+terms. QueryPlanner.plan() rewrites a prepared query in three ways:
+
+- equality filters: FILTER(?x = <iri>), FILTER(?x = "text") and FILTER(sameTerm(?x, term)) over a
+  basic graph pattern become a binding of ?x the patterns are evaluated with, so
+  `?subcategory rdfs:subClassOf gr:ProductOrService . FILTER(?subcategory = base:Milk)` of
+  Products.js is an index lookup of base:Milk instead of every subclass filtered. Only IRIs and simple
+  literals are pushed for =, the terms that are equal to nothing but themselves.
+- join order: the patterns of a basic graph pattern are ordered greedily by the rows they are
+  estimated to give, the next pattern being the cheapest one sharing a variable with the patterns
+  before it. The store counts the triples of a predicate, alone or with a bound subject or object,
+  and the statistics Products.py collects (see predicate_statistics.py) tell how many distinct
+  subjects and objects a predicate has, so how many triples one bound subject or object matches.
+  The other filters are tested as soon as their variables are bound: the search of Header.js tests
+  the name of a product before joining its seven other properties.
+- aggregates: MAX and COUNT over patterns of the form `?s a :Class ; :predicate ?value`, optionally
+  with a BIND of ?value, like the MAX() of the product, order and order item ids InsertProducts.js and
+  Cart.js ask before every insert, and the COUNT() of the users of Account.js, are answered from
+  aggregates kept up to date with every write (see apply()) instead of reading all the ids.
+
+Anything else is left to rdflib as it is, so a query gives the same results with or without the
+planner. explain() shows the plan of a query: the rewritten algebra, the estimated rows of every
+triple pattern and the aggregates answered.
+"""
+
+from rdflib import RDF, XSD, BNode, Literal, URIRef, Variable
+from rdflib.plugins.sparql.evalutils import _eval, _val
+from rdflib.plugins.sparql.parserutils import CompValue, Expr
+from rdflib.plugins.sparql.sparql import FrozenBindings, Query, QueryContext, SPARQLError
+
+from predicate_statistics import PredicateStatistics
+
+# Share of the rows assumed to pass a FILTER that is not an equality
+filter_selectivity = 0.1
+
+# Expressions whose MAX is kept per aggregate, the least recently used one is dropped past this
+max_functions = 16
+
+# MAX of an expression that cannot be kept, because a value fails it or values cannot be ordered
+_unanswerable = object()
+
+
+def _is_variable(term):
+    return isinstance(term, (Variable, BNode))
+
+
+def _variables(value, found=None):
+    """Return the variables used by an expression or by triple patterns."""
+    found = set() if found is None else found
+    if isinstance(value, Variable):
+        found.add(value)
+    elif isinstance(value, CompValue):
+        for key, item in value.items():
+            if key != "_vars":
+                _variables(item, found)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            _variables(item, found)
+    return found
+
+
+def _pattern_variables(triples):
+    return {term for triple in triples for term in triple if _is_variable(term)}
+
+
+def _has_exists(expr):
+    """Whether an expression contains EXISTS or NOT EXISTS, which depend on every binding of the row."""
+    if isinstance(expr, CompValue):
+        return expr.name in ("Builtin_EXISTS", "Builtin_NOTEXISTS") or any(
+            _has_exists(item) for key, item in expr.items() if key != "_vars")
+    if isinstance(expr, (list, tuple)):
+        return any(_has_exists(item) for item in expr)
+    return False
+
+
+def _conjuncts(expr):
+    """Split an expression on &&."""
+    if isinstance(expr, CompValue) and expr.name == "ConditionalAndExpression":
+        return [part for item in [expr.expr, *(expr.other or [])] for part in _conjuncts(item)]
+    return [expr]
+
+
+def _equality(expr):
+    """Return (variable, term) if expr is only true when the variable is bound to that term, else None."""
+    if not isinstance(expr, CompValue):
+        return None
+    if expr.name == "RelationalExpression" and expr.op == "=":
+        pairs = [(expr.expr, expr.other), (expr.other, expr.expr)]
+        same_term = False
+    elif expr.name == "Builtin_sameTerm":
+        pairs = [(expr.arg1, expr.arg2), (expr.arg2, expr.arg1)]
+        same_term = True
+    else:
+        return None
+    for variable, term in pairs:
+        if not isinstance(variable, Variable):
+            continue
+        if isinstance(term, URIRef):
+            return variable, term
+        if isinstance(term, Literal):
+            # The store keeps "x"^^xsd:string as "x", and = compares other literals by value
+            if same_term and term.datatype != XSD.string:
+                return variable, term
+            if term.datatype is None and not term.language:
+                return variable, term
+    return None
+
+
+def _bound_variables(node):
+    """Return the variables a part of a query binds, for the estimates of the parts evaluated with its rows."""
+    if node.name == "ToMultiSet" and node.p.name == "values":
+        return {variable for row in node.p.res for variable in row}
+    return set(node.get("_vars") or ())
+
+
+def _components(triples):
+    """Split triple patterns into the groups connected by shared variables."""
+    groups = []
+    for triple in triples:
+        variables = _pattern_variables([triple])
+        joined = [group for group in groups if group[0] & variables]
+        merged = (set(variables), [triple])
+        for group in joined:
+            merged[0].update(group[0])
+            merged[1][:0] = group[1]
+            groups.remove(group)
+        groups.append(merged)
+    return [group[1] for group in groups]
+
+
+def _flatten(node, triples, extends):
+    """Collect the triple patterns and the BINDs of a group made only of those, return False for anything else."""
+    if node.name == "BGP":
+        triples.extend(node.triples)
+    elif node.name == "Join":
+        return _flatten(node.p1, triples, extends) and _flatten(node.p2, triples, extends)
+    elif node.name == "Extend":
+        if not _flatten(node.p, triples, extends):
+            return False
+        extends[node.var] = node.expr
+    else:
+        return False
+    return True
+
+
+def _shape(triples):
+    """Return (subject, class, predicate, value) of `?s a :Class ; :predicate ?value` patterns, class or
+    predicate and value being None when the pattern is missing, or None for any other group."""
+    types = [triple for triple in triples if triple[1] == RDF.type and isinstance(triple[2], URIRef)]
+    values = [triple for triple in triples if triple not in types]
+    if len(types) > 1 or len(values) > 1 or len(set(triples)) != len(triples):
+        return None
+    subject = triples[0][0]
+    if not isinstance(subject, Variable) or any(triple[0] != subject for triple in triples):
+        return None
+    cls = types[0][2] if types else None
+    if not values:
+        return subject, cls, None, None
+    _, predicate, value = values[0]
+    if not isinstance(predicate, URIRef) or not isinstance(value, Variable) or value == subject:
+        return None
+    return subject, cls, predicate, value
+
+
+class ValueAggregate:
+    """The values of one predicate, of the subjects of one class or of every subject, kept up to date.
+
+    For a class, the number of (subject, value) pairs is kept, for every subject the store counts
+    them itself. The MAX of an expression of the values is computed with one pass over the values the
+    first time it is asked, then raised by the values added. Removing a value that may be the
+    maximum makes the next query compute it again.
+    """
+
+    def __init__(self, graph, context, predicate, cls=None):
+        self.graph = graph
+        self.context = context
+        self.predicate = predicate
+        self.cls = cls
+        # Values of every subject of the class, and their sum
+        self.counts = {}
+        self.rows = 0
+        # (kind, expression text, variable) -> [kind, expression, variable, maximum]
+        self.maxima = {}
+        if cls is not None:
+            for subject in graph.subjects(RDF.type, cls):
+                self._count(subject)
+
+    def _count(self, subject):
+        old = self.counts.pop(subject, 0)
+        typed = (subject, RDF.type, self.cls) in self.graph
+        new = self.graph.store.count(subject, self.predicate, None) if typed else 0
+        if new:
+            self.counts[subject] = new
+        self.rows += new - old
+        return typed
+
+    def values(self):
+        """Yield the values counted, once per (subject, value) pair."""
+        if self.cls is None:
+            yield from self.graph.objects(None, self.predicate)
+            return
+        for subject in self.counts:
+            yield from self.graph.objects(subject, self.predicate)
+
+    def _evaluate(self, function, value):
+        kind, expression, variable, _ = function
+        if expression is None:
+            return value
+        try:
+            return _eval(expression, FrozenBindings(self.context, {variable: value}))
+        except SPARQLError as error:
+            return error
+
+    def _fold(self, function, maximum, value):
+        """Return the maximum after value, a result of the expression, like rdflib's MAX would."""
+        if maximum is _unanswerable:
+            return maximum
+        if not isinstance(value, Literal):
+            # A BIND leaves the variable unbound and MAX skips it, an error inside MAX() is not kept
+            return maximum if function[0] == "bind" and isinstance(value, SPARQLError) else _unanswerable
+        if maximum is None:
+            return value
+        # Literals of one datatype have one order whichever value comes first
+        if value.datatype != maximum.datatype or value.language != maximum.language:
+            return _unanswerable
+        try:
+            return max(maximum, value, key=_val)
+        except TypeError:
+            return _unanswerable
+
+    def maximum(self, kind, expression, variable, key):
+        """Return the MAX of an expression of the values, None without values, or _unanswerable.
+
+        kind is "value" for MAX(?value), "bind" for the MAX of a variable bound to the expression by a
+        BIND, where the values the expression fails for are skipped, and "inline" for MAX(expression).
+        """
+        function = self.maxima.pop(key, None)
+        if function is None:
+            function = [kind, expression, variable, None]
+            for value in self.values():
+                function[3] = self._fold(function, function[3], self._evaluate(function, value))
+                if function[3] is _unanswerable:
+                    break
+        self.maxima[key] = function
+        while len(self.maxima) > max_functions:
+            del self.maxima[next(iter(self.maxima))]
+        return function[3]
+
+    def update(self, subjects):
+        """Update the counts and maxima after a write, given the (added, predicate, object) changes of every subject."""
+        for subject, changes in subjects.items():
+            typed = self.cls is None or self._count(subject)
+            if not self.maxima:
+                continue
+            current = set(self.graph.objects(subject, self.predicate)) if typed else set()
+            added, removed = set(), set()
+            for is_added, predicate, value in changes:
+                if predicate == self.predicate:
+                    (added if is_added else removed).add(value)
+                if predicate == RDF.type and value == self.cls:
+                    (added if is_added else removed).update(self.graph.objects(subject, self.predicate))
+            for key, function in list(self.maxima.items()):
+                maximum = function[3]
+                stale = maximum is _unanswerable
+                for value in removed - current:
+                    if stale or maximum is None:
+                        break
+                    result = self._evaluate(function, value)
+                    try:
+                        stale = isinstance(result, Literal) and not _val(result) < _val(maximum)
+                    except TypeError:
+                        stale = True
+                if stale:
+                    del self.maxima[key]
+                    continue
+                for value in added & current:
+                    maximum = self._fold(function, maximum, self._evaluate(function, value))
+                function[3] = maximum
+
+
+class QueryPlanner:
+    """Rewrites prepared queries on a catalog graph, on a CatalogStore, and keeps the aggregates it answers."""
+
+    def __init__(self, graph, statistics=None):
+        self.graph = graph
+        self.statistics = PredicateStatistics() if statistics is None else statistics
+        # (class or None, predicate) -> ValueAggregate, created by the first query that needs it
+        self.aggregates = {}
+        self.context = QueryContext(graph)
+        self.answered = 0
+
+    def plan(self, prepared, notes=None):
+        """Return the query to evaluate instead of a prepared one.
+
+        notes, if given, is filled with what explain() shows: the estimates of every pattern and the
+        aggregates answered, by the id of the rewritten nodes.
+        """
+        notes = {} if notes is None else notes
+        return Query(prepared.prologue, self._rewrite(prepared.algebra, frozenset(), notes))
+
+    def apply(self, changes):
+        """Update the maintained aggregates after a write, given its (added, s, p, o) changes."""
+        if not self.aggregates:
+            return
+        touched = {}
+        for added, s, p, o in changes:
+            for aggregate in self.aggregates.values():
+                if p == aggregate.predicate or (p == RDF.type and o == aggregate.cls):
+                    touched.setdefault(aggregate, {}).setdefault(s, []).append((added, p, o))
+        for aggregate, subjects in touched.items():
+            aggregate.update(subjects)
+
+    def _rewrite(self, node, bound, notes):
+        if not isinstance(node, CompValue) or isinstance(node, Expr):
+            return node
+        if node.name == "BGP":
+            return self._basic_pattern(node.triples, bound, notes)
+        if node.name == "Filter" and node.p.name == "BGP" and node.p.triples:
+            return self._filter(node, bound, notes)
+        if node.name == "AggregateJoin":
+            answered = self._aggregate(node, notes)
+            if answered is not None:
+                return answered
+        rewritten = CompValue(node.name, **node)
+        if "p" in node:
+            rewritten["p"] = self._rewrite(node.p, bound, notes)
+        if "p1" in node:
+            rewritten["p1"] = self._rewrite(node.p1, bound, notes)
+        if "p2" in node:
+            # The second part of a lazy join and of an OPTIONAL is evaluated with the rows of the first
+            if node.name == "LeftJoin" or (node.name == "Join" and node.lazy):
+                rewritten["p2"] = self._rewrite(node.p2, bound | _bound_variables(node.p1), notes)
+            else:
+                rewritten["p2"] = self._rewrite(node.p2, bound, notes)
+        return rewritten
+
+    # Join order
+
+    def cardinality(self, triple):
+        """Return the triples matching the terms of a pattern, and the distinct subjects and objects of its predicate."""
+        store = self.graph.store
+        s, p, o = (None if _is_variable(term) else term for term in triple)
+        count = store.count(s, p, o)
+        total = len(store) if p is None else store.count(None, p, None)
+        counts = self.statistics.get(p) if p is not None else None
+        if not counts or not counts["triples"]:
+            return count, total, total
+        # Distinct terms now, if they grew like the triples since the statistics were collected
+        return count, counts["subjects"] * total / counts["triples"], counts["objects"] * total / counts["triples"]
+
+    def estimate(self, triple, bound, cardinality=None):
+        """Estimate the rows a triple pattern gives for one row binding the variables in bound."""
+        count, subjects, objects = self.cardinality(triple) if cardinality is None else cardinality
+        rows = float(count)
+        for term, distinct in ((triple[0], subjects), (triple[2], objects)):
+            if rows and term in bound:
+                rows /= max(distinct, 1.0)
+        return rows
+
+    def order(self, triples, bound, filters=()):
+        """Order triple patterns greedily by estimated rows and return the steps as (triple, rows per row, rows).
+
+        filters are the variables of the filters on the patterns: a pattern completing the variables of
+        one is assumed to give filter_selectivity of its rows.
+        """
+        remaining = {triple: (_pattern_variables([triple]), self.cardinality(triple)) for triple in triples}
+        bound = set(bound)
+        steps = []
+        rows = 1.0
+        while remaining:
+            connected = [triple for triple, (variables, _) in remaining.items() if not variables or variables & bound]
+            best = None
+            for triple in connected or remaining:
+                variables, cardinality = remaining[triple]
+                estimate = self.estimate(triple, bound, cardinality)
+                for used in filters:
+                    if not used <= bound and used <= bound | variables:
+                        estimate *= filter_selectivity
+                if best is None or estimate < best[0]:
+                    best = estimate, triple
+            estimate, triple = best
+            bound |= remaining.pop(triple)[0]
+            rows *= estimate
+            steps.append((triple, estimate, rows))
+        return steps
+
+    def _basic_pattern(self, triples, bound, notes):
+        steps = self.order(triples, bound)
+        node = CompValue("BGP", triples=[triple for triple, _, _ in steps], _vars=_pattern_variables(triples))
+        notes[id(node)] = steps
+        return node
+
+    def _filter(self, node, bound, notes):
+        """Push the equalities of a FILTER over a basic graph pattern and test the rest as early as possible."""
+        triples = node.p.triples
+        variables = _pattern_variables(triples)
+        bindings = {}
+        conflict = False
+        rest = []
+        for part in _conjuncts(node.expr):
+            equality = _equality(part)
+            if equality is None or equality[0] not in variables:
+                rest.append(part)
+                continue
+            variable, term = equality
+            if bindings.get(variable, term) != term:
+                conflict = True
+            bindings[variable] = term
+
+        inner = set(bound) | set(bindings)
+        filters = [(part, _variables(part)) for part in rest]
+        steps = self.order(triples, inner, [used for _, used in filters])
+        ordered = [triple for triple, _, _ in steps]
+        # Every filter goes after the first patterns binding its variables, or after all of them
+        placed = {}
+        for part, used in filters:
+            position = len(ordered)
+            if not _has_exists(part) and used <= variables | set(bindings):
+                known = set(inner)
+                for position, triple in enumerate(ordered, 1):
+                    known |= _pattern_variables([triple])
+                    if used <= known:
+                        break
+            placed.setdefault(max(position, 1), []).append(part)
+
+        pattern = None
+        start = 0
+        for end in sorted(placed) + ([len(ordered)] if len(ordered) not in placed else []):
+            part = CompValue("BGP", triples=ordered[start:end], _vars=_pattern_variables(ordered[start:end]))
+            notes[id(part)] = steps[start:end]
+            if pattern is None:
+                pattern = part
+            else:
+                pattern = CompValue("Join", p1=pattern, p2=part, lazy=True, _vars=node._vars)
+            for expr in placed.get(end, ()):
+                pattern = CompValue("Filter", **{**node, "expr": expr, "p": pattern})
+            start = end
+
+        if not bindings:
+            return pattern
+        values = CompValue("ToMultiSet", p=CompValue("values", res=[] if conflict else [bindings]), _vars=set())
+        notes[id(values)] = ["pushed down from FILTER"]
+        return CompValue("Join", p1=values, p2=pattern, lazy=True, _vars=node._vars)
+
+    # Aggregates
+
+    def _value_aggregate(self, cls, predicate):
+        aggregate = self.aggregates.get((cls, predicate))
+        if aggregate is None:
+            aggregate = self.aggregates[(cls, predicate)] = ValueAggregate(self.graph, self.context, predicate, cls)
+        return aggregate
+
+    def _rows(self, shape):
+        _, cls, predicate, _ = shape
+        store = self.graph.store
+        if predicate is None:
+            return store.count(None, RDF.type, cls)
+        if cls is None:
+            return store.count(None, predicate, None)
+        return self._value_aggregate(cls, predicate).rows
+
+    def _aggregate(self, node, notes):
+        """Answer the MAX and COUNT of an AggregateJoin without GROUP BY from the maintained aggregates.
+
+        Return the one row of the aggregates as a VALUES part, or None if the query has another form.
+        """
+        group = node.p
+        if group.name != "Group" or group.expr is not None:
+            return None
+        triples, extends = [], {}
+        if not _flatten(group.p, triples, extends) or not triples:
+            return None
+        shapes = [_shape(component) for component in _components(triples)]
+        if None in shapes:
+            return None
+        pattern_variables = _pattern_variables(triples)
+        values_of = {shape[3]: shape for shape in shapes if shape[3] is not None}
+        if any(variable in pattern_variables or not _variables(expr) <= set(values_of) or len(_variables(expr)) != 1
+               for variable, expr in extends.items()):
+            return None
+
+        rows = 1
+        for shape in shapes:
+            rows *= self._rows(shape)
+        row = {}
+        described = []
+        for aggregate in node.A:
+            target = aggregate.vars
+            if aggregate.name == "Aggregate_Count":
+                if target != "*" and not (isinstance(target, Variable) and target in pattern_variables):
+                    return None
+                if aggregate.distinct and not (len(shapes) == 1 and shapes[0][2] is None):
+                    return None
+                row[aggregate.res] = Literal(rows)
+            elif aggregate.name == "Aggregate_Max":
+                if isinstance(target, Variable) and target in values_of:
+                    kind, expression, variable = "value", None, target
+                elif isinstance(target, Variable) and target in extends:
+                    kind, expression = "bind", extends[target]
+                    variable, = _variables(expression)
+                elif isinstance(target, Expr) and len(_variables(target)) == 1 and _variables(target) <= set(values_of):
+                    kind, expression = "inline", target
+                    variable, = _variables(target)
+                else:
+                    return None
+                _, cls, predicate, _ = values_of[variable]
+                maximum = None
+                if rows:
+                    key = (kind, self.text(expression) if expression is not None else None, variable)
+                    maximum = self._value_aggregate(cls, predicate).maximum(kind, expression, variable, key)
+                if maximum is _unanswerable:
+                    return None
+                if maximum is not None:
+                    row[aggregate.res] = maximum
+            else:
+                return None
+            described.append(f"{self.text(aggregate)} = {self.text(row.get(aggregate.res, 'unbound'))}")
+
+        self.answered += 1
+        values = CompValue("ToMultiSet", p=CompValue("values", res=[row]), _vars=set(row))
+        notes[id(values)] = ["answered from the maintained aggregates", *described]
+        return values
+
+    # EXPLAIN
+
+    def text(self, value):
+        """Write a term, an expression or an aggregate of the algebra in a SPARQL-like form."""
+        if isinstance(value, Variable):
+            return "?" + value
+        if isinstance(value, (URIRef, Literal, BNode)):
+            return value.n3(self.graph.namespace_manager)
+        if isinstance(value, (list, tuple)):
+            return ", ".join(self.text(item) for item in value)
+        if not isinstance(value, CompValue):
+            return str(value)
+        name = value.name
+        if name == "RelationalExpression" or name in ("AdditiveExpression", "MultiplicativeExpression"):
+            if name == "RelationalExpression":
+                operators, others = [value.op], [value.other]
+            else:
+                operators, others = value.op, value.other
+            text = self.text(value.expr)
+            for operator, other in zip(operators, others):
+                other = f"({self.text(other)})" if isinstance(other, list) else self.text(other)
+                text += f" {operator} {other}"
+            return text
+        if name in ("ConditionalAndExpression", "ConditionalOrExpression"):
+            separator = " && " if name == "ConditionalAndExpression" else " || "
+            return separator.join(self.text(item) for item in [value.expr, *(value.other or [])])
+        if name.startswith("Aggregate_"):
+            distinct = "DISTINCT " if value.distinct else ""
+            return f"{name[len('Aggregate_'):].upper()}({distinct}{self.text(value.vars)})"
+        if name == "OrderCondition":
+            return f"{value.order}({self.text(value.expr)})" if value.order else self.text(value.expr)
+        if name == "Function":
+            return f"{self.text(value.iri)}({self.text(value.expr)})"
+        arguments = [self.text(item) for key, item in value.items() if key != "_vars" and item not in (None, [])]
+        return f"{name.removeprefix('Builtin_')}({', '.join(arguments)})"
+
+    def explain(self, prepared):
+        """Return the plan of a prepared query as lines of text."""
+        notes = {}
+        query = self.plan(prepared, notes)
+        lines = []
+        self._describe(query.algebra, 0, notes, lines)
+        return lines
+
+    def _describe(self, node, depth, notes, lines):
+        indent = "  " * depth
+        name = node.name
+        if name == "BGP":
+            steps = notes.get(id(node)) or [(triple, None, None) for triple in node.triples]
+            lines.append(f"{indent}BGP")
+            for number, (triple, estimate, rows) in enumerate(steps, 1):
+                pattern = " ".join(self.text(term) for term in triple)
+                if estimate is None:
+                    lines.append(f"{indent}  {number}. {pattern}")
+                else:
+                    lines.append(f"{indent}  {number}. {pattern}  (~{estimate:.3g} per row, ~{rows:.3g} rows)")
+            return
+        if name == "ToMultiSet" and node.p.name == "values":
+            rows = [" ".join(f"?{variable} = {self.text(term)}" for variable, term in row.items()) or "()"
+                    for row in node.p.res]
+            lines.append(f"{indent}Values {', '.join(rows) or 'no rows'}")
+            for note in notes.get(id(node), ()):
+                lines.append(f"{indent}  -- {note}")
+            return
+        if name == "Project":
+            detail = " ".join(self.text(variable) for variable in node.PV)
+        elif name == "Filter":
+            detail = self.text(node.expr)
+        elif name == "Extend":
+            detail = f"{self.text(node.var)} = {self.text(node.expr)}"
+        elif name == "AggregateJoin":
+            detail = ", ".join(f"{self.text(aggregate)} AS {self.text(aggregate.res)}" for aggregate in node.A)
+        elif name == "OrderBy":
+            detail = ", ".join(self.text(condition) for condition in node.expr)
+        elif name == "Slice":
+            detail = f"offset {node.start or 0}" + (f" limit {node.length}" if node.length is not None else "")
+        elif name == "Join":
+            detail = "(lazy)" if node.lazy else ""
+        elif name == "LeftJoin" and node.expr is not None and node.expr != Literal(True):
+            detail = self.text(node.expr)
+        elif name == "Group" and node.expr is not None:
+            detail = self.text(node.expr)
+        else:
+            detail = ""
+        lines.append(f"{indent}{name} {detail}".rstrip())
+        for key in ("p", "p1", "p2"):
+            child = node.get(key)
+            if isinstance(child, CompValue) and not isinstance(child, Expr):
+                self._describe(child, depth + 1, notes, lines)
@@ -0,0 +1,322 @@
+"""
+Uploads the RDF files of Products.py to the /statements endpoint of a repository in parallel chunks.
+
+Uploading Products.ttl to GraphDB sends it as one request: slow for a big catalog, and one error
+loses all of it. Uploader.upload() instead:
+
+- reads N-Triples or N-Quads files, gzipped or not, line by line and cuts them into chunks of about
+  chunk_bytes, only where the subject changes, so a chunk holds whole triples and all the triples of
+  a product. Turtle files are converted to N-Triples with rdflib first.
+- keeps the triples with blank nodes together in one last chunk, as a blank node label only names
+  the same node within one request
+- posts up to `connections` chunks at the same time, every worker thread over its own keep-alive
+  HTTP connection, and reads at most 2 * connections chunks ahead, so memory stays flat
+- retries a chunk after a connection error, a 429 or a 5xx answer, with exponential backoff and
+  jitter, or after the Retry-After of the answer
+- records the chunks done in a checkpoint file: an interrupted upload started again with the same
+  file and chunk size only sends the chunks that are missing. Adding a triple twice changes nothing,
+  so a chunk whose answer was lost can simply be sent again.
+
+The local service of sparql_service.py accepts the same requests, so an upload can be tried against it:
+
+    python rdf_upload.py Products.nt --url http://localhost:7200 --connections 8
+"""
+
+import argparse
+import gzip
+import http.client
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+# Media types of the line-oriented formats, by file extension
+media_types = {
+    ".nt": "application/n-triples",
+    ".nq": "application/n-quads",
+}
+
+# Defaults of the command line
+default_url = "http://localhost:7200"
+repository_name = "Super_Market"
+checkpoint_file = "Products.upload.json"
+chunk_bytes = 4 << 20
+default_connections = 4
+max_retries = 5
+
+# First delay before a retry and the longest one, in seconds
+backoff_seconds = 0.5
+max_backoff_seconds = 30.0
+
+# Seconds to wait for the answer to one chunk
+request_timeout = 300
+
+# Answers after which a chunk is sent again, the other errors stop the upload
+retry_statuses = {429, 500, 502, 503, 504}
+
+# Longest part of an error answer kept in the error message
+error_chars = 300
+
+
+class UploadError(Exception):
+    """A chunk the endpoint refused, or that still failed after every retry."""
+
+
+def file_format(path):
+    """Return the extension of a file without .gz, and whether it is gzipped."""
+    compressed = path.endswith(".gz")
+    return os.path.splitext(path[:-3] if compressed else path)[1].lower(), compressed
+
+
+def read_lines(path):
+    """Yield the lines of an N-Triples or N-Quads file, or of a Turtle file converted to N-Triples."""
+    extension, compressed = file_format(path)
+    if extension in media_types:
+        with (gzip.open(path, "rt", encoding="utf-8") if compressed else open(path, encoding="utf-8")) as f:
+            yield from f
+        return
+
+    from rdflib import Graph
+
+    with (gzip.open(path, "rb") if compressed else open(path, "rb")) as f:
+        graph = Graph().parse(f, format="turtle")
+    for line in graph.serialize(format="nt", encoding="utf-8").decode("utf-8").splitlines(keepends=True):
+        yield line
+
+
+def chunks(lines, size=chunk_bytes):
+    """Group lines of N-Triples or N-Quads into chunks of about size characters and yield their text.
+
+    A chunk only ends where the subject changes. The lines with blank nodes are all in the last chunk.
+    """
+    blank = []
+    chunk = []
+    chunk_size = 0
+    last_subject = None
+    for line in lines:
+        if not line.strip() or line.startswith("#"):
+            continue
+        if not line.endswith("\n"):
+            line += "\n"
+        if "_:" in line:
+            blank.append(line)
+            continue
+        subject = line.split(" ", 1)[0]
+        if chunk_size >= size and subject != last_subject:
+            yield "".join(chunk)
+            chunk = []
+            chunk_size = 0
+        chunk.append(line)
+        chunk_size += len(line)
+        last_subject = subject
+    if chunk:
+        yield "".join(chunk)
+    if blank:
+        yield "".join(blank)
+
+
+class Checkpoint:
+    """The chunks already uploaded of every file, saved as JSON.
+
+    The chunks of a file are only reused while its size, modification time, the chunk size and the
+    endpoint are the same, otherwise the file is uploaded again from the start.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.files = json.load(f).get("files", {})
+        self._saved = 0.0
+
+    def done(self, path, key):
+        """Return the set of chunks of a file already uploaded with the same key."""
+        entry = self.files.get(os.path.abspath(path))
+        if entry is None or entry["key"] != key:
+            entry = self.files[os.path.abspath(path)] = {"key": key, "done": []}
+        return set(entry["done"])
+
+    def update(self, path, done, force=False):
+        """Record the chunks done of a file, saving at most once a second unless forced."""
+        self.files[os.path.abspath(path)]["done"] = sorted(done)
+        now = time.monotonic()
+        if self.path and (force or now - self._saved >= 1.0):
+            temporary = f"{self.path}.{os.getpid()}.tmp"
+            with open(temporary, "w", encoding="utf-8") as f:
+                json.dump({"files": self.files}, f)
+            os.replace(temporary, self.path)
+            self._saved = now
+
+
+class Uploader:
+    """Posts chunks of RDF to the /statements endpoint of a repository over pooled keep-alive connections."""
+
+    def __init__(self, url=default_url, repository=repository_name, connections=default_connections,
+                 retries=max_retries, backoff=backoff_seconds, timeout=request_timeout, headers=None):
+        parts = urlsplit(url)
+        self.scheme = parts.scheme or "http"
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = f"{parts.path.rstrip('/')}/repositories/{repository}/statements"
+        self.url = f"{self.scheme}://{parts.netloc}{self.path}"
+        self.connections = connections
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.headers = dict(headers or {})
+        # One connection per worker thread, kept open between its requests
+        self._local = threading.local()
+        self._pool = []
+        self._lock = threading.Lock()
+        self.sent_bytes = 0
+        self.retried = 0
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection_class = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+            connection = self._local.connection = connection_class(self.host, self.port, timeout=self.timeout)
+            with self._lock:
+                self._pool.append(connection)
+        return connection
+
+    def close(self):
+        with self._lock:
+            for connection in self._pool:
+                connection.close()
+
+    def _delay(self, attempt, retry_after=None):
+        """Seconds to wait before the next attempt: Retry-After if given, else exponential backoff with jitter."""
+        if retry_after is not None and retry_after.strip().isdigit():
+            return min(float(retry_after), max_backoff_seconds)
+        return min(self.backoff * 2 ** attempt, max_backoff_seconds) * random.uniform(0.5, 1.0)
+
+    def post(self, text, media_type):
+        """Post one chunk, retrying connection errors and retryable answers, and raise UploadError if it fails."""
+        body = text.encode("utf-8")
+        headers = {"Content-Type": f"{media_type};charset=UTF-8", **self.headers}
+        for attempt in range(self.retries + 1):
+            retry_after = None
+            connection = self._connection()
+            try:
+                connection.request("POST", self.path, body, headers)
+                response = connection.getresponse()
+                answer = response.read()
+                if response.will_close:
+                    connection.close()
+                if response.status < 300:
+                    with self._lock:
+                        self.sent_bytes += len(body)
+                    return
+                error = f"{response.status} {response.reason}: {answer.decode('utf-8', 'replace')[:error_chars]}"
+                if response.status not in retry_statuses:
+                    raise UploadError(error)
+                retry_after = response.getheader("Retry-After")
+            except (OSError, http.client.HTTPException) as exception:
+                # A stale keep-alive connection is reopened by the next request
+                connection.close()
+                error = f"{type(exception).__name__}: {exception}"
+            if attempt == self.retries:
+                raise UploadError(f"{error} (after {attempt + 1} attempts)")
+            with self._lock:
+                self.retried += 1
+            time.sleep(self._delay(attempt, retry_after))
+
+    def upload(self, path, chunk_size=chunk_bytes, checkpoint=None, progress=print):
+        """Upload a file in chunks and return the number of chunks sent and skipped.
+
+        Chunks already in checkpoint, a Checkpoint, are skipped and the ones sent are added to it.
+        progress is called with a line of text at most once a second and at the end.
+        """
+        extension, _ = file_format(path)
+        media_type = media_types.get(extension, media_types[".nt"])
+        checkpoint = Checkpoint(None) if checkpoint is None else checkpoint
+        stat = os.stat(path)
+        done = checkpoint.done(path, [stat.st_size, stat.st_mtime_ns, chunk_size, self.url])
+        skipped = len(done)
+        sent = 0
+        start = time.perf_counter()
+        reported = start
+        pending = deque()
+
+        def finish(index, future):
+            nonlocal sent, reported
+            future.result()
+            done.add(index)
+            sent += 1
+            checkpoint.update(path, done)
+            now = time.perf_counter()
+            if now - reported >= 1.0:
+                reported = now
+                progress(f"{path}: {sent} chunks, {self.sent_bytes / (1 << 20):.1f} MB sent, {self.retried} retries")
+
+        with ThreadPoolExecutor(max_workers=self.connections, thread_name_prefix="upload") as pool:
+            try:
+                for index, text in enumerate(chunks(read_lines(path), chunk_size)):
+                    if index in done:
+                        continue
+                    pending.append((index, pool.submit(self.post, text, media_type)))
+                    # Bounded read-ahead: wait for the oldest chunk before reading more
+                    if len(pending) >= 2 * self.connections:
+                        finish(*pending[0])
+                        pending.popleft()
+                while pending:
+                    finish(*pending[0])
+                    pending.popleft()
+            finally:
+                # Keep the chunks that made it when one fails or the upload is interrupted, so the next
+                # run resumes after them. A chunk leaves pending only once recorded in done.
+                for index, future in pending:
+                    future.cancel()
+                    if not future.cancelled() and future.exception() is None:
+                        done.add(index)
+                checkpoint.update(path, done, force=True)
+
+        elapsed = time.perf_counter() - start
+        progress(f"{path}: {sent} chunks sent, {skipped} already uploaded, {self.retried} retries "
+                 f"in {elapsed:.1f} s")
+        return sent, skipped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Upload RDF files to a repository in parallel chunks.")
+    parser.add_argument("files", nargs="+", help="N-Triples (.nt), N-Quads (.nq) or Turtle files, optionally .gz")
+    parser.add_argument("--url", default=default_url, help="server URL (default: %(default)s)")
+    parser.add_argument("--repository", default=repository_name, help="repository name (default: %(default)s)")
+    parser.add_argument("--connections", type=int, default=default_connections,
+                        help="chunks posted at the same time (default: %(default)s)")
+    parser.add_argument("--chunk-mb", type=float, default=chunk_bytes / (1 << 20),
+                        help="approximate size of a chunk in megabytes (default: %(default)s)")
+    parser.add_argument("--retries", type=int, default=max_retries,
+                        help="attempts after the first one for a failing chunk (default: %(default)s)")
+    parser.add_argument("--checkpoint", default=checkpoint_file,
+                        help="file recording the chunks uploaded, to resume an interrupted upload (default: %(default)s)")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and upload everything again")
+    args = parser.parse_args(argv)
+
+    if args.restart and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    checkpoint = Checkpoint(args.checkpoint)
+    uploader = Uploader(args.url, args.repository, args.connections, args.retries)
+    try:
+        for path in args.files:
+            uploader.upload(path, int(args.chunk_mb * (1 << 20)), checkpoint)
+    except UploadError as error:
+        print(f"Upload failed: {error}")
+        print(f"Run the same command again to resume from {args.checkpoint}")
+        return 1
+    except KeyboardInterrupt:
+        print(f"Upload interrupted, run the same command again to resume from {args.checkpoint}")
+        return 130
+    finally:
+        uploader.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
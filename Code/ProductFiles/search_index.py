@@ -0,0 +1,353 @@
+"""
+An inverted index over product names and brands, built by Products.py next to Products.ttl.
+
+The header search of the React app runs FILTER(CONTAINS(LCASE(?name), ...)) over every gr:name,
+which scans the whole catalog on each search. This index answers the same question from posting
+lists instead, so a search only touches the products that can match:
+
+- token:    every word of the query is a word of the name or brand
+- prefix:   every word of the query starts a word of the name or brand (search as you type)
+- contains: the query is a substring of the lowercased name or brand, like CONTAINS(LCASE(...)).
+            Candidates come from the trigrams of the query and have to be checked against the
+            product text, which the SPARQL service does with the current values in the store.
+
+The index file is a small JSON header followed by flat arrays (write_arrays and map_arrays, also used by
+the product snapshot), which SearchIndex memory-maps, so loading it is instant and only the posting
+lists a search touches are read from disk.
+
+The file is never rewritten by the SPARQL service. SearchDelta keeps the products whose name or brand
+changed since the file was built in memory, found at startup from a hash of the text of every row and
+updated with every write, and merges them with the results of the file.
+"""
+
+import json
+import mmap
+import re
+
+import numpy as np
+import pandas as pd
+
+# Bytes at the start of every index file
+magic = b"PSEARCH1"
+
+# Length of the n-grams used by contains searches
+gram_size = 3
+
+# Widest UTF-8 n-gram, used as the width of the fixed-size n-gram keys
+gram_width = 4 * gram_size
+
+# Separators between the words of a name or brand
+_word = r"\w+"
+
+
+def _lower(values):
+    return pd.Series(values, dtype=object).astype(str).str.lower().reset_index(drop=True)
+
+
+def text_hashes(names, brands):
+    """Return a 64-bit hash of the lowercased name and brand of every product."""
+    text = _lower(names) + "\0" + _lower(brands)
+    return pd.util.hash_pandas_object(text, index=False).to_numpy(dtype=np.uint64)
+
+
+def _tokens(text):
+    """Return (row, token) Series of every word of a column of lowercased text."""
+    words = text.str.findall(_word).explode().dropna()
+    return words.index.to_numpy(), words.to_numpy(dtype=object)
+
+
+def _grams(text):
+    """Return (row, n-gram) arrays of every n-gram of a column of lowercased text.
+
+    Texts shorter than an n-gram are kept whole, so short queries can still find them.
+    """
+    lengths = text.str.len().to_numpy()
+    short = (lengths > 0) & (lengths < gram_size)
+    rows = [np.flatnonzero(short)]
+    grams = [text[short].to_numpy(dtype=object)]
+    for start in range(max(int(lengths.max(initial=0)) - gram_size + 1, 0)):
+        mask = lengths >= start + gram_size
+        rows.append(np.flatnonzero(mask))
+        grams.append(text[mask].str.slice(start, start + gram_size).to_numpy(dtype=object))
+    return np.concatenate(rows), np.concatenate(grams)
+
+
+def query_tokens(query):
+    """Split a search query into lowercased words."""
+    return pd.Series([query.lower()]).str.findall(_word)[0]
+
+
+def query_grams(query):
+    """Return the distinct n-grams of a lowercased search query."""
+    if len(query) < gram_size:
+        return [query]
+    return sorted({query[i:i + gram_size] for i in range(len(query) - gram_size + 1)})
+
+
+def write_arrays(path, file_magic, arrays, **header):
+    """Write a file of flat arrays: the magic bytes, a JSON header and every array aligned to 8 bytes."""
+    layout, offset = {}, 0
+    for name, array in arrays.items():
+        layout[name] = [array.dtype.str, offset, len(array)]
+        offset += -(-array.nbytes // 8) * 8
+    header = json.dumps({**header, "arrays": layout}).encode("utf-8")
+    header += b" " * (-(len(file_magic) + 8 + len(header)) % 8)
+    with open(path, "wb") as f:
+        f.write(file_magic + np.uint64(len(header)).tobytes() + header)
+        for array in arrays.values():
+            f.write(array.tobytes())
+            f.write(b"\0" * (-array.nbytes % 8))
+
+
+def map_arrays(path, file_magic):
+    """Memory-map a file written by write_arrays and return the map, the header and the arrays by name.
+
+    The arrays are read-only views of the map, nothing is copied.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(file_magic)) != file_magic:
+            raise ValueError(f"{path} is not a {file_magic.decode('ascii')} file")
+        size = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(size))
+        file_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    start = len(file_magic) + 8 + size
+    arrays = {
+        name: np.frombuffer(file_map, dtype=dtype, count=length, offset=start + offset)
+        for name, (dtype, offset, length) in header.pop("arrays").items()
+    }
+    return file_map, header, arrays
+
+
+class _Postings:
+    """Collects (key, row) pairs chunk by chunk and writes them as sorted keys with posting lists."""
+
+    def __init__(self):
+        self.ids = {}
+        self.key_ids = []
+        self.rows = []
+
+    def add(self, rows, keys):
+        if not len(rows):
+            return
+        codes, uniques = pd.factorize(keys)
+        ids = np.fromiter((self.ids.setdefault(key, len(self.ids)) for key in uniques), dtype=np.int64, count=len(uniques))
+        # One entry per key and row, even when a word or n-gram appears twice in a name
+        pairs = np.unique((ids[codes] << 32) | rows.astype(np.int64))
+        self.key_ids.append((pairs >> 32).astype(np.uint32))
+        self.rows.append((pairs & 0xFFFFFFFF).astype(np.uint32))
+
+    def arrays(self, width=None):
+        """Return the sorted keys, the posting offsets of every key and the concatenated posting lists."""
+        keys = np.array([key.encode("utf-8") for key in self.ids], dtype=f"S{width}" if width else bytes)
+        if not len(keys):
+            keys = np.zeros(0, dtype=f"S{width or 1}")
+        order = np.argsort(keys, kind="stable")
+        rank = np.empty(len(keys), dtype=np.uint32)
+        rank[order] = np.arange(len(keys), dtype=np.uint32)
+        key_ids = rank[np.concatenate(self.key_ids)] if self.key_ids else np.zeros(0, dtype=np.uint32)
+        rows = np.concatenate(self.rows) if self.rows else np.zeros(0, dtype=np.uint32)
+        # Rows were added in CSV order, so a stable sort by key keeps every posting list sorted
+        by_key = np.argsort(key_ids, kind="stable")
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(key_ids, minlength=len(keys)), out=offsets[1:])
+        return keys[order], offsets, rows[by_key]
+
+
+class SearchIndexBuilder:
+    """Builds a search index from chunks of products, in CSV order."""
+
+    def __init__(self):
+        self.count = 0
+        self.instances = []
+        self.hashes = []
+        self.tokens = _Postings()
+        self.grams = _Postings()
+
+    def add(self, instances, names, brands):
+        """Index a chunk of products, given their instance local names, names and brands."""
+        start = self.count
+        self.instances.append(pd.Series(instances, dtype=object).astype(str).to_numpy(dtype=object))
+        self.hashes.append(text_hashes(names, brands))
+        for text in (_lower(names), _lower(brands)):
+            rows, tokens = _tokens(text)
+            self.tokens.add(rows + start, tokens)
+            rows, grams = _grams(text)
+            self.grams.add(rows + start, grams)
+        self.count += len(self.instances[-1])
+
+    def write(self, path):
+        """Write the index file."""
+        instances = np.concatenate(self.instances) if self.instances else np.zeros(0, dtype=object)
+        encoded = [instance.encode("utf-8") for instance in instances]
+        instance_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=instance_offsets[1:])
+        arrays = {"instance_data": np.frombuffer(b"".join(encoded), dtype=np.uint8), "instance_offsets": instance_offsets}
+        arrays["text_hashes"] = np.concatenate(self.hashes) if self.hashes else np.zeros(0, dtype=np.uint64)
+        arrays.update(zip(("token_keys", "token_offsets", "token_rows"), self.tokens.arrays()))
+        arrays.update(zip(("gram_keys", "gram_offsets", "gram_rows"), self.grams.arrays(gram_width)))
+        write_arrays(path, magic, arrays, count=self.count)
+
+
+class SearchIndex:
+    """A memory-mapped search index file."""
+
+    def __init__(self, path):
+        self._map, header, arrays = map_arrays(path, magic)
+        self.count = header["count"]
+        # Files written before the text hashes were stored have none
+        self.text_hashes = None
+        for name, array in arrays.items():
+            setattr(self, name, array)
+
+    def __len__(self):
+        return self.count
+
+    def instance(self, row):
+        """Return the instance local name of a product row."""
+        return bytes(self.instance_data[self.instance_offsets[row]:self.instance_offsets[row + 1]]).decode("utf-8")
+
+    def instances(self, rows):
+        """Return the distinct instance local names of product rows, in row order."""
+        return list(dict.fromkeys(self.instance(row) for row in rows))
+
+    @staticmethod
+    def _postings(offsets, rows, start, end):
+        """Return the union of the posting lists of the keys between two positions."""
+        if end - start == 1:
+            return rows[offsets[start]:offsets[end]]
+        return np.unique(rows[offsets[start]:offsets[end]])
+
+    def _token(self, token, prefix):
+        value = token.encode("utf-8")
+        start = np.searchsorted(self.token_keys, value, side="left")
+        end = np.searchsorted(self.token_keys, value + b"\xff" if prefix else value, side="left" if prefix else "right")
+        return self._postings(self.token_offsets, self.token_rows, start, end)
+
+    def _gram(self, gram):
+        value = gram.encode("utf-8")
+        if len(gram) < gram_size:
+            # Short queries match every n-gram that contains them
+            matches = np.flatnonzero(np.char.find(self.gram_keys, value) >= 0)
+            parts = [self.gram_rows[self.gram_offsets[i]:self.gram_offsets[i + 1]] for i in matches]
+            return np.unique(np.concatenate(parts)) if parts else np.zeros(0, dtype=np.uint32)
+        start = np.searchsorted(self.gram_keys, value, side="left")
+        end = np.searchsorted(self.gram_keys, value, side="right")
+        return self._postings(self.gram_offsets, self.gram_rows, start, end)
+
+    def search(self, query, mode="contains"):
+        """Return the sorted rows of the products that can match a query.
+
+        token and prefix results are exact. contains results are candidates that contain every
+        n-gram of the query and still have to be checked against the product text.
+        """
+        if mode == "contains":
+            query = query.strip().lower()
+            postings = [self._gram(gram) for gram in query_grams(query)] if query else []
+        elif mode in ("token", "prefix"):
+            postings = [self._token(token, mode == "prefix") for token in query_tokens(query)]
+        else:
+            raise ValueError(f"Unknown search mode: {mode}")
+        if not postings:
+            return np.zeros(0, dtype=np.uint32)
+        # Intersect the shortest lists first
+        postings.sort(key=len)
+        rows = postings[0]
+        for other in postings[1:]:
+            if not len(rows):
+                break
+            rows = np.intersect1d(rows, other, assume_unique=True)
+        return rows
+
+    def close(self):
+        for name in list(vars(self)):
+            if name.endswith(("_keys", "_offsets", "_rows", "_data", "_hashes")):
+                delattr(self, name)
+        self._map.close()
+
+
+class SearchDelta:
+    """The products whose name or brand differs from a SearchIndex, searched in memory.
+
+    graph is the store the index describes, namespace the namespace of the instances and name and brand the
+    predicates of the indexed text. The rows of a changed product are dropped from the results of the index
+    and the product is matched against its current text instead, a product without a name or brand any more
+    is dropped. A changed product stays in the delta, which is scanned on every search, until the index file
+    is built again.
+    """
+
+    def __init__(self, index, graph, namespace, name, brand):
+        self.index = index
+        self.graph = graph
+        self.namespace = namespace
+        self.predicates = (name, brand)
+        # instance local name -> (lowercased names and brands, their words)
+        self.texts = {}
+        # instance local names of the index that no longer have a name or brand
+        self.removed = set()
+        self._sync()
+
+    def _local(self, subject):
+        text = str(subject)
+        return text[len(self.namespace):] if text.startswith(self.namespace) else None
+
+    def _sync(self):
+        """Find the products of the store whose text differs from the index, and the ones it lost."""
+        values = {}
+        for position, predicate in enumerate(self.predicates):
+            for subject, value in self.graph.subject_objects(predicate):
+                local = self._local(subject)
+                if local is not None:
+                    values.setdefault(local, ([], []))[position].append(str(value))
+        rows = {self.index.instance(row): row for row in range(len(self.index))}
+        instances = list(values)
+        hashes = self.index.text_hashes
+        if hashes is not None and instances:
+            # A product with several names or brands never matches the hash of a row
+            current = text_hashes(*zip(*(("\n".join(sorted(names)), "\n".join(sorted(brands)))
+                                         for names, brands in values.values())))
+        for position, local in enumerate(instances):
+            row = rows.pop(local, None)
+            if row is None or (hashes is not None and hashes[row] != current[position]):
+                self._set(local, [text for texts in values[local] for text in texts])
+        self.removed.update(rows)
+
+    def _set(self, local, texts):
+        if texts:
+            lowered = tuple(text.lower() for text in texts)
+            self.texts[local] = lowered, frozenset(word for text in lowered for word in re.findall(_word, text))
+            self.removed.discard(local)
+        else:
+            self.texts.pop(local, None)
+            self.removed.add(local)
+
+    def apply(self, changes):
+        """Update the delta after a write, given its (added, s, p, o) changes."""
+        for subject in {s for _, s, p, _ in changes if p in self.predicates}:
+            local = self._local(subject)
+            if local is not None:
+                self._set(local, [str(value) for predicate in self.predicates
+                                  for value in self.graph.objects(subject, predicate)])
+
+    def _matches(self, query, mode):
+        if mode == "contains":
+            query = query.strip().lower()
+            if not query:
+                return []
+            return [local for local, (texts, _) in self.texts.items() if any(query in text for text in texts)]
+        tokens = query_tokens(query)
+        if not tokens:
+            return []
+        if mode == "token":
+            return [local for local, (_, words) in self.texts.items() if all(token in words for token in tokens)]
+        return [local for local, (_, words) in self.texts.items()
+                if all(any(word.startswith(token) for word in words) for token in tokens)]
+
+    def search(self, query, mode="contains"):
+        """Return the instance local names of the products that can match a query, like
+        SearchIndex.search: the rows of the index in order, then the changed products."""
+        stale = self.texts.keys() | self.removed
+        instances = [local for local in self.index.instances(self.index.search(query, mode)) if local not in stale]
+        return instances + self._matches(query, mode)
+
+    def __len__(self):
+        return len(self.texts) + len(self.removed)
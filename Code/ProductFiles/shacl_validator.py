@@ -0,0 +1,419 @@
+"""
+A SHACL validator compiled from the shapes Products.py writes to Shacl_shapes.ttl.
+
+GraphDB only checks the shapes when the data is uploaded, which is slow and rejects the whole upload
+for one bad row. compile_shapes() turns the shapes into checks that run while the catalog is generated
+and on every update of the local SPARQL service:
+
+- sh:targetClass shapes check every instance of the class or of its subclasses, with sh:minCount,
+  sh:maxCount, sh:datatype (including a well-formed lexical form) and sh:minInclusive,
+  sh:minExclusive, sh:maxInclusive and sh:maxExclusive on the values of each sh:path.
+- sh:targetObjectsOf shapes with sh:path [ sh:inversePath p ] and sh:maxCount 1 (unique product ids
+  and usernames) keep a 64-bit hash of every value and of its subject in sorted arrays, so uniqueness
+  is checked across the whole catalog with a binary search per value.
+
+check() validates the triples of a TripleBuilder without leaving its integer id arrays, one record
+(one CSV row) at a time, so violations are reported with the row numbers of the CSV file. It returns
+a ChunkReport, which can be computed in a worker process, and merge() adds it to the results in CSV
+order. check_graph() validates the nodes an update touched against the whole store.
+
+Only the subset of SHACL used by the shapes of Products.py is supported, other constraints are
+rejected when the shapes are compiled.
+"""
+
+import re
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+from rdflib import RDF, RDFS, BNode, Graph, Literal, Namespace, URIRef
+
+from triples import RDF_TYPE
+
+SH = Namespace("http://www.w3.org/ns/shacl#")
+XSD_STRING = "http://www.w3.org/2001/XMLSchema#string"
+RDFS_SUBCLASS_OF = str(RDFS.subClassOf)
+
+# Well-formed lexical forms of the datatypes the shapes use
+_lexical_forms = {
+    "http://www.w3.org/2001/XMLSchema#double": re.compile(r"[+-]?(\d+(\.\d*)?|\.\d+)([eE][+-]?\d+)?|[+-]?INF|NaN"),
+    "http://www.w3.org/2001/XMLSchema#float": re.compile(r"[+-]?(\d+(\.\d*)?|\.\d+)([eE][+-]?\d+)?|[+-]?INF|NaN"),
+    "http://www.w3.org/2001/XMLSchema#decimal": re.compile(r"[+-]?(\d+(\.\d*)?|\.\d+)"),
+    "http://www.w3.org/2001/XMLSchema#integer": re.compile(r"[+-]?\d+"),
+    "http://www.w3.org/2001/XMLSchema#boolean": re.compile(r"true|false|1|0"),
+}
+
+# Value range constraints and the comparison each one requires
+_bounds = {
+    "minInclusive": lambda value, bound: value >= bound,
+    "minExclusive": lambda value, bound: value > bound,
+    "maxInclusive": lambda value, bound: value <= bound,
+    "maxExclusive": lambda value, bound: value < bound,
+}
+
+# Constraints of a property shape that compile_shapes() understands
+_supported = {"path", "datatype", "minCount", "maxCount", "message", *_bounds}
+
+# row is the 1-based CSV row of the product, or None for triples that do not come from the CSV file
+Violation = namedtuple("Violation", ["row", "focus", "shape", "path", "constraint", "message", "value"])
+
+
+def format_violation(violation):
+    where = f"row {violation.row}" if violation.row is not None else violation.focus
+    return (f"{where}: {violation.shape} {violation.path} {violation.constraint}: {violation.message} "
+            f"({violation.value})")
+
+
+def _term(term):
+    """Convert an rdflib term to the term tuples of TripleBuilder: an IRI string or (lexical form, datatype)."""
+    if isinstance(term, Literal):
+        return str(term), str(term.datatype) if term.datatype else None
+    return str(term)
+
+
+class ValidationError(ValueError):
+    """Data that violates the shapes, with the list of violations."""
+
+    def __init__(self, violations, shown=20):
+        lines = [format_violation(violation) for violation in violations[:shown]]
+        if len(violations) > shown:
+            lines.append(f"... and {len(violations) - shown} more")
+        super().__init__(f"{len(violations)} SHACL violations:\n" + "\n".join(lines))
+        self.violations = violations
+
+
+def _columns(terms):
+    """Split term tuples into a Series of lexical forms (or IRIs) and one of datatypes (None for IRIs).
+
+    A plain literal has the datatype xsd:string.
+    """
+    literal = [isinstance(term, tuple) for term in terms]
+    lexical = pd.Series([term[0] if is_literal else term for term, is_literal in zip(terms, literal)], dtype=object)
+    datatypes = pd.Series([(term[1] or XSD_STRING) if is_literal else None for term, is_literal in zip(terms, literal)],
+                          dtype=object)
+    return lexical, datatypes
+
+
+def _hashes(terms):
+    """Return a 64-bit hash of every term, the same for a plain literal and an xsd:string one."""
+    lexical, datatypes = _columns(terms)
+    keys = lexical.where(datatypes.isna(), lexical + "\0" + datatypes)
+    return pd.util.hash_array(keys.to_numpy(dtype=object)), lexical.to_numpy(dtype=object)
+
+
+def _short(iri):
+    return iri.rsplit("#", 1)[-1].rsplit("/", 1)[-1]
+
+
+class PropertyCheck:
+    """The constraints of one sh:property of a shape."""
+
+    def __init__(self, path, inverse=False, datatype=None, min_count=None, max_count=None, bounds=(), message=None):
+        self.path = path
+        self.inverse = inverse
+        self.datatype = datatype
+        self.min_count = min_count
+        self.max_count = max_count
+        self.bounds = list(bounds)
+        self.message = message or ""
+
+    @property
+    def label(self):
+        return f"^:{_short(self.path)}" if self.inverse else f":{_short(self.path)}"
+
+    def value_errors(self, terms):
+        """Check the datatype and the bounds of value nodes, a whole column at a time.
+
+        Return (position, constraint, detail) for every violation, by position in terms.
+        """
+        lexical, datatypes = _columns(terms)
+        errors = []
+        valid = pd.Series(True, index=lexical.index)
+        if self.datatype is not None:
+            valid = datatypes == self.datatype
+            for position in np.flatnonzero(~valid):
+                errors.append((position, "sh:datatype", f"{lexical[position]} is not {_short(self.datatype)}"))
+            form = _lexical_forms.get(self.datatype)
+            if form is not None:
+                well_formed = lexical.str.fullmatch(form.pattern).fillna(False).astype(bool)
+                for position in np.flatnonzero(valid & ~well_formed):
+                    errors.append((position, "sh:datatype", f"{lexical[position]!r} is not a valid {_short(self.datatype)}"))
+                valid &= well_formed
+        if self.bounds:
+            numbers = pd.to_numeric(lexical.where(valid & datatypes.notna()), errors="coerce").to_numpy(dtype=float)
+            known = ~np.isnan(numbers)
+            for name, bound in self.bounds:
+                for position in np.flatnonzero(known & ~_bounds[name](numbers, bound)):
+                    errors.append((position, f"sh:{name}", f"{lexical[position]} (bound {bound:g})"))
+        return errors
+
+
+class Shape:
+    """A node shape with its targets and property checks."""
+
+    def __init__(self, name, target_classes, target_objects_of, properties):
+        self.name = name
+        self.target_classes = target_classes
+        self.target_objects_of = target_objects_of
+        self.properties = properties
+
+
+class ChunkReport:
+    """The violations found in one chunk, and the values it adds to the uniqueness indexes."""
+
+    def __init__(self, violations, unique):
+        self.violations = violations
+        # (shape, path) -> (value hashes, subject hashes, rows, value texts)
+        self.unique = unique
+
+
+class _UniqueIndex:
+    """Sorted 64-bit hashes of the values seen so far, with the hash of their subject and their row."""
+
+    def __init__(self):
+        self.keys = np.zeros(0, dtype=np.uint64)
+        self.subjects = np.zeros(0, dtype=np.uint64)
+        self.rows = np.zeros(0, dtype=np.int64)
+
+    def add(self, keys, subjects, rows):
+        """Add values and return the positions of those used by another subject, with that subject's row."""
+        order = np.argsort(keys, kind="stable")
+        keys, subjects, rows = keys[order], subjects[order], rows[order]
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = keys[1:] != keys[:-1]
+        starts = np.flatnonzero(first)
+        group = np.cumsum(first) - 1
+
+        positions = np.searchsorted(self.keys, keys[starts])
+        found = positions < len(self.keys)
+        found[found] = self.keys[positions[found]] == keys[starts][found]
+
+        # Compare every value with the first subject that used it, here or in an earlier chunk
+        owner_subject = subjects[starts].copy()
+        owner_row = rows[starts].copy()
+        owner_subject[found] = self.subjects[positions[found]]
+        owner_row[found] = self.rows[positions[found]]
+        duplicate = subjects != owner_subject[group]
+
+        new = ~found
+        self.keys = np.insert(self.keys, positions[new], keys[starts][new])
+        self.subjects = np.insert(self.subjects, positions[new], subjects[starts][new])
+        self.rows = np.insert(self.rows, positions[new], rows[starts][new])
+        return order[duplicate], owner_row[group][duplicate]
+
+
+class ShapeValidator:
+    """Checks triples against compiled shapes and collects the violations."""
+
+    def __init__(self, shapes):
+        self.shapes = shapes
+        self.superclasses = {}
+        self.violations = []
+        self._unique = {}
+
+    def learn(self, builder):
+        """Read the rdfs:subClassOf triples of a builder, so subclass instances are targeted too."""
+        subclass_of = builder.ids.get(RDFS_SUBCLASS_OF)
+        if subclass_of is None:
+            return
+        terms = builder.terms
+        for s, p, o in zip(builder.subjects, builder.predicates, builder.objects):
+            if p == subclass_of:
+                self.superclasses.setdefault(terms[s], set()).add(terms[o])
+
+    def instance_classes(self, shape):
+        """Return the target classes of a shape and all their known subclasses."""
+        classes = set(shape.target_classes)
+        pending = list(classes)
+        subclasses = {}
+        for subclass, parents in self.superclasses.items():
+            for parent in parents:
+                subclasses.setdefault(parent, []).append(subclass)
+        while pending:
+            for subclass in subclasses.get(pending.pop(), ()):
+                if subclass not in classes:
+                    classes.add(subclass)
+                    pending.append(subclass)
+        return classes
+
+    def check(self, builder, rows=None):
+        """Validate the triples of a builder and return a ChunkReport.
+
+        Triples added by add_records are checked record by record and rows gives the CSV row of every
+        record. Other triples are grouped by subject.
+        """
+        subjects = np.frombuffer(builder.subjects, dtype=np.int64)
+        predicates = np.frombuffer(builder.predicates, dtype=np.int64)
+        objects = np.frombuffer(builder.objects, dtype=np.int64)
+        records = np.frombuffer(builder.records, dtype=np.int64)
+        if len(records):
+            unit = np.searchsorted(records, np.arange(len(subjects)), side="right") - 1
+            unit_subjects = subjects[records]
+        else:
+            unit, unit_subjects = pd.factorize(subjects)
+        rows = np.full(len(unit_subjects), -1, dtype=np.int64) if rows is None else np.asarray(rows, dtype=np.int64)
+        terms = builder.terms
+        violations = []
+        unique = {}
+
+        def report(unit_index, shape, check, constraint, value):
+            row = int(rows[unit_index])
+            violations.append(Violation(row if row >= 0 else None, terms[unit_subjects[unit_index]], shape.name,
+                                        check.label, constraint, check.message, value))
+
+        type_id = builder.ids.get(RDF_TYPE, -1)
+        for shape in self.shapes:
+            if shape.target_classes:
+                class_ids = [builder.ids[c] for c in self.instance_classes(shape) if c in builder.ids]
+                is_focus = np.zeros(len(unit_subjects), dtype=bool)
+                is_focus[unit[(predicates == type_id) & np.isin(objects, class_ids)]] = True
+                focus = np.flatnonzero(is_focus)
+                for check in shape.properties:
+                    matches = predicates == builder.ids.get(check.path, -1)
+                    counts = np.bincount(unit[matches], minlength=len(unit_subjects))[focus]
+                    if check.min_count is not None:
+                        for unit_index, count in zip(focus[counts < check.min_count], counts[counts < check.min_count]):
+                            report(unit_index, shape, check, "sh:minCount", f"{count} values, at least {check.min_count}")
+                    if check.max_count is not None:
+                        for unit_index, count in zip(focus[counts > check.max_count], counts[counts > check.max_count]):
+                            report(unit_index, shape, check, "sh:maxCount", f"{count} values, at most {check.max_count}")
+                    if check.datatype is None and not check.bounds:
+                        continue
+                    matches &= is_focus[unit]
+                    # Every distinct value is checked once
+                    values, inverse = np.unique(objects[matches], return_inverse=True)
+                    errors = {}
+                    for position, constraint, detail in check.value_errors([terms[value] for value in values]):
+                        errors.setdefault(position, []).append((constraint, detail))
+                    if not errors:
+                        continue
+                    for unit_index, value in zip(unit[matches], inverse):
+                        for constraint, detail in errors.get(value, ()):
+                            report(unit_index, shape, check, constraint, detail)
+            for target in shape.target_objects_of:
+                matches = predicates == builder.ids.get(target, -1)
+                values, inverse = np.unique(objects[matches], return_inverse=True)
+                value_keys, texts = _hashes([terms[value] for value in values])
+                owners, owner_inverse = np.unique(subjects[matches], return_inverse=True)
+                subject_keys, _ = _hashes([terms[owner] for owner in owners])
+                unique[(shape.name, target)] = (value_keys[inverse], subject_keys[owner_inverse], rows[unit[matches]],
+                                                texts[inverse])
+        violations.sort(key=lambda violation: -1 if violation.row is None else violation.row)
+        return ChunkReport(violations, unique)
+
+    def merge(self, report):
+        """Add the report of the next chunk, checking its values against the uniqueness indexes."""
+        self.violations.extend(report.violations)
+        for (name, target), (keys, subjects, rows, texts) in report.unique.items():
+            shape = next(shape for shape in self.shapes if shape.name == name)
+            check = next(check for check in shape.properties if check.inverse and check.path == target)
+            index = self._unique.setdefault((name, target), _UniqueIndex())
+            positions, owner_rows = index.add(keys, subjects, rows)
+            for position, owner_row in zip(positions, owner_rows):
+                row = int(rows[position])
+                owner = f"row {owner_row}" if owner_row >= 0 else "another subject"
+                self.violations.append(Violation(row if row >= 0 else None, texts[position], name, check.label,
+                                                 "sh:maxCount", check.message, f"also used by {owner}"))
+
+    def check_graph(self, graph, nodes, added=()):
+        """Validate nodes against a whole graph, and the uniqueness of the values of added (s, p, o) triples.
+
+        Used after an update with the subjects it touched and the triples it added.
+        """
+        violations = []
+        superclasses = {}
+
+        def classes(node):
+            found = set()
+            for node_type in graph.objects(node, RDF.type):
+                if node_type not in superclasses:
+                    superclasses[node_type] = {str(c) for c in graph.transitive_objects(node_type, RDFS.subClassOf)}
+                found |= superclasses[node_type]
+            return found
+
+        # The values of every property check and their nodes, checked together once all nodes are read
+        checked = {}
+        for node in nodes:
+            node_classes = None
+            for shape in self.shapes:
+                if not shape.target_classes:
+                    continue
+                if node_classes is None:
+                    node_classes = classes(node)
+                if node_classes.isdisjoint(shape.target_classes):
+                    continue
+                for check in shape.properties:
+                    values = [_term(value) for value in graph.objects(node, URIRef(check.path))]
+                    if check.min_count is not None and len(values) < check.min_count:
+                        violations.append(Violation(None, str(node), shape.name, check.label, "sh:minCount",
+                                                    check.message, f"{len(values)} values, at least {check.min_count}"))
+                    if check.max_count is not None and len(values) > check.max_count:
+                        violations.append(Violation(None, str(node), shape.name, check.label, "sh:maxCount",
+                                                    check.message, f"{len(values)} values, at most {check.max_count}"))
+                    _, owners, checked_values = checked.setdefault(check, (shape, [], []))
+                    owners.extend([node] * len(values))
+                    checked_values.extend(values)
+        for check, (shape, owners, values) in checked.items():
+            for position, constraint, detail in check.value_errors(values):
+                violations.append(Violation(None, str(owners[position]), shape.name, check.label, constraint,
+                                            check.message, detail))
+        for shape in self.shapes:
+            for target in shape.target_objects_of:
+                check = next(check for check in shape.properties if check.inverse and check.path == target)
+                for value in {o for _, p, o in added if str(p) == target}:
+                    owners = set(graph.subjects(URIRef(check.path), value))
+                    if len(owners) > 1:
+                        violations.append(Violation(None, str(value), shape.name, check.label, "sh:maxCount",
+                                                    check.message, f"used by {len(owners)} subjects"))
+        return violations
+
+
+def _number(graph, node, predicate):
+    value = graph.value(node, predicate)
+    return None if value is None else value.toPython()
+
+
+def compile_shapes(source):
+    """Compile the node shapes of an rdflib Graph, or of Turtle text, into a ShapeValidator."""
+    if not isinstance(source, Graph):
+        source = Graph().parse(data=source, format="turtle")
+    shapes = []
+    for node in sorted(set(source.subjects(RDF.type, SH.NodeShape)), key=str):
+        properties = []
+        for prop in source.objects(node, SH.property):
+            unsupported = {_short(str(p)) for p in source.predicates(prop)} - _supported
+            if unsupported:
+                raise ValueError(f"Unsupported constraints in {node}: {', '.join(sorted(unsupported))}")
+            path = source.value(prop, SH.path)
+            inverse = isinstance(path, BNode)
+            if inverse:
+                path = source.value(path, SH.inversePath)
+                if path is None:
+                    raise ValueError(f"Unsupported property path in {node}")
+            datatype = source.value(prop, SH.datatype)
+            bounds = [(name, _number(source, prop, SH[name])) for name in _bounds]
+            properties.append(PropertyCheck(
+                str(path),
+                inverse=inverse,
+                datatype=str(datatype) if datatype is not None else None,
+                min_count=_number(source, prop, SH.minCount),
+                max_count=_number(source, prop, SH.maxCount),
+                bounds=[(name, float(bound)) for name, bound in bounds if bound is not None],
+                message=str(source.value(prop, SH.message) or ""),
+            ))
+        shape = Shape(
+            f":{_short(str(node))}",
+            [str(c) for c in source.objects(node, SH.targetClass)],
+            [str(p) for p in source.objects(node, SH.targetObjectsOf)],
+            [check for check in properties if not check.inverse],
+        )
+        inverse = [check for check in properties if check.inverse]
+        for check in inverse:
+            if check.path not in shape.target_objects_of or check.max_count != 1 or check.datatype or check.bounds:
+                raise ValueError(f"Only sh:maxCount 1 on the inverse of the sh:targetObjectsOf property is supported"
+                                 f" ({shape.name})")
+        if inverse and shape.properties:
+            raise ValueError(f"Inverse and direct paths in the same shape are not supported ({shape.name})")
+        shape.properties = shape.properties or inverse
+        shapes.append(shape)
+    return ShapeValidator(shapes)
@@ -0,0 +1,918 @@
+"""
+A local SPARQL endpoint for the catalog generated by Products.py, a stand-in for GraphDB.
+
+The catalog is loaded into an indexed CatalogStore and served with the same endpoints the React app
+uses on GraphDB:
+
+- GET/POST /repositories/Super_Market             SPARQL queries, answered as application/sparql-results+json
+- POST     /repositories/Super_Market/statements  SPARQL updates, or N-Triples, N-Quads or Turtle data to add
+                                                  (see rdf_upload.py), answered with 204 No Content
+- GET      /repositories/Super_Market/search      product search from the index built by Products.py and
+                                                  the products written since (see SearchDelta), with
+                                                  ?q=...&mode=contains|token|prefix&limit=..., answered
+                                                  with the same bindings as the search query of Header.js
+- POST     /repositories/Super_Market/orders      batched order placement with stock reservation (see
+                                                  order_service.py), GET returns the order counters
+- GET      /repositories/Super_Market/cache       hit/miss statistics of the query result cache (see
+                                                  query_cache.py), DELETE empties it
+- GET      /repositories/Super_Market/dashboard   orders with their items, revenue per day, units sold and
+                                                  low stock in one read (see dashboard_aggregates.py,
+                                                  ?limit=... keeps the latest orders and best sellers)
+- POST     /repositories/Super_Market/products    bulk import of a text/csv file in the columns of
+                                                  Products.csv (see product_import.py), answered with the
+                                                  imported and rejected rows, GET returns the progress
+- POST     /repositories/Super_Market/login       login with a JSON username, password and role, answered
+                                                  with a session token and the user (see auth_service.py)
+- GET      /repositories/Super_Market/session     the user of the Authorization: Bearer session token, from
+                                                  memory, DELETE logs out
+- POST     /repositories/Super_Market/users       account creation from a JSON username, password, name,
+                                                  surname and address, the password stored as a salted hash
+- GET      /metrics                               request counts and latencies by endpoint, cache, order and
+                                                  memory metrics in the Prometheus text format (see metrics.py)
+
+Connections are handled by asyncio, so many clients can be connected and send requests at the same
+time. Queries and updates are evaluated one at a time on a worker thread, which keeps the event loop
+responsive and every request sees a consistent store. Query results are cached until an update or an
+order writes a predicate they read, and cache hits are answered without leaving the event loop.
+
+Queries are planned before they are evaluated (see query_planner.py): equality filters become bound
+terms, triple patterns are joined in the order of their estimated rows, using the predicate statistics
+Products.py saves in Products.stats.json if --stats finds them, and MAX() and COUNT() of ids are
+answered from aggregates kept up to date with every write. A query sent with explain=true is answered
+with its plan as text instead of its results. --no-plan leaves queries as rdflib translates them.
+
+An update is applied whole or not at all. The nodes it touched are validated against the SHACL shapes
+loaded with the data (see shacl_validator.py), and an update that breaks a shape is rolled back and
+answered with 400 and the violations, like GraphDB does with SHACL validation enabled.
+
+With --store, the store is kept in a directory as a snapshot and a write-ahead log of every change
+(see store_persistence.py): the first start parses --data once, later ones map the snapshot and replay
+the changes made since it, so updates, imports and orders survive a restart. Delete the directory to
+load --data again.
+
+With --shards N, the products are split by category between N worker processes, each with its own
+store, indexes and cache, and the queries are routed to the shard of their category or scattered to
+all of them and merged (see catalog_shards.py). Orders, imports and the dashboard are not served
+then.
+
+Queries and updates slower than --slow-query-ms are logged with their time. --profile runs the store
+thread, where queries and updates are evaluated, under cProfile and saves the stats on exit, and
+--trace-memory adds the Python allocations traced by tracemalloc to the metrics.
+
+Run it from the ProductFiles folder on the port the React app proxies to:
+
+    python sparql_service.py --port 7200
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import re
+import signal
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+from rdflib import Dataset, Graph, Literal, URIRef
+from rdflib.plugins.sparql.processor import prepareQuery, prepareUpdate
+
+from auth_service import AuthError, AuthService, max_sessions, roles, session_seconds
+from catalog_store import catalog_namespaces, load_catalog, normalize_values
+from dashboard_aggregates import DashboardAggregates, low_stock_threshold
+from metrics import RequestMetrics, memory_families, prometheus_text
+from order_service import OrderService
+from predicate_statistics import PredicateStatistics
+from pricing import PricingEngine, load_rules
+from product_import import ProductImport, ProductImportError
+from query_cache import (QueryCache, max_bytes, max_entries, normalize_query, query_keys, triple_keys, update_keys,
+                         write_keys)
+from query_planner import QueryPlanner
+from search_index import SearchDelta, SearchIndex
+from shacl_validator import ValidationError, compile_shapes, format_violation
+from store_persistence import StorePersistence, snapshot_log_bytes
+
+# Files loaded at startup, the same ones uploaded to GraphDB
+data_files = ["Products.ttl", "Shacl_shapes.ttl"]
+search_index_file = "Products.search.idx"
+statistics_file = "Products.stats.json"
+pricing_file = "Pricing.csv"
+store_directory = "Super_Market.store"
+repository_name = "Super_Market"
+
+# Largest request body accepted, big enough for a bulk INSERT DATA upload
+max_body_size = 1 << 28
+
+# rdflib result formats by media type, the first one is the default
+result_formats = {
+    "application/sparql-results+json": "json",
+    "application/json": "json",
+    "application/sparql-results+xml": "xml",
+    "text/csv": "csv",
+    "text/tab-separated-values": "tsv",
+}
+graph_formats = {
+    "text/turtle": "turtle",
+    "application/n-triples": "nt",
+    "application/rdf+xml": "xml",
+}
+
+# rdflib parsers of the data that can be posted to /statements, by media type
+data_formats = {
+    "application/n-triples": "nt",
+    "text/plain": "nt",
+    "application/n-quads": "nquads",
+    "text/turtle": "turtle",
+    "application/x-turtle": "turtle",
+}
+
+# Variables of the search results and their predicates, as in the search query of Header.js
+search_fields = {
+    "name": "http://purl.org/goodrelations/v1#name",
+    "brand": catalog_namespaces[""] + "hasBrand",
+    "price": catalog_namespaces[""] + "hasPrice",
+    "discountPrice": catalog_namespaces[""] + "hasDiscountPrice",
+    "productId": catalog_namespaces[""] + "hasProductID",
+    "quantity": catalog_namespaces[""] + "hasQuantity",
+    "stock": catalog_namespaces[""] + "hasStock",
+    "available": catalog_namespaces[""] + "isAvailable",
+}
+
+# Prefix of the metrics of GET /metrics
+metrics_prefix = "sparql_service"
+
+# Longest part of a slow query or update that is logged
+slow_query_log_chars = 300
+
+# What is done with updates that break a SHACL shape
+validation_modes = ["reject", "report", "off"]
+
+# PREFIX declarations of a query or update
+_prefix_declaration = re.compile(r"PREFIX\s+([A-Za-z][\w.-]*)?:\s*<([^>]*)>", re.IGNORECASE)
+
+reasons = {
+    200: "OK",
+    201: "Created",
+    204: "No Content",
+    400: "Bad Request",
+    401: "Unauthorized",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    409: "Conflict",
+    411: "Length Required",
+    413: "Payload Too Large",
+    415: "Unsupported Media Type",
+    500: "Internal Server Error",
+}
+
+
+class HTTPError(Exception):
+    """An error answered with an HTTP status and a plain text message."""
+
+    def __init__(self, status, message=None):
+        super().__init__(message or reasons[status])
+        self.status = status
+
+
+class Request:
+    """A parsed HTTP request."""
+
+    def __init__(self, method, target, version, headers, body):
+        url = urlsplit(target)
+        self.method = method
+        self.path = url.path.rstrip("/") or "/"
+        self.params = parse_qs(url.query, keep_blank_values=True)
+        self.version = version
+        self.headers = headers
+        self.body = body
+        # Name of the handler that answered the request, the endpoint label of the metrics
+        self.endpoint = "other"
+
+    @property
+    def content_type(self):
+        return self.headers.get("content-type", "").split(";")[0].strip().lower()
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get("connection", "").lower()
+        return connection == "keep-alive" if self.version == "HTTP/1.0" else connection != "close"
+
+    def form(self):
+        """Return the query string parameters, plus the body ones for a form POST."""
+        params = {key: list(values) for key, values in self.params.items()}
+        if self.content_type == "application/x-www-form-urlencoded":
+            for key, values in parse_qs(self.body.decode("utf-8"), keep_blank_values=True).items():
+                params.setdefault(key, []).extend(values)
+        return params
+
+    def param(self, name):
+        values = self.form().get(name)
+        return values[0] if values else None
+
+
+class Response:
+    """An HTTP response with a complete body."""
+
+    def __init__(self, status=200, body=b"", content_type=None, headers=None):
+        self.status = status
+        self.body = body.encode("utf-8") if isinstance(body, str) else body
+        self.headers = dict(headers or {})
+        if content_type:
+            self.headers["Content-Type"] = content_type
+
+    def encode(self, keep_alive):
+        headers = {"Content-Length": str(len(self.body)), "Connection": "keep-alive" if keep_alive else "close"}
+        headers.update(self.headers)
+        head = f"HTTP/1.1 {self.status} {reasons.get(self.status, '')}\r\n"
+        head += "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+        return (head + "\r\n").encode("latin-1") + self.body
+
+
+def term_json(term):
+    """Render an rdflib term as a binding of application/sparql-results+json."""
+    if isinstance(term, Literal):
+        binding = {"type": "literal", "value": str(term)}
+        if term.language:
+            binding["xml:lang"] = term.language
+        elif term.datatype:
+            binding["datatype"] = str(term.datatype)
+        return binding
+    if isinstance(term, URIRef):
+        return {"type": "uri", "value": str(term)}
+    return {"type": "bnode", "value": str(term)}
+
+
+def add_prefixes(text, namespaces=catalog_namespaces):
+    """Declare the catalog prefixes a query or update does not declare itself, like the default namespaces of GraphDB.
+
+    rdflib keeps one prefix per namespace, so a namespace the text already declares is left alone, and of
+    prefixes sharing a namespace (':' and 'base:') only the one the text uses is added.
+    """
+    declared = dict(_prefix_declaration.findall(text))
+    taken = set(declared.values())
+    added = {}
+    for prefix, namespace in namespaces.items():
+        if prefix in declared or namespace in taken:
+            continue
+        if namespace not in added or re.search(rf"(?<![\w.<-]){re.escape(prefix)}:", text):
+            added[namespace] = prefix
+    lines = "".join(f"PREFIX {prefix}: <{namespace}>\n" for namespace, prefix in added.items())
+    return lines + text
+
+
+def _negotiate(accept, formats):
+    """Pick the media type of the Accept header that is in formats, or the default one."""
+    for item in accept.split(","):
+        media_type = item.split(";")[0].strip().lower()
+        if media_type in formats:
+            return media_type
+    return next(iter(formats))
+
+
+def serialize_result(result, accept):
+    """Serialize a query result in the format negotiated with an Accept header and return its media type and bytes."""
+    if result.type in ("CONSTRUCT", "DESCRIBE"):
+        media_type = _negotiate(accept, graph_formats)
+        return media_type, result.graph.serialize(format=graph_formats[media_type], encoding="utf-8")
+    media_type = _negotiate(accept, result_formats)
+    return media_type, result.serialize(format=result_formats[media_type])
+
+
+def query_text(request):
+    """Return the query of a request to the repository, in the body or in the query parameter."""
+    if request.method == "POST" and request.content_type == "application/sparql-query":
+        text = request.body.decode("utf-8")
+    else:
+        text = request.param("query")
+    if not text:
+        raise HTTPError(400, "Missing parameter: query")
+    return text
+
+
+def read_json(request):
+    """Return the JSON body of a request."""
+    if request.content_type != "application/json":
+        raise HTTPError(415, f"Unsupported content type: {request.content_type}")
+    try:
+        return json.loads(request.body.decode("utf-8"))
+    except ValueError as error:
+        raise HTTPError(400, f"Invalid JSON: {error}")
+
+
+def bearer_token(request):
+    """Return the token of the Authorization: Bearer header of a request, or None."""
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer":
+        return None
+    return token.strip() or None
+
+
+def parse_data(body, data_format):
+    """Parse RDF data posted to /statements into a list of triples, the named graphs of N-Quads merged."""
+    if data_format == "nquads":
+        return [(s, p, o) for s, p, o, _ in Dataset().parse(data=body, format=data_format).quads()]
+    return list(Graph().parse(data=body, format=data_format))
+
+
+def search_params(request):
+    """Return the text, mode and limit of a search request."""
+    text = request.param("q")
+    if not text or not text.strip():
+        raise HTTPError(400, "Missing parameter: q")
+    mode = request.param("mode") or "contains"
+    if mode not in ("contains", "token", "prefix"):
+        raise HTTPError(400, f"Unknown search mode: {mode}")
+    limit = request.param("limit")
+    try:
+        limit = int(limit) if limit else None
+    except ValueError:
+        raise HTTPError(400, f"Invalid limit: {limit}")
+    return text, mode, limit
+
+
+async def read_request(reader):
+    """Read one HTTP request, or return None when the client closed the connection."""
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    try:
+        method, target, version = line.decode("latin-1").split()
+    except ValueError:
+        raise HTTPError(400, "Malformed request line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        raise HTTPError(411, "Chunked request bodies are not supported, send a Content-Length")
+    length = int(headers.get("content-length") or 0)
+    if length > max_body_size:
+        raise HTTPError(413)
+    body = await reader.readexactly(length) if length else b""
+    return Request(method.upper(), target, version.upper(), headers, body)
+
+
+class HTTPService:
+    """Answers HTTP requests on keep-alive connections with the async handlers of self.routes.
+
+    Handlers are registered per method and path, and every request is counted in self.metrics under
+    the name of its handler.
+    """
+
+    def __init__(self):
+        self.metrics = RequestMetrics()
+        self.routes = {}
+
+    def route(self, method, path, handler):
+        """Register an async handler taking a Request and returning a Response."""
+        self.routes[(method, path)] = handler
+
+    async def dispatch(self, request):
+        handler = self.routes.get((request.method, request.path))
+        if handler is None:
+            if any(path == request.path for _, path in self.routes):
+                raise HTTPError(405)
+            raise HTTPError(404)
+        request.endpoint = handler.__name__.removeprefix("handle_")
+        return await handler(request)
+
+    async def handle_connection(self, reader, writer):
+        """Answer the requests of one client until it closes the connection."""
+        try:
+            while True:
+                keep_alive = False
+                request = None
+                try:
+                    request = await read_request(reader)
+                    if request is None:
+                        break
+                    start = time.perf_counter()
+                    keep_alive = request.keep_alive
+                    response = await self.dispatch(request)
+                except HTTPError as error:
+                    response = Response(error.status, str(error), "text/plain;charset=UTF-8")
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except Exception as error:
+                    response = Response(500, str(error), "text/plain;charset=UTF-8")
+                if request is not None:
+                    self.metrics.observe(request.endpoint, response.status, time.perf_counter() - start)
+                writer.write(response.encode(keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_connection, host, port, limit=1 << 20)
+        async with server:
+            await server.serve_forever()
+
+
+class AuthEndpoints:
+    """The login, session and account endpoints of a service whose logins are self.auth, an AuthService."""
+
+    def route_auth(self, repository_path):
+        self.route("POST", repository_path + "/login", self.handle_login)
+        self.route("GET", repository_path + "/session", self.handle_session)
+        self.route("DELETE", repository_path + "/session", self.handle_logout)
+        self.route("POST", repository_path + "/users", self.handle_register)
+
+    async def handle_login(self, request):
+        body = read_json(request)
+        if not isinstance(body, dict) or not all(isinstance(body.get(key), str) for key in ("username", "password")):
+            raise HTTPError(400, "Expected {\"username\": ..., \"password\": ..., \"role\": ...}")
+        role = body.get("role")
+        if role is not None and role not in roles:
+            raise HTTPError(400, f"Unknown role: {role}")
+        session = await self.auth.login(body["username"], body["password"], role)
+        if session is None:
+            raise HTTPError(401, "Invalid username or password")
+        token, user = session
+        return Response(200, json.dumps({"token": token, **user}), "application/json;charset=UTF-8")
+
+    async def handle_session(self, request):
+        user = self.auth.session(bearer_token(request))
+        if user is None:
+            raise HTTPError(401, "Unknown or expired session")
+        return Response(200, json.dumps(user), "application/json;charset=UTF-8")
+
+    async def handle_logout(self, request):
+        self.auth.logout(bearer_token(request))
+        return Response(204)
+
+    async def handle_register(self, request):
+        body = read_json(request)
+        fields = ("username", "password", "name", "surname", "address")
+        if not isinstance(body, dict) or not all(isinstance(body.get(key), str) and body[key].strip() for key in fields):
+            raise HTTPError(400, f"Expected the fields {', '.join(fields)}")
+        try:
+            user = await self.auth.register(*(body[key] for key in fields))
+        except AuthError as error:
+            raise HTTPError(409, str(error))
+        except ValidationError as error:
+            raise HTTPError(400, str(error))
+        return Response(201, json.dumps(user), "application/json;charset=UTF-8")
+
+    def auth_families(self, prefix):
+        """Return the session and login metrics."""
+        auth = self.auth.stats()
+        return [
+            (f"{prefix}_sessions", "gauge", "Open login sessions.", [("", {}, auth["sessions"])]),
+            (f"{prefix}_logins_total", "counter", "Logins by result.",
+             [("", {"result": "ok"}, auth["logins"]), ("", {"result": "failed"}, auth["failedLogins"])]),
+            (f"{prefix}_session_lookups_total", "counter", "Users resolved from a session token, by result.",
+             [("", {"result": "hit"}, auth["sessionHits"]), ("", {"result": "miss"}, auth["sessionMisses"])]),
+            (f"{prefix}_rehashed_passwords_total", "counter",
+             "Plaintext passwords replaced by their hash at the login of their user.",
+             [("", {}, auth["rehashedPasswords"])]),
+        ]
+
+
+class SparqlService(HTTPService, AuthEndpoints):
+    """Serves SPARQL queries and updates over a catalog graph.
+
+    Handlers are registered per method and path in self.routes, so more endpoints can be added next
+    to the repository ones.
+    """
+
+    def __init__(self, graph, repository=repository_name, search_index=None, cache=None, validation="reject",
+                 low_stock=low_stock_threshold, slow_query=None, pricing=None, persistence=None,
+                 statistics=None, plan=True, max_sessions=max_sessions, session_seconds=session_seconds):
+        super().__init__()
+        self.graph = graph
+        # Logs every change written to the store, if it is kept on disk
+        self.persistence = persistence
+        self.search_index = search_index
+        # Products whose name or brand changed since the search index was built
+        self.search_delta = None
+        if search_index is not None:
+            self.search_delta = SearchDelta(search_index, graph, catalog_namespaces[""],
+                                            URIRef(search_fields["name"]), URIRef(search_fields["brand"]))
+        self.repository = repository
+        self.cache = QueryCache() if cache is None else cache
+        self.validation = validation
+        self.validator = compile_shapes(graph) if validation != "off" else None
+        self.dashboard = DashboardAggregates(graph, low_stock)
+        # Rewrites queries before they are evaluated, None evaluates them as rdflib translates them
+        self.planner = QueryPlanner(graph, statistics) if plan else None
+        # Queries and updates taking longer than this many seconds are logged
+        self.slow_query = slow_query
+        # One thread: queries and updates never run concurrently on the store
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sparql")
+        self.orders = OrderService(graph, self.executor, write=self.write)
+        self.products = ProductImport(graph, self.executor, self.write_triples, self.validator, pricing)
+        self.auth = AuthService(graph, self.write_change, max_sessions, session_seconds)
+        repository_path = f"/repositories/{repository}"
+        self.route("GET", repository_path, self.handle_query)
+        self.route("POST", repository_path, self.handle_query)
+        self.route("POST", repository_path + "/statements", self.handle_update)
+        self.route("POST", repository_path + "/orders", self.handle_orders)
+        self.route("GET", repository_path + "/orders", self.handle_order_stats)
+        self.route("GET", repository_path + "/cache", self.handle_cache_stats)
+        self.route("DELETE", repository_path + "/cache", self.handle_cache_clear)
+        self.route("GET", repository_path + "/dashboard", self.handle_dashboard)
+        self.route("POST", repository_path + "/products", self.handle_import)
+        self.route("GET", repository_path + "/products", self.handle_import_progress)
+        self.route_auth(repository_path)
+        self.route("GET", "/metrics", self.handle_metrics)
+        if search_index is not None:
+            self.route("GET", repository_path + "/search", self.handle_search)
+
+    async def run(self, function, *args):
+        """Run a function on the store thread."""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    def log_slow(self, kind, text, start):
+        """Log a query or update that took longer than self.slow_query seconds since start."""
+        elapsed = time.perf_counter() - start
+        if self.slow_query is not None and elapsed > self.slow_query:
+            print(f"Slow {kind} ({elapsed * 1000:.1f} ms): {normalize_query(text)[:slow_query_log_chars]}")
+
+    def query(self, text, accept="", key=None):
+        """Evaluate a query and return its media type and serialized result, caching it under key if given."""
+        start = time.perf_counter()
+        prepared = prepareQuery(add_prefixes(text))
+        normalize_values(prepared.algebra)
+        result = self.graph.query(prepared if self.planner is None else self.planner.plan(prepared))
+        value = serialize_result(result, accept)
+        if key is not None:
+            self.cache.put(key, value, query_keys(prepared.algebra))
+        self.log_slow("query", text, start)
+        return value
+
+    def explain(self, text):
+        """Return the plan of a query as text."""
+        prepared = prepareQuery(add_prefixes(text))
+        if self.planner is None:
+            return "Query planning is disabled (--no-plan), the query is evaluated as rdflib translates it\n"
+        return "\n".join(self.planner.explain(prepared)) + "\n"
+
+    def update(self, text):
+        """Run a SPARQL update on the store and drop the cached results it can change.
+
+        If the update fails, or breaks a shape while validation is "reject", its changes are rolled back.
+        """
+        start = time.perf_counter()
+        prepared = prepareUpdate(add_prefixes(text))
+        normalize_values(prepared.algebra)
+        try:
+            self._write(lambda: self.graph.update(prepared))
+        finally:
+            self.cache.invalidate(update_keys(prepared.algebra))
+            self.log_slow("update", text, start)
+
+    def write_triples(self, added, removed=()):
+        """Remove and add triples as one change, validated and rolled back like an update."""
+        graph = self.graph
+
+        def write():
+            for triple in removed:
+                graph.remove(triple)
+            for triple in added:
+                graph.add(triple)
+
+        self.write(write)
+
+    async def write_change(self, changes):
+        """Run changes() on the store thread and write the (added, removed) triples it returns as one change."""
+        await self.run(lambda: self.write_triples(*changes()))
+
+    def write(self, write):
+        """Run write() on the store as one change like an update, and return its (added, s, p, o) changes.
+
+        The cached results the change can affect are dropped.
+        """
+        changes = self._write(write)
+        self.cache.invalidate(write_keys(triple_keys([(s, p, o) for _, s, p, o in changes])))
+        return changes
+
+    def add_data(self, body, data_format):
+        """Add the triples of RDF data to the store as one change, the named graphs of N-Quads are merged."""
+        start = time.perf_counter()
+        triples = parse_data(body, data_format)
+        self.write_triples(triples)
+        self.log_slow("data upload", f"{len(triples)} triples", start)
+
+    def _write(self, write):
+        """Run write() on the store as one change and return its (added, s, p, o) changes.
+
+        The changes are validated, logged and applied to the dashboard and the query planner, and undone if
+        anything fails.
+        """
+        store = self.graph.store
+        store.journal = journal = []
+        try:
+            write()
+            self.validate(journal)
+            terms = store.terms
+            changes = [(added, terms[s], terms[p], terms[o]) for added, s, p, o in journal]
+            if self.persistence is not None:
+                self.persistence.log(changes)
+            self.dashboard.apply(changes)
+            self.auth.apply(changes)
+            if self.search_delta is not None:
+                self.search_delta.apply(changes)
+            if self.planner is not None:
+                self.planner.apply(changes)
+        except Exception:
+            store.rollback(journal)
+            raise
+        finally:
+            store.journal = None
+        return changes
+
+    def validate(self, journal):
+        """Validate the nodes changed by the triples of a store journal."""
+        if self.validator is None or not journal:
+            return
+        terms = self.graph.store.terms
+        nodes = {terms[s] for _, s, _, _ in journal}
+        added = [(terms[s], terms[p], terms[o]) for is_added, s, p, o in journal if is_added]
+        violations = self.validator.check_graph(self.graph, nodes, added)
+        if violations and self.validation == "reject":
+            raise ValidationError(violations)
+        for violation in violations:
+            print(format_violation(violation))
+
+    def search(self, text, mode="contains", limit=None):
+        """Search the products and return application/sparql-results+json bindings like Header.js gets."""
+        predicates = {name: URIRef(iri) for name, iri in search_fields.items()}
+        text = text.strip().lower()
+        bindings = []
+        for local in self.search_delta.search(text, mode):
+            instance = URIRef(catalog_namespaces[""] + local)
+            values = {name: list(self.graph.objects(instance, predicate)) for name, predicate in predicates.items()}
+            # n-gram candidates are checked against the current name and brand in the store
+            if mode == "contains" and not any(text in str(value).lower() for value in values["name"] + values["brand"]):
+                continue
+            # Every combination of values, like the basic graph pattern of the query
+            for row in itertools.product(*values.values()):
+                binding = {"instance": term_json(instance)}
+                binding.update(zip(values, map(term_json, row)))
+                bindings.append(binding)
+            if limit is not None and len(bindings) >= limit:
+                del bindings[limit:]
+                break
+        result = {"head": {"vars": ["instance", *search_fields]}, "results": {"bindings": bindings}}
+        return json.dumps(result).encode("utf-8")
+
+    async def handle_search(self, request):
+        body = await self.run(self.search, *search_params(request))
+        return Response(200, body, "application/sparql-results+json;charset=UTF-8")
+
+    async def handle_orders(self, request):
+        body = read_json(request)
+        orders = body.get("orders", [body]) if isinstance(body, dict) else None
+        if not isinstance(orders, list) or not all(isinstance(order, dict) for order in orders):
+            raise HTTPError(400, "Expected an order or {\"orders\": [...]}")
+        token = bearer_token(request)
+        if token is not None:
+            # Orders of a logged in user are placed for the user of the session
+            user = self.auth.session(token)
+            if user is None:
+                raise HTTPError(401, "Unknown or expired session")
+            for order in orders:
+                order["user"] = user["userInstance"]
+        try:
+            results = await self.orders.submit(orders)
+        except ValidationError as error:
+            raise HTTPError(400, str(error))
+        return Response(200, json.dumps({"orders": results}), "application/json;charset=UTF-8")
+
+    async def handle_order_stats(self, request):
+        return Response(200, json.dumps(self.orders.stats()), "application/json;charset=UTF-8")
+
+    async def handle_dashboard(self, request):
+        limit = request.param("limit")
+        try:
+            limit = int(limit) if limit else None
+        except ValueError:
+            raise HTTPError(400, f"Invalid limit: {limit}")
+        summary = await self.run(self.dashboard.summary, limit)
+        return Response(200, json.dumps(summary), "application/json;charset=UTF-8")
+
+    async def handle_import(self, request):
+        if request.content_type != "text/csv":
+            raise HTTPError(415, f"Unsupported content type: {request.content_type}")
+        if self.products.progress["state"] in ("checking", "importing"):
+            raise HTTPError(409, "Another import is running")
+        try:
+            summary = await self.products.run(request.body.decode("utf-8"))
+        except ProductImportError as error:
+            raise HTTPError(400, str(error))
+        return Response(200, json.dumps(summary), "application/json;charset=UTF-8")
+
+    async def handle_import_progress(self, request):
+        return Response(200, json.dumps(self.products.progress), "application/json;charset=UTF-8")
+
+    async def handle_cache_stats(self, request):
+        return Response(200, json.dumps(self.cache.stats()), "application/json;charset=UTF-8")
+
+    def metric_families(self):
+        """Return the request, store, cache, order, import and memory metrics of the service."""
+        prefix = metrics_prefix
+        cache = self.cache.stats()
+        orders = self.orders.stats()
+        families = self.metrics.families(prefix)
+        families += [
+            (f"{prefix}_triples", "gauge", "Triples in the store.", [("", {}, len(self.graph))]),
+            (f"{prefix}_cache_entries", "gauge", "Query results in the cache.", [("", {}, cache["entries"])]),
+            (f"{prefix}_cache_bytes", "gauge", "Bytes of query results in the cache.", [("", {}, cache["bytes"])]),
+        ]
+        for name, key, help_text in [
+            ("cache_hits", "hits", "Queries answered from the cache."),
+            ("cache_misses", "misses", "Queries evaluated on the store."),
+            ("cache_evictions", "evictions", "Results evicted to keep the cache within its limits."),
+            ("cache_invalidations", "invalidations", "Results dropped by updates and orders."),
+            ("orders_placed", "placed", "Orders placed."),
+            ("orders_rejected", "rejected", "Orders rejected."),
+            ("order_batches", "batches", "Batches of orders written."),
+        ]:
+            value = cache[key] if name.startswith("cache") else orders[key]
+            families.append((f"{prefix}_{name}_total", "counter", help_text, [("", {}, value)]))
+        families += [
+            (f"{prefix}_products_imported_total", "counter", "Products added by imports.",
+             [("", {}, self.products.imported)]),
+            (f"{prefix}_import_batches_total", "counter", "Batches of imported products written.",
+             [("", {}, self.products.batches)]),
+        ]
+        families += self.auth_families(prefix)
+        if self.planner is not None:
+            families.append((f"{prefix}_planned_aggregates_total", "counter",
+                             "Aggregates answered from the maintained aggregates.", [("", {}, self.planner.answered)]))
+        if self.persistence is not None:
+            families += self.persistence.families(prefix)
+        return families + memory_families(prefix)
+
+    async def handle_metrics(self, request):
+        return Response(200, prometheus_text(self.metric_families()), "text/plain; version=0.0.4; charset=utf-8")
+
+    async def handle_cache_clear(self, request):
+        await self.run(self.cache.clear)
+        return Response(204)
+
+    async def handle_query(self, request):
+        text = query_text(request)
+        if request.param("explain") in ("true", "1"):
+            try:
+                plan = await self.run(self.explain, text)
+            except Exception as error:
+                raise HTTPError(400, f"MALFORMED QUERY: {error}")
+            return Response(200, plan, "text/plain;charset=UTF-8")
+        accept = request.headers.get("accept", "")
+        key = self.cache.key(text, accept)
+        cached = self.cache.get(key)
+        if cached is not None:
+            media_type, body = cached
+            return Response(200, body, f"{media_type};charset=UTF-8")
+        try:
+            media_type, body = await self.run(self.query, text, accept, key)
+        except Exception as error:
+            raise HTTPError(400, f"MALFORMED QUERY: {error}")
+        return Response(200, body, f"{media_type};charset=UTF-8")
+
+    async def handle_update(self, request):
+        if request.content_type == "application/sparql-update":
+            text = request.body.decode("utf-8")
+        elif request.content_type == "application/x-www-form-urlencoded":
+            text = request.param("update")
+        elif request.content_type in data_formats:
+            try:
+                await self.run(self.add_data, request.body, data_formats[request.content_type])
+            except ValidationError as error:
+                raise HTTPError(400, str(error))
+            except Exception as error:
+                raise HTTPError(400, f"MALFORMED DATA: {error}")
+            return Response(204)
+        else:
+            raise HTTPError(415, f"Unsupported content type: {request.content_type}")
+        if not text:
+            raise HTTPError(400, "Missing parameter: update")
+        try:
+            await self.run(self.update, text)
+        except ValidationError as error:
+            raise HTTPError(400, str(error))
+        except Exception as error:
+            raise HTTPError(400, f"MALFORMED QUERY: {error}")
+        return Response(204)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the generated catalog on a local SPARQL endpoint.")
+    parser.add_argument("--data", nargs="+", default=data_files, help="RDF files to load (default: %(default)s)")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=7200)
+    parser.add_argument("--repository", default=repository_name)
+    parser.add_argument("--search-index", default=search_index_file, help="search index built by Products.py")
+    parser.add_argument("--stats", default=statistics_file,
+                        help="predicate statistics saved by Products.py --stats, used to plan queries if the file exists "
+                             "(default: %(default)s)")
+    parser.add_argument("--no-plan", action="store_true",
+                        help="evaluate queries as rdflib translates them, without the query planner")
+    parser.add_argument("--cache-entries", type=int, default=max_entries,
+                        help="most query results kept in the cache, 0 disables it (default: %(default)s)")
+    parser.add_argument("--cache-mb", type=float, default=max_bytes / (1 << 20),
+                        help="most megabytes of query results kept in the cache (default: %(default)s)")
+    parser.add_argument("--validation", choices=validation_modes, default="reject",
+                        help="reject or only report updates that break a SHACL shape (default: %(default)s)")
+    parser.add_argument("--low-stock", type=int, default=low_stock_threshold,
+                        help="stock at or below which the dashboard lists a product (default: %(default)s)")
+    parser.add_argument("--pricing", default=pricing_file,
+                        help="discount rules of the imported products, used if the file exists (default: %(default)s)")
+    parser.add_argument("--max-sessions", type=int, default=max_sessions,
+                        help="most login sessions kept, the least recently used are dropped (default: %(default)s)")
+    parser.add_argument("--session-minutes", type=float, default=session_seconds / 60,
+                        help="minutes without a request after which a session expires (default: %(default)s)")
+    parser.add_argument("--store", nargs="?", const=store_directory, default=None,
+                        help="keep the store in this directory as a snapshot and a log of the changes, loading "
+                             "--data only if it is empty (default without a value: %(const)s)")
+    parser.add_argument("--snapshot-mb", type=float, default=snapshot_log_bytes / (1 << 20),
+                        help="megabytes of logged changes after which a new snapshot is taken (default: %(default)s)")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="split the products by category between this many worker processes, plus a replica of "
+                             "the whole catalog, and route or scatter the queries between them (see catalog_shards.py)")
+    parser.add_argument("--slow-query-ms", type=float, default=None,
+                        help="log the queries and updates that take longer than this many milliseconds")
+    parser.add_argument("--profile", default=None,
+                        help="profile the store thread with cProfile and save the stats to this file on exit")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="trace the Python allocations with tracemalloc and add them to the metrics (slower)")
+    args = parser.parse_args(argv)
+    if args.shards and (args.store or args.profile):
+        parser.error("--shards cannot be combined with --store or --profile")
+
+    if args.trace_memory:
+        tracemalloc.start()
+
+    if args.shards:
+        from catalog_shards import ShardedService
+
+        service = ShardedService(args.data, args.shards, args.repository,
+                                 args.search_index if os.path.exists(args.search_index) else None,
+                                 args.stats if os.path.exists(args.stats) else None, args.validation,
+                                 args.cache_entries, int(args.cache_mb * (1 << 20)), not args.no_plan,
+                                 args.max_sessions, args.session_minutes * 60)
+        print(f"Serving {args.shards} shards on http://{args.host}:{args.port}/repositories/{args.repository}")
+        try:
+            asyncio.run(service.serve(args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            service.close()
+        return
+
+    persistence = None
+    if args.store:
+        persistence = StorePersistence(args.store, int(args.snapshot_mb * (1 << 20)))
+        graph = persistence.load(lambda: load_catalog(args.data))
+    else:
+        graph = load_catalog(args.data)
+    search_index = SearchIndex(args.search_index) if os.path.exists(args.search_index) else None
+    if search_index is None:
+        print(f"No search index found at {args.search_index}, the search endpoint is disabled")
+    statistics = PredicateStatistics.load(args.stats) if os.path.exists(args.stats) else None
+    if statistics is None and not args.no_plan:
+        print(f"No predicate statistics found at {args.stats}, queries are planned from the store counts")
+    cache = QueryCache(args.cache_entries, int(args.cache_mb * (1 << 20)))
+    slow_query = args.slow_query_ms / 1000 if args.slow_query_ms is not None else None
+    pricing = PricingEngine(load_rules(args.pricing) if os.path.exists(args.pricing) else [])
+    service = SparqlService(graph, args.repository, search_index, cache, args.validation, args.low_stock, slow_query,
+                            pricing, persistence, statistics, not args.no_plan, args.max_sessions,
+                            args.session_minutes * 60)
+    profiler = None
+    if args.profile:
+        import cProfile
+
+        # The profiler hooks the thread that enables it, so enable it on the store thread
+        profiler = cProfile.Profile()
+        service.executor.submit(profiler.enable).result()
+    if profiler is not None or persistence is not None:
+        # Stop on SIGTERM like on Ctrl+C, so the profile is saved and the last snapshot taken when a supervisor
+        # stops the service
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+    print(f"Serving {len(graph)} triples on http://{args.host}:{args.port}/repositories/{args.repository}")
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if profiler is not None:
+            service.executor.submit(profiler.disable).result()
+            profiler.dump_stats(args.profile)
+            print(f"Profile saved as {args.profile}")
+        if persistence is not None:
+            # The last snapshot is taken on the store thread, after the changes still running
+            service.executor.submit(persistence.close).result()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,466 @@
+"""
+Snapshots and a write-ahead log of a CatalogStore, so the local SPARQL service restarts without parsing
+the catalog again and keeps the orders, edits and stock changes it was sent.
+
+StorePersistence keeps a store in a directory:
+
+- snapshot-<seq>.bin is a compact image of the interned term table and the triples of the store after
+  change <seq>, with the layout of the search index (see write_arrays in search_index.py). Terms are
+  UTF-8 data with int64 offsets, a kind per term and a sorted 64-bit hash per term to find the id of a
+  term; triples are the id columns sorted in the SPO, POS and OSP orders, with the offsets of the rows
+  of every term in the first column. Opening a snapshot maps the
+  file and makes it the base of a CatalogStore, nothing is decoded or indexed at startup.
+- wal-<seq>.log are the segments of the write-ahead log. Every change written to the store (a SPARQL
+  update, an RDF upload, a batch of an import or of orders) is appended as one record before it is
+  answered: its sequence number, the triples added and removed as JSON, and a CRC-32. The record is
+  fsynced unless sync is off.
+
+When the log written since the last snapshot reaches snapshot_bytes, and when the service stops, a new
+snapshot is taken: the log is continued in a new segment, the state of the store is copied on the store
+thread and the file is written on a thread of its own while queries go on. Terms no triple uses any more
+are dropped from it. Once it is renamed into place the older snapshots and the segments it covers are
+deleted.
+
+load() opens the newest snapshot and replays the records of the log after it, so a restart takes the
+time to map the snapshot and to replay the changes since it, whatever the size of the catalog. A record
+cut short by a crash is dropped and the segment truncated before it. Without a snapshot, the catalog is
+built by the function given to load() (parsing Products.ttl) and the first snapshot taken from it.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import re
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from rdflib import BNode, Literal, URIRef
+
+try:
+    import fcntl
+except ImportError:  # Windows has no fcntl, the directory is locked with msvcrt there
+    fcntl = None
+    import msvcrt
+
+from catalog_store import CatalogStore, SortedTriples, catalog_graph, normalize
+from search_index import map_arrays, write_arrays
+
+# Bytes at the start of every snapshot file
+magic = b"CSTORE01"
+
+# Log written since the last snapshot after which a new one is taken
+snapshot_log_bytes = 16 << 20
+
+# Kinds of terms
+IRI, BLANK, LITERAL, LANGUAGE_LITERAL = range(4)
+
+# A log record starts with the length of its JSON, the CRC-32 of the sequence number and the JSON, and the sequence number
+_record = struct.Struct("<IIQ")
+
+_snapshot_name = re.compile(r"snapshot-(\d+)\.bin$")
+_segment_name = re.compile(r"wal-(\d+)\.log$")
+
+
+def encode_term(term):
+    """Return the kind, the text and the datatype or language of a term."""
+    term = normalize(term)
+    if isinstance(term, URIRef):
+        return IRI, str(term), ""
+    if isinstance(term, BNode):
+        return BLANK, str(term), ""
+    if isinstance(term, Literal):
+        if term.language:
+            return LANGUAGE_LITERAL, str(term), term.language
+        return LITERAL, str(term), str(term.datatype or "")
+    raise TypeError(f"Cannot store the term {term!r}")
+
+
+def decode_term(kind, text, extra):
+    """Return the term of a kind, a text and a datatype or language, as given by encode_term()."""
+    if kind == IRI:
+        return URIRef(text)
+    if kind == BLANK:
+        return BNode(text)
+    if kind == LANGUAGE_LITERAL:
+        return Literal(text, lang=extra, normalize=False)
+    return Literal(text, datatype=URIRef(extra) if extra else None, normalize=False)
+
+
+def _term_key(kind, text, extra):
+    return bytes((kind,)) + text + b"\0" + extra
+
+
+def _term_hash(key):
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+
+def _fsync_directory(directory):
+    """Make a rename in a directory durable, where directories can be opened (not on Windows)."""
+    try:
+        descriptor = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(descriptor)
+    except OSError:
+        pass
+    finally:
+        os.close(descriptor)
+
+
+class SnapshotTerms:
+    """The term table of a snapshot, read from the mapped arrays only for the terms asked for."""
+
+    def __init__(self, arrays):
+        self.kinds = arrays["term_kinds"]
+        self.text = arrays["term_text"]
+        self.text_offsets = arrays["term_text_offsets"]
+        self.extra = arrays["term_extra"]
+        self.extra_offsets = arrays["term_extra_offsets"]
+        self.hashes = arrays["term_hashes"]
+        self.hash_ids = arrays["term_hash_ids"]
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def raw(self, term_id):
+        """Return the kind of a term and its text and datatype or language as UTF-8 bytes."""
+        offsets, extra_offsets = self.text_offsets, self.extra_offsets
+        return (int(self.kinds[term_id]), self.text[offsets[term_id]:offsets[term_id + 1]].tobytes(),
+                self.extra[extra_offsets[term_id]:extra_offsets[term_id + 1]].tobytes())
+
+    def decode(self, term_id):
+        kind, text, extra = self.raw(term_id)
+        return decode_term(kind, text.decode("utf-8"), extra.decode("utf-8"))
+
+    def find(self, term):
+        """Return the id of a normalized term, or None if the snapshot does not have it."""
+        kind, text, extra = encode_term(term)
+        key = _term_key(kind, text.encode("utf-8"), extra.encode("utf-8"))
+        term_hash = _term_hash(key)
+        position = int(self.hashes.searchsorted(np.uint64(term_hash)))
+        while position < len(self.hashes) and int(self.hashes[position]) == term_hash:
+            term_id = int(self.hash_ids[position])
+            if _term_key(*self.raw(term_id)) == key:
+                return term_id
+            position += 1
+        return None
+
+
+def capture(store):
+    """Copy what a snapshot of a store needs on the store thread, so it can be written while the store changes."""
+    added = np.fromiter((value for s, predicates in store.spo.items() for p, objects in predicates.items()
+                         for o in objects for value in (s, p, o)), dtype=np.int64).reshape(-1, 3)
+    return {
+        "terms": store.terms.base,
+        "triples": store.base_triples,
+        "added_terms": list(store.terms.added),
+        "added": added,
+        "removed": list(store.removed),
+        "namespaces": dict(store.namespaces()),
+    }
+
+
+def write_snapshot(path, state, seq):
+    """Write the captured state of a store as a snapshot after change seq, atomically.
+
+    Return the number of triples written.
+    """
+    base_terms, base_triples = state["terms"], state["triples"]
+    parts = [state["added"]]
+    if base_triples is not None and len(base_triples):
+        keep = np.ones(len(base_triples), dtype=bool)
+        for triple in state["removed"]:
+            keep[base_triples.range("spo", triple)[0]] = False
+        parts.insert(0, np.column_stack(base_triples.orders["spo"]).astype(np.int64)[keep])
+    triples = np.concatenate(parts)
+
+    # Only the terms still used are kept, renumbered in the order of their old ids
+    used, triples = np.unique(triples, return_inverse=True)
+    triples = triples.reshape(-1, 3)
+    base_size = len(base_terms) if base_terms is not None else 0
+    kinds = np.empty(len(used), dtype=np.uint8)
+    texts, extras, hashes = [], [], np.empty(len(used), dtype=np.uint64)
+    for position, term_id in enumerate(used.tolist()):
+        if term_id < base_size:
+            kind, text, extra = base_terms.raw(term_id)
+        else:
+            kind, text, extra = encode_term(state["added_terms"][term_id - base_size])
+            text, extra = text.encode("utf-8"), extra.encode("utf-8")
+        kinds[position] = kind
+        texts.append(text)
+        extras.append(extra)
+        hashes[position] = _term_hash(_term_key(kind, text, extra))
+
+    def utf8_column(values):
+        offsets = np.zeros(len(values) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter(map(len, values), dtype=np.int64, count=len(values)), out=offsets[1:])
+        return np.frombuffer(b"".join(values), dtype=np.uint8), offsets
+
+    id_type = np.uint32 if len(used) < 1 << 32 else np.uint64
+    s, p, o = (triples[:, column].astype(id_type) for column in range(3))
+    arrays = {"term_kinds": kinds}
+    arrays["term_text"], arrays["term_text_offsets"] = utf8_column(texts)
+    arrays["term_extra"], arrays["term_extra_offsets"] = utf8_column(extras)
+    hash_order = np.argsort(hashes, kind="stable")
+    arrays["term_hashes"] = hashes[hash_order]
+    arrays["term_hash_ids"] = hash_order.astype(id_type)
+    for order, columns in [("spo", (s, p, o)), ("pos", (p, o, s)), ("osp", (o, s, p))]:
+        rows = np.lexsort(columns[::-1])
+        for name, column in zip(order, columns):
+            arrays[f"{order}_{name}"] = column[rows]
+        arrays[f"{order}_offsets"] = np.searchsorted(arrays[f"{order}_{order[0]}"], np.arange(len(used) + 1)).astype(np.int64)
+
+    temporary = f"{path}.{os.getpid()}.tmp"
+    write_arrays(temporary, magic, arrays, seq=seq, triples=len(triples), namespaces=state["namespaces"])
+    with open(temporary, "rb+") as f:
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+    _fsync_directory(os.path.dirname(os.path.abspath(path)))
+    return len(triples)
+
+
+def read_snapshot(path):
+    """Open a snapshot as the base of a new catalog graph and return the graph and the seq of the snapshot."""
+    _, header, arrays = map_arrays(path, magic)
+    orders = ("spo", "pos", "osp")
+    triples = SortedTriples(*(tuple(arrays[f"{order}_{name}"] for name in order) for order in orders),
+                            {order: arrays[f"{order}_offsets"] for order in orders})
+    store = CatalogStore(base_terms=SnapshotTerms(arrays), base_triples=triples)
+    for prefix, namespace in header["namespaces"].items():
+        store.bind(prefix, namespace)
+    return catalog_graph(store), header["seq"]
+
+
+def _read_record(f):
+    """Return the seq and the JSON of the next record of a log file, or None if it is cut short or damaged."""
+    head = f.read(_record.size)
+    if len(head) < _record.size:
+        return None
+    size, crc, seq = _record.unpack(head)
+    payload = f.read(size)
+    if len(payload) < size or zlib.crc32(payload, zlib.crc32(struct.pack("<Q", seq))) != crc:
+        return None
+    return seq, payload
+
+
+class WriteAheadLog:
+    """Appends the changes of a store as records to the segment files of a directory."""
+
+    def __init__(self, directory, sync=True):
+        self.directory = directory
+        self.sync = sync
+        self.file = None
+        self.start = None
+
+    def segments(self):
+        """Return the (first seq, path) of the segments of the log, in order."""
+        segments = []
+        for path in glob.glob(os.path.join(self.directory, "wal-*.log")):
+            match = _segment_name.search(os.path.basename(path))
+            if match:
+                segments.append((int(match.group(1)), path))
+        return sorted(segments)
+
+    def open(self, start):
+        """Continue the log in a new segment whose first record will be seq start."""
+        self.close()
+        self.start = start
+        self.file = open(os.path.join(self.directory, f"wal-{start:012d}.log"), "ab")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def append(self, seq, changes):
+        """Append the (added, s, p, o) term changes of change seq and return the bytes written."""
+        payload = json.dumps([[int(added), *(encode_term(term) for term in triple)] for added, *triple in changes],
+                             ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        sequence = struct.pack("<Q", seq)
+        record = _record.pack(len(payload), zlib.crc32(payload, zlib.crc32(sequence)), seq) + payload
+        self.file.write(record)
+        self.file.flush()
+        if self.sync:
+            os.fsync(self.file.fileno())
+        return len(record)
+
+    def records(self, after):
+        """Yield the seq and the (added, s, p, o) term changes of the records after seq after.
+
+        A record cut short or damaged at the end of the last segment is dropped and the segment truncated
+        before it, anywhere else it raises ValueError.
+        """
+        segments = self.segments()
+        for number, (_, path) in enumerate(segments):
+            with open(path, "rb+") as f:
+                end = os.fstat(f.fileno()).st_size
+                position = 0
+                while position < end:
+                    record = _read_record(f)
+                    if record is None:
+                        if number < len(segments) - 1:
+                            raise ValueError(f"{path}: damaged record at byte {position}")
+                        print(f"Dropping the incomplete record at byte {position} of {path}")
+                        f.truncate(position)
+                        break
+                    position = f.tell()
+                    seq, payload = record
+                    if seq > after:
+                        yield seq, [(bool(added), *(decode_term(*term) for term in triple))
+                                    for added, *triple in json.loads(payload)]
+
+    def remove_before(self, start):
+        """Delete the segments whose records all come before the segment starting at seq start."""
+        for first, path in self.segments():
+            if first < start:
+                os.remove(path)
+
+
+def lock_directory(directory):
+    """Lock a store directory for this process and return the open lock file, which holds the lock.
+
+    Two services on the same directory would replay and delete each other's log, so the second one
+    raises RuntimeError.
+    """
+    f = open(os.path.join(directory, "lock"), "a+b")
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        f.close()
+        raise RuntimeError(f"{directory} is used by another process")
+    return f
+
+
+class StorePersistence:
+    """Keeps a catalog store in a directory as its newest snapshot and the log of the changes made since.
+
+    load() is called once before the store is used. log() and snapshot() are called on the store thread.
+    """
+
+    def __init__(self, directory, snapshot_bytes=snapshot_log_bytes, sync=True):
+        self.directory = directory
+        self.snapshot_bytes = snapshot_bytes
+        self.wal = WriteAheadLog(directory, sync)
+        self.store = None
+        # Sequence numbers of the last change logged, of the last snapshot started and of the newest one written
+        self.seq = 0
+        self.started_seq = 0
+        self.snapshot_seq = 0
+        # Bytes logged since the last snapshot was started
+        self.log_bytes = 0
+        self.snapshots = 0
+        self.snapshot_seconds = None
+        # Snapshots are written one at a time, off the store thread
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="snapshot")
+        self._writing = None
+        self._lock = None
+
+    def _snapshots(self):
+        snapshots = []
+        for path in glob.glob(os.path.join(self.directory, "snapshot-*.bin")):
+            match = _snapshot_name.search(os.path.basename(path))
+            if match:
+                snapshots.append((int(match.group(1)), path))
+        return sorted(snapshots)
+
+    def load(self, build):
+        """Open the store of the directory, replaying the log after its snapshot, and return its graph.
+
+        Without a snapshot the graph is build() with the log replayed, and its first snapshot is taken.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock = lock_directory(self.directory)
+        snapshots = self._snapshots()
+        if snapshots:
+            self.snapshot_seq, path = snapshots[-1]
+            graph, _ = read_snapshot(path)
+            print(f"Opened {path}: {len(graph)} triples")
+        else:
+            graph = build()
+        start = time.perf_counter()
+        self.store = graph.store
+        self.seq = self.started_seq = self.snapshot_seq
+        replayed = 0
+        for seq, changes in self.wal.records(self.snapshot_seq):
+            for added, *triple in changes:
+                if added:
+                    self.store.add(tuple(triple))
+                else:
+                    self.store.remove(tuple(triple))
+            self.seq = seq
+            replayed += 1
+        if replayed:
+            print(f"Replayed {replayed} changes of the log in {time.perf_counter() - start:.2f} s")
+        self.wal.open(self.seq + 1)
+        if not snapshots or replayed:
+            self.snapshot()
+        return graph
+
+    def log(self, changes):
+        """Append a change written to the store to the log, taking a snapshot when enough was logged."""
+        if not changes:
+            return
+        self.log_bytes += self.wal.append(self.seq + 1, changes)
+        self.seq += 1
+        if self.log_bytes >= self.snapshot_bytes and (self._writing is None or self._writing.done()):
+            self.snapshot()
+
+    def snapshot(self):
+        """Start writing a snapshot of the store as it is now and return its future.
+
+        The log goes on in a new segment, which the next restart replays after the snapshot.
+        """
+        seq = self.started_seq = self.seq
+        self.wal.open(seq + 1)
+        self.log_bytes = 0
+        state = capture(self.store)
+        path = os.path.join(self.directory, f"snapshot-{seq:012d}.bin")
+
+        def write():
+            start = time.perf_counter()
+            triples = write_snapshot(path, state, seq)
+            self.snapshot_seq = seq
+            self.snapshots += 1
+            self.snapshot_seconds = time.perf_counter() - start
+            for old_seq, old_path in self._snapshots():
+                if old_seq < seq:
+                    try:
+                        os.remove(old_path)
+                    except OSError:
+                        # A snapshot still mapped cannot be deleted on Windows, the next one will be
+                        pass
+            self.wal.remove_before(seq + 1)
+            print(f"Wrote {path}: {triples} triples in {self.snapshot_seconds:.2f} s")
+
+        self._writing = self.writer.submit(write)
+        return self._writing
+
+    def close(self, snapshot=True):
+        """Take a last snapshot if anything was logged since the previous one, wait for it and close the log."""
+        if snapshot and self.seq > self.started_seq:
+            self.snapshot()
+        self.writer.shutdown(wait=True)
+        self.wal.close()
+        if self._lock is not None:
+            self._lock.close()
+            self._lock = None
+
+    def families(self, prefix):
+        """Return the log and snapshot metrics as metric families named prefix_..."""
+        families = [
+            (f"{prefix}_wal_sequence", "gauge", "Sequence number of the last change logged.", [("", {}, self.seq)]),
+            (f"{prefix}_wal_bytes", "gauge", "Bytes logged since the last snapshot.", [("", {}, self.log_bytes)]),
+            (f"{prefix}_snapshots_total", "counter", "Snapshots written.", [("", {}, self.snapshots)]),
+        ]
+        if self.snapshot_seconds is not None:
+            families.append((f"{prefix}_snapshot_seconds", "gauge", "Time taken to write the last snapshot.",
+                             [("", {}, self.snapshot_seconds)]))
+        return families
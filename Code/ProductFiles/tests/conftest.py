@@ -0,0 +1,19 @@
+import os
+import sys
+
+# The modules of ProductFiles import each other by name, as when the scripts are run from their folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from catalog_store import load_catalog
+from output_regression import fixture_dir
+
+# The catalog saved by output_regression.py: 147 products, the default users and the shapes
+catalog_files = [os.path.join(fixture_dir, "Products.ttl"), os.path.join(fixture_dir, "Shacl_shapes.ttl")]
+
+
+@pytest.fixture
+def catalog():
+    """A new store loaded with the fixture catalog."""
+    return load_catalog(catalog_files)
@@ -0,0 +1,63 @@
+import asyncio
+
+from rdflib import Literal, URIRef
+
+from order_service import HAS_PRODUCT_ID, HAS_STOCK, IS_AVAILABLE, base
+from sparql_service import SparqlService
+
+
+class FailingLog:
+    """Persistence whose log fails, like a full disk, after the orders of a batch were written."""
+
+    def log(self, changes):
+        raise OSError("No space left on device")
+
+
+def stock(graph, product_id):
+    product = graph.value(None, HAS_PRODUCT_ID, Literal(product_id))
+    return int(graph.value(product, HAS_STOCK)), graph.value(product, IS_AVAILABLE).toPython()
+
+
+def order(quantity, product_id="1"):
+    return [{"username": "user", "items": [{"productId": product_id, "quantity": quantity}]}]
+
+
+async def submit_all(service, requests, return_exceptions=False):
+    return await asyncio.gather(*(service.orders.submit(orders) for orders in requests),
+                                return_exceptions=return_exceptions)
+
+
+def test_concurrent_orders_are_placed_in_one_batch_against_the_stock_left(catalog):
+    service = SparqlService(catalog)
+    assert stock(catalog, "1") == (10, True)
+
+    # Product 1 has 10 in stock: three orders of 3 fit, the fourth is rejected, the last takes the rest
+    results = asyncio.run(submit_all(service, [order(3), order(3), order(3), order(3), order(1), order(0)]))
+
+    statuses = [result[0]["status"] for result in results]
+    assert statuses == ["placed", "placed", "placed", "rejected", "placed", "rejected"]
+    assert [result[0]["orderId"] for result in results if result[0]["status"] == "placed"] == \
+        ["OR01", "OR02", "OR03", "OR04"]
+    assert "Not enough stock" in results[3][0]["reason"]
+    assert "Invalid quantity" in results[5][0]["reason"]
+    assert stock(catalog, "1") == (0, False)
+    assert service.orders.stats() == {"placed": 4, "rejected": 2, "batches": 1, "lastOrder": 4, "lastOrderItem": 4}
+    assert (URIRef(base + "Order4"), None, None) in catalog
+
+
+def test_failed_batch_is_rolled_back_whole(catalog):
+    service = SparqlService(catalog)
+    service.persistence = FailingLog()
+    before = set(catalog)
+
+    # Both requests of the batch get the error
+    errors = asyncio.run(submit_all(service, [order(2), order(1, "11")], return_exceptions=True))
+    assert [type(error) for error in errors] == [OSError, OSError]
+
+    # Nothing of the batch is kept and its ids are given to the next orders
+    assert set(catalog) == before
+    assert service.orders.stats()["lastOrder"] == 0
+    service.persistence = None
+    results = asyncio.run(submit_all(service, [order(2)]))
+    assert results[0][0]["orderId"] == "OR01"
+    assert stock(catalog, "1") == (8, True)
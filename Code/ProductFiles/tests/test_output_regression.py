@@ -0,0 +1,6 @@
+from output_regression import fixture_dir, main
+
+
+def test_streamed_output_matches_the_fixture(capsys):
+    # The one-chunk run must write the saved files, and every streamed run the same bytes
+    assert main(["--expected", fixture_dir]) == 0, capsys.readouterr().out
@@ -0,0 +1,25 @@
+import asyncio
+
+from metrics import prometheus_text
+from sparql_service import SparqlService
+
+# Two new products and one whose id is already in the catalog
+supplier_csv = """id,name,category,subcategory,type,price,brand,quantity
+,Zebra Quokka Juice 1 lt,Drinks,Juices,Juice,2.4,Quokka,1 lt
+,Zebra Quokka Apple 1 kg,Fruit and Vegetables,Fruit,Apple,1.9,Quokka,1 kg
+1,Sour Apple1 kg,Fruit and Vegetables,Fruit,Apple,2.2,MS Domestic,1 kg
+"""
+
+
+def test_import_is_counted_in_the_metrics_not_printed(catalog, capsys):
+    service = SparqlService(catalog)
+    service.products.batch_size = 1
+
+    summary = asyncio.run(service.products.run(supplier_csv))
+
+    assert summary["imported"] == 2
+    assert [rejected["row"] for rejected in summary["rejected"]] == [3]
+    assert capsys.readouterr().out == ""
+    text = prometheus_text(service.metric_families())
+    assert "sparql_service_products_imported_total 2\n" in text
+    assert "sparql_service_import_batches_total 2\n" in text
@@ -0,0 +1,70 @@
+import pytest
+
+from shacl_validator import ValidationError
+from sparql_service import SparqlService
+
+# Queries of the pages, by what they read
+queries = {
+    "stock": 'SELECT ?stock WHERE { ?product :hasProductID "1" ; :hasStock ?stock }',
+    "price": 'SELECT ?price WHERE { ?product :hasProductID "1" ; :hasPrice ?price }',
+    "name": 'SELECT ?name WHERE { ?product :hasProductID "1" ; gr:name ?name }',
+    "milk": "SELECT ?product WHERE { ?product a pto:Milk }",
+    "orders": "SELECT (COUNT(?order) AS ?count) WHERE { ?order a :Order }",
+}
+
+order = [{"username": "user", "items": [{"productId": "1", "quantity": 2}]}]
+
+
+@pytest.fixture
+def service(catalog):
+    return SparqlService(catalog)
+
+
+def fill(service):
+    """Cache the result of every query."""
+    for text in queries.values():
+        key = service.cache.key(text)
+        if service.cache.get(key) is None:
+            service.query(text, key=key)
+
+
+def cached(service):
+    """Return the queries still cached, checking that their result is the one a new evaluation gives."""
+    names = set()
+    for name, text in queries.items():
+        value = service.cache.get(service.cache.key(text))
+        if value is not None:
+            assert value == service.query(text), name
+            names.add(name)
+    return names
+
+
+def test_writes_drop_only_the_results_they_change(service):
+    fill(service)
+    assert cached(service) == set(queries)
+    assert service.cache.stats()["hits"] == len(queries)
+
+    # A checkout writes the stock and availability of the product and adds an order
+    service.orders.place([order])
+    assert cached(service) == {"price", "name", "milk"}
+
+    fill(service)
+    service.update('DELETE { ?product :hasPrice ?price } INSERT { ?product :hasPrice "3.5"^^xsd:double } '
+                   'WHERE { ?product :hasProductID "1" ; :hasPrice ?price }')
+    assert cached(service) == {"stock", "name", "milk", "orders"}
+
+
+def test_updates_with_a_variable_predicate_drop_everything(service):
+    fill(service)
+    service.update("DELETE WHERE { :Order1 ?property ?value }")
+    assert cached(service) == set()
+
+
+def test_failed_update_keeps_results_consistent(service):
+    fill(service)
+    # A negative stock breaks a shape, so the update is rolled back
+    with pytest.raises(ValidationError):
+        service.update('DELETE { ?product :hasStock ?stock } INSERT { ?product :hasStock "-1"^^xsd:integer } '
+                       'WHERE { ?product :hasProductID "1" ; :hasStock ?stock }')
+    cached(service)
+    assert '"10"' in service.query(queries["stock"])[1].decode("utf-8")
@@ -0,0 +1,95 @@
+import json
+from collections import Counter
+
+import pytest
+
+from benchmark import frontend_queries, order_item, order_update, stock_update
+from catalog_store import load_catalog
+from conftest import catalog_files
+from order_service import HAS_STOCK
+from sparql_service import SparqlService
+
+# The frontend queries filled in with values of the fixture catalog
+queries = {
+    "search": frontend_queries["search"].format(term="milk"),
+    "browse_categories": frontend_queries["browse_categories"].format(),
+    "browse_subcategories": frontend_queries["browse_subcategories"].format(category="Fruit_and_Vegetables"),
+    "browse_types": frontend_queries["browse_types"].format(subcategory="Fruit"),
+    "browse_products": frontend_queries["browse_products"].format(type="Milk"),
+    "cart_stock_check": frontend_queries["cart_stock_check"].format(ids='"1" "11" "21" "2"'),
+    "cart_max_ids": frontend_queries["cart_max_ids"].format(),
+    "dashboard_orders": frontend_queries["dashboard_orders"].format(),
+    "dashboard_order_items": frontend_queries["dashboard_order_items"].format(order_id="OR01"),
+    "dashboard_inventory": frontend_queries["dashboard_inventory"].format(),
+    # Filters the planner pushes into the patterns, and ones it must leave alone
+    "product_id_filter": 'SELECT ?product WHERE { ?product :hasProductID ?id . FILTER(?id = "11") }',
+    "typed_id_filter": 'SELECT ?product WHERE { ?product :hasProductID ?id . FILTER(?id = "11"^^xsd:string) }',
+    "same_term_filter": 'SELECT ?product WHERE { ?product :hasProductID ?id . FILTER(sameTerm(?id, "11")) }',
+    "numeric_filter": "SELECT ?product WHERE { ?product :hasStock ?stock . FILTER(?stock = 10) }",
+    "order_count": "SELECT (COUNT(?order) AS ?count) WHERE { ?order a :Order ; :hasOrderID ?id }",
+    "user_count": "SELECT (COUNT(?user) AS ?count) WHERE { ?user a :NormalUser ; :hasUsername ?username }",
+    "max_order": 'SELECT (MAX(?number) AS ?max) WHERE { ?order a :Order ; :hasOrderID ?id . '
+                 'BIND(xsd:integer(SUBSTR(?id, 3)) AS ?number) }',
+}
+
+
+def rows(service, text):
+    """Return the rows of a query result, in order if the query sorts them."""
+    result = json.loads(service.query(text, "application/sparql-results+json")[1])
+    found = [tuple(sorted((name, json.dumps(value, sort_keys=True)) for name, value in binding.items()))
+             for binding in result["results"]["bindings"]]
+    return found if "ORDER BY" in text else Counter(found)
+
+
+def value(service, text):
+    """Return the value of a query with one row and one variable."""
+    binding, = json.loads(service.query(text, "application/sparql-results+json")[1])["results"]["bindings"]
+    return next(iter(binding.values()))["value"]
+
+
+def place_order(service, number, products):
+    """Place an order the way Cart.js does, with one update."""
+    service.update(order_update.format(
+        number=number, date=f"2026-01-{number:02d}T10:00:00Z", total=3.0,
+        items="".join(order_item.format(number=number, item=number * 10 + i, product=product)
+                      for i, product in enumerate(products)),
+    ) + "".join(stock_update.format(product=product) for product in products))
+
+
+@pytest.fixture
+def services():
+    """The same catalog served with and without the query planner."""
+    return SparqlService(load_catalog(catalog_files)), SparqlService(load_catalog(catalog_files), plan=False)
+
+
+def assert_same_results(services):
+    planned, unplanned = services
+    for name, text in queries.items():
+        assert rows(planned, text) == rows(unplanned, text), name
+
+
+def test_planned_queries_give_the_results_of_rdflib(services):
+    assert_same_results(services)
+    # The queries are not all empty, so the comparison says something
+    planned = services[0]
+    assert rows(planned, queries["search"])
+    assert rows(planned, queries["browse_subcategories"])
+    assert sum(rows(planned, queries["product_id_filter"]).values()) == 1
+
+
+def test_maintained_aggregates_follow_the_writes(services):
+    products = [str(product) for product in services[0].graph.subjects(HAS_STOCK)][:6]
+    for service in services:
+        for number in range(1, 4):
+            place_order(service, number, products[number - 1:number + 2])
+    assert_same_results(services)
+    assert value(services[0], queries["max_order"]) == "3"
+
+    # Deleting the newest order makes MAX go back, a new user makes COUNT go up
+    for service in services:
+        service.update("DELETE WHERE { :Order3 ?property ?value }")
+        service.update('INSERT DATA { :User2 a :NormalUser ; :hasUsername "second" ; :hasName "A" ; :hasSurname "B" ; '
+                       ':hasPassword "password" ; :hasAddress "1 Street" }')
+    assert_same_results(services)
+    assert value(services[0], queries["max_order"]) == "2"
+    assert value(services[0], queries["user_count"]) == "2"
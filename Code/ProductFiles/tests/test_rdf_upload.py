@@ -0,0 +1,144 @@
+import os
+import signal
+import subprocess
+import sys
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from rdf_upload import Checkpoint, UploadError, Uploader, chunks, read_lines
+
+# Folder of rdf_upload.py, run as a script by the interrupted upload
+script_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Products in the test file, and a chunk size smaller than one product so every product is a chunk
+product_count = 16
+chunk_mb = 0.0001
+
+
+class Endpoint(ThreadingHTTPServer):
+    """A /statements endpoint on an ephemeral port that counts the chunks it accepted.
+
+    The first post of the chunks of products 2, 5, 8... is answered 503, some of them with a Retry-After.
+    The first post of the chunk of product hold waits for release, so a test can interrupt the upload
+    meanwhile.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, hold=None):
+        super().__init__(("127.0.0.1", 0), Handler)
+        self.accepted = Counter()
+        self.refused = Counter()
+        self.hold = hold
+        self.holding = threading.Event()
+        self.release = threading.Event()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def answer(self, status, headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8")
+        product = int(body.split(">", 1)[0].rsplit("/p", 1)[1])
+        server = self.server
+        with server.lock:
+            first = server.refused[body] == 0 and server.accepted[body] == 0
+        if first and product % 3 == 2:
+            with server.lock:
+                server.refused[body] += 1
+            self.answer(503, [("Retry-After", "0")] if product % 2 == 0 else [])
+            return
+        if first and product == server.hold:
+            server.holding.set()
+            server.release.wait(10)
+        with server.lock:
+            server.accepted[body] += 1
+        self.answer(204)
+
+
+@pytest.fixture
+def products(tmp_path):
+    path = tmp_path / "Products.nt"
+    with open(path, "w", encoding="utf-8") as f:
+        for number in range(product_count):
+            subject = f"<http://example.org/p{number}>"
+            f.write(f'{subject} <http://example.org/name> "Product {number}" .\n')
+            f.write(f'{subject} <http://example.org/price> "{number}.99" .\n')
+    return str(path)
+
+
+def serve(endpoint):
+    thread = threading.Thread(target=endpoint.serve_forever, daemon=True)
+    thread.start()
+    return endpoint
+
+
+def test_resumed_upload_sends_every_chunk_once(products, tmp_path):
+    expected = list(chunks(read_lines(products), int(chunk_mb * (1 << 20))))
+    assert len(expected) == product_count
+    endpoint = serve(Endpoint(hold=6))
+    command = [sys.executable, "rdf_upload.py", products, "--url", endpoint.url, "--connections", "2",
+               "--chunk-mb", str(chunk_mb), "--checkpoint", str(tmp_path / "upload.json")]
+    try:
+        # Interrupt the first run while a chunk is in flight, then answer it
+        upload = subprocess.Popen(command, cwd=script_dir, stdout=subprocess.PIPE, text=True)
+        assert endpoint.holding.wait(30)
+        upload.send_signal(signal.SIGINT)
+        endpoint.release.set()
+        output = upload.communicate(timeout=30)[0]
+        assert upload.returncode == 130, output
+        first_run = sum(endpoint.accepted.values())
+        assert 0 < first_run < product_count
+
+        resumed = subprocess.run(command, cwd=script_dir, capture_output=True, text=True, timeout=60)
+        assert resumed.returncode == 0, resumed.stdout + resumed.stderr
+        assert f"{product_count - first_run} chunks sent, {first_run} already uploaded" in resumed.stdout
+    finally:
+        endpoint.release.set()
+        endpoint.shutdown()
+        endpoint.server_close()
+
+    assert endpoint.accepted == Counter(expected)
+    assert sum(endpoint.refused.values()) > 0
+
+
+def test_refused_chunk_stops_the_upload_and_keeps_the_checkpoint(products, tmp_path):
+    endpoint = serve(Endpoint())
+    uploader = Uploader(endpoint.url, connections=1, backoff=0.01)
+    checkpoint = Checkpoint(str(tmp_path / "upload.json"))
+    size = int(chunk_mb * (1 << 20))
+    try:
+        # Without retries the 503 of product 2 stops the upload, the chunks before it are kept
+        uploader.retries = 0
+        with pytest.raises(UploadError, match="503"):
+            uploader.upload(products, size, checkpoint, progress=lambda line: None)
+        done = set(Checkpoint(checkpoint.path).files[os.path.abspath(products)]["done"])
+        assert {0, 1} <= done and 2 not in done
+
+        uploader.retries = 2
+        sent, skipped = uploader.upload(products, size, Checkpoint(checkpoint.path), progress=lambda line: None)
+    finally:
+        uploader.close()
+        endpoint.shutdown()
+        endpoint.server_close()
+
+    assert (sent, skipped) == (product_count - len(done), len(done))
+    assert endpoint.accepted == Counter(chunks(read_lines(products), size))
@@ -0,0 +1,107 @@
+import glob
+import os
+
+import pytest
+from rdflib import URIRef
+
+from catalog_store import load_catalog
+from conftest import catalog_files
+from sparql_service import SparqlService
+from store_persistence import StorePersistence
+
+order = [{"username": "user", "items": [{"productId": "1", "quantity": 2}, {"productId": "11", "quantity": 1}]}]
+
+# Changes of the pages: a checkout, a price edit and the removal of a product that is in the base snapshot
+changes = [
+    lambda service: service.orders.place([order]),
+    lambda service: service.update('DELETE { ?product :hasPrice ?price } '
+                                   'INSERT { ?product :hasPrice "3.5"^^xsd:double } '
+                                   'WHERE { ?product :hasProductID "1" ; :hasPrice ?price }'),
+    lambda service: service.update('DELETE WHERE { ?product :hasProductID "21" ; ?property ?value }'),
+]
+
+
+def build():
+    return load_catalog(catalog_files)
+
+
+def not_built():
+    raise AssertionError("The catalog was parsed again instead of opening the snapshot")
+
+
+def open_store(directory, build=not_built, **options):
+    persistence = StorePersistence(str(directory), **options)
+    return persistence, persistence.load(build)
+
+
+def crash(persistence):
+    """Stop like a killed process: the log and the snapshots written so far stay, no last snapshot is taken."""
+    persistence.close(snapshot=False)
+
+
+def test_restart_replays_the_log_after_the_snapshot(tmp_path):
+    persistence, graph = open_store(tmp_path, build)
+    service = SparqlService(graph, persistence=persistence)
+    states = [set(graph)]
+    for change in changes:
+        change(service)
+        states.append(set(graph))
+        assert states[-1] != states[-2]
+    assert persistence.seq == len(changes)
+    crash(persistence)
+
+    persistence, graph = open_store(tmp_path)
+    assert set(graph) == states[-1]
+    assert (URIRef("http://www.semanticweb.org/My_Super/Order1"), None, None) in graph
+
+    # The restart took a snapshot of the replayed changes, the next one opens it without replaying
+    crash(persistence)
+    persistence, graph = open_store(tmp_path)
+    assert persistence.snapshot_seq == len(changes)
+    assert set(graph) == states[-1]
+    crash(persistence)
+
+
+def test_record_cut_short_by_a_crash_is_dropped(tmp_path):
+    persistence, graph = open_store(tmp_path, build)
+    service = SparqlService(graph, persistence=persistence)
+    states = [set(graph)]
+    for change in changes:
+        change(service)
+        states.append(set(graph))
+    crash(persistence)
+
+    # The last record was only half written
+    segment = sorted(glob.glob(os.path.join(tmp_path, "wal-*.log")))[-1]
+    with open(segment, "rb+") as f:
+        f.truncate(os.path.getsize(segment) - 10)
+
+    persistence, graph = open_store(tmp_path)
+    assert persistence.seq == len(changes) - 1
+    assert set(graph) == states[-2]
+    crash(persistence)
+
+
+def test_snapshots_taken_while_writing_replace_the_log(tmp_path):
+    # Every change is enough log for a new snapshot
+    persistence, graph = open_store(tmp_path, build, snapshot_bytes=1)
+    service = SparqlService(graph, persistence=persistence)
+    for change in changes:
+        change(service)
+        persistence._writing.result()
+    expected = set(graph)
+    assert persistence.snapshot_seq == len(changes)
+    crash(persistence)
+
+    assert [os.path.basename(path) for path in glob.glob(os.path.join(tmp_path, "snapshot-*.bin"))] == \
+        [f"snapshot-{len(changes):012d}.bin"]
+    persistence, graph = open_store(tmp_path)
+    assert set(graph) == expected
+    crash(persistence)
+
+
+def test_second_service_on_the_same_directory_is_refused(tmp_path):
+    persistence, _ = open_store(tmp_path, build)
+    with pytest.raises(RuntimeError):
+        open_store(tmp_path)
+    crash(persistence)
@@ -0,0 +1,299 @@
+"""
+A compact triple builder used by Products.py instead of an in-memory rdflib Graph.
+
+Every IRI and literal is interned once and gets an integer id. Triples are stored as three parallel
+integer arrays (subjects, predicates, objects), so memory grows by 24 bytes per triple plus one entry
+per distinct term. The same triples can be written as Turtle, N-Triples or N-Quads with correct
+escaping, or exported to an rdflib Graph.
+
+IRIs are kept as full IRI strings and literals as (lexical form, datatype IRI) tuples. A datatype of
+None stands for a plain literal.
+"""
+
+import re
+from array import array
+
+from lazy_modules import lazy_import
+
+# Only loaded once a builder renders columns, escaping single terms does not need them
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+RDF_TYPE = "http://www.w3.org/1999/02/22-rdf-syntax-ns#type"
+
+# Local names that can be written as prefixed names without escaping
+_local_name = re.compile(r"\w([\w.-]*[\w-])?")
+
+# Characters that are not allowed in an IRI
+_iri_forbidden = re.compile(r'[\x00-\x20<>"{}|^`\\]')
+
+# Characters that must be escaped in a literal
+_literal_escapes = {"\\": "\\\\", '"': '\\"', "\n": "\\n", "\r": "\\r"}
+_literal_forbidden = re.compile(r'[\\"\n\r]')
+
+# Escape sequences of Turtle strings
+_string_escapes = {"t": "\t", "b": "\b", "n": "\n", "r": "\r", "f": "\f", '"': '"', "'": "'", "\\": "\\"}
+_string_escape = re.compile(r"\\(?:u([0-9A-Fa-f]{4})|U([0-9A-Fa-f]{8})|(.))")
+
+# Tokens of the Turtle subset written by Products.py: comments, IRIs, literals, punctuation and names
+_turtle_token = re.compile(
+    r'\s*(?:(?P<comment>#[^\n]*)|(?P<iri><[^>]*>)'
+    r'|(?P<literal>"(?:[^"\\]|\\.)*")(?:\^\^(?P<datatype>[^\s;,.]*(?:\.[^\s;,.]+)*))?'
+    r'|(?P<punct>[;,.])|(?P<name>[^\s;,<"]*[^\s;,.<"]))'
+)
+
+
+def escape_literal(value):
+    """Escape a lexical form for use between double quotes in Turtle or N-Triples."""
+    return _literal_forbidden.sub(lambda m: _literal_escapes[m.group()], value)
+
+
+def escape_iri(value):
+    """Percent-encode the characters that are not allowed in an IRI."""
+    return _iri_forbidden.sub(lambda m: f"%{ord(m.group()):02X}", value)
+
+
+def turtle_iri(iri, namespaces):
+    """Render an IRI in Turtle, as a prefixed name whenever the local name allows it."""
+    return _turtle_iri(iri, sorted(namespaces.items(), key=lambda item: len(item[1]), reverse=True))
+
+
+def _turtle_iri(iri, prefixes):
+    for prefix, namespace in prefixes:
+        if iri.startswith(namespace) and _local_name.fullmatch(iri, len(namespace)):
+            return f"{prefix}:{iri[len(namespace):]}"
+    return f"<{escape_iri(iri)}>"
+
+
+def _unescape_string(value):
+    """Resolve the escape sequences of a Turtle string."""
+    def replace(match):
+        code = match.group(1) or match.group(2)
+        return chr(int(code, 16)) if code else _string_escapes.get(match.group(3), match.group(3))
+    return _string_escape.sub(replace, value)
+
+
+def _factorize(values):
+    """Split a column, or any sequence, into codes and unique values."""
+    if not hasattr(values, "dtype"):
+        values = np.asarray(values)
+    return pd.factorize(values, use_na_sentinel=False)
+
+
+class TripleBuilder:
+    """Interned terms plus triples stored as integer id arrays."""
+
+    def __init__(self, namespaces):
+        self.namespaces = dict(namespaces)
+        self.terms = []
+        self.ids = {}
+        self.subjects = array("q")
+        self.predicates = array("q")
+        self.objects = array("q")
+        # Offsets of the first triple of every record added by add_records
+        self.records = array("q")
+        self._rendered = {}
+        # Longest namespaces first, so the most specific prefix wins
+        self._prefixes = sorted(self.namespaces.items(), key=lambda item: len(item[1]), reverse=True)
+
+    def __len__(self):
+        return len(self.subjects)
+
+    def intern(self, term):
+        """Return the id of a term, adding it to the term table the first time it is seen."""
+        term_id = self.ids.get(term)
+        if term_id is None:
+            term_id = self.ids[term] = len(self.terms)
+            self.terms.append(term)
+        return term_id
+
+    def expand(self, name):
+        """Expand a prefixed name, '<iri>' or the keyword 'a' to a full IRI."""
+        if name == "a":
+            return RDF_TYPE
+        if name.startswith("<") and name.endswith(">"):
+            return name[1:-1]
+        prefix, _, local = name.partition(":")
+        if prefix in self.namespaces and not local.startswith("//"):
+            return self.namespaces[prefix] + local
+        return name
+
+    def iri(self, name):
+        """Intern an IRI given in full, between angle brackets or as a prefixed name, percent-encoding it if needed."""
+        return self.intern(escape_iri(self.expand(name)))
+
+    def literal(self, lexical, datatype="xsd:string"):
+        """Intern a typed literal, or a plain literal when datatype is None."""
+        return self.intern((str(lexical), self.expand(datatype) if datatype else None))
+
+    def iris(self, locals_, namespace):
+        """Intern a column of local names in a namespace, percent-encoded if needed, and return their ids as an array."""
+        codes, uniques = _factorize(locals_)
+        namespace = self.namespaces.get(namespace, namespace)
+        ids = np.fromiter((self.intern(escape_iri(namespace + str(local))) for local in uniques), dtype=np.int64, count=len(uniques))
+        return ids[codes]
+
+    def literals(self, values, datatype="xsd:string"):
+        """Intern a column of lexical forms with one datatype and return their ids as an array."""
+        codes, uniques = _factorize(values)
+        datatype = self.expand(datatype) if datatype else None
+        ids = np.fromiter((self.intern((str(value), datatype)) for value in uniques), dtype=np.int64, count=len(uniques))
+        return ids[codes]
+
+    def add(self, subject, predicate, obj):
+        """Add one triple of term ids."""
+        self.subjects.append(subject)
+        self.predicates.append(predicate)
+        self.objects.append(obj)
+
+    def add_records(self, subjects, pairs):
+        """Add the same predicates for every subject of an id array, subject by subject.
+
+        pairs is a list of (predicate id, object ids) where the object ids are an array with one id per
+        subject or a single id shared by all subjects.
+        """
+        subjects = np.asarray(subjects, dtype=np.int64)
+        count = len(subjects)
+        if not count or not pairs:
+            return
+        objects = np.column_stack([np.broadcast_to(np.asarray(ids, dtype=np.int64), count) for _, ids in pairs])
+        predicates = np.array([predicate for predicate, _ in pairs], dtype=np.int64)
+        start = len(self.subjects)
+        self.records.frombytes(np.arange(start, start + count * len(pairs), len(pairs), dtype=np.int64).tobytes())
+        self.subjects.frombytes(np.repeat(subjects, len(pairs)).tobytes())
+        self.predicates.frombytes(np.tile(predicates, count).tobytes())
+        self.objects.frombytes(objects.ravel().tobytes())
+
+    def add_turtle(self, text):
+        """Read Turtle statements written by Products.py and add their triples.
+
+        Only the subset of Turtle that Products.py writes is understood: prefixed names, IRIs,
+        literals, comments and the ';' and ',' abbreviations. @prefix and @base lines are skipped,
+        the namespaces of the builder are used instead.
+        """
+        text = "\n".join(line for line in text.splitlines() if not line.lstrip().startswith("@"))
+        position = 0
+        subject = predicate = None
+        while position < len(text):
+            match = _turtle_token.match(text, position)
+            if match is None or match.end() == position:
+                if text[position:].strip():
+                    raise ValueError(f"Cannot read Turtle near: {text[position:position + 40]!r}")
+                break
+            position = match.end()
+            kind = match.lastgroup if match.group("datatype") is None else "literal"
+            value = match.group(kind)
+            if kind == "comment":
+                continue
+            if kind == "punct":
+                if value == ".":
+                    subject = predicate = None
+                elif value == ";":
+                    predicate = None
+                continue
+            if kind == "literal":
+                term = self.literal(_unescape_string(value[1:-1]), match.group("datatype"))
+            else:
+                term = self.iri(value)
+            if subject is None:
+                subject = term
+            elif predicate is None:
+                predicate = term
+            else:
+                self.add(subject, predicate, term)
+
+    def triples(self):
+        """Iterate over the triples as (subject, predicate, object) term tuples."""
+        terms = self.terms
+        for s, p, o in zip(self.subjects, self.predicates, self.objects):
+            yield terms[s], terms[p], terms[o]
+
+    def turtle_term(self, term):
+        """Render a term in Turtle, as a prefixed name whenever the local name allows it."""
+        if isinstance(term, tuple):
+            lexical, datatype = term
+            rendered = f'"{escape_literal(lexical)}"'
+            return rendered + "^^" + self.turtle_term(datatype) if datatype else rendered
+        return _turtle_iri(term, self._prefixes)
+
+    def ntriples_term(self, term):
+        """Render a term in N-Triples."""
+        if isinstance(term, tuple):
+            lexical, datatype = term
+            rendered = f'"{escape_literal(lexical)}"'
+            return rendered + f"^^<{escape_iri(datatype)}>" if datatype else rendered
+        return f"<{escape_iri(term)}>"
+
+    def _render(self, style):
+        """Return an object array with every term rendered once in the given style."""
+        rendered = self._rendered.get(style)
+        if rendered is None or len(rendered) < len(self.terms):
+            render = self.turtle_term if style == "turtle" else self.ntriples_term
+            done = [] if rendered is None else list(rendered)
+            done.extend(render(term) for term in self.terms[len(done):])
+            rendered = self._rendered[style] = np.empty(len(done), dtype=object)
+            rendered[:] = done
+        return rendered
+
+    def _columns(self, style):
+        rendered = self._render(style)
+        subjects = np.frombuffer(self.subjects, dtype=np.int64)
+        predicates = np.frombuffer(self.predicates, dtype=np.int64)
+        objects = np.frombuffer(self.objects, dtype=np.int64)
+        return subjects, rendered[subjects], rendered[predicates], rendered[objects], predicates
+
+    def ntriples(self, graph=None):
+        """Render all triples as N-Triples lines, or as N-Quads lines in the given graph IRI."""
+        if not len(self):
+            return ""
+        _, subjects, predicates, objects, _ = self._columns("ntriples")
+        end = f" <{escape_iri(self.expand(graph))}> .\n" if graph else " .\n"
+        return "".join(subjects + " " + predicates + " " + objects + end)
+
+    def turtle_lines(self):
+        """Render all triples as one Turtle statement per line."""
+        if not len(self):
+            return ""
+        _, subjects, predicates, objects, _ = self._columns("turtle")
+        return "".join(subjects + " " + predicates + " " + objects + " .\n")
+
+    def turtle(self, indent=13):
+        """Render all triples as Turtle blocks, one per record or run of triples with the same subject.
+
+        Every block starts with a '###' comment naming the subject, continues the predicates on
+        lines indented by indent spaces and is followed by an empty line.
+        """
+        if not len(self):
+            return ""
+        ids, subjects, predicates, objects, predicate_ids = self._columns("turtle")
+        predicates[predicate_ids == self.ids.get(RDF_TYPE, -1)] = "a"
+        first = np.ones(len(ids), dtype=bool)
+        first[1:] = ids[1:] != ids[:-1]
+        first[np.frombuffer(self.records, dtype=np.int64)] = True
+        last = np.ones(len(ids), dtype=bool)
+        last[:-1] = first[1:]
+        heads = np.where(first, "###  " + subjects + "\n" + subjects + " ", " " * indent)
+        ends = np.where(last, " .\n\n", " ;\n")
+        return "".join(heads + predicates + " " + objects + ends)
+
+    def rdf_triples(self):
+        """Iterate over the triples as tuples of rdflib terms."""
+        from rdflib import Literal, URIRef
+
+        nodes = [
+            Literal(term[0], datatype=URIRef(term[1]) if term[1] else None) if isinstance(term, tuple) else URIRef(term)
+            for term in self.terms
+        ]
+        for s, p, o in zip(self.subjects, self.predicates, self.objects):
+            yield nodes[s], nodes[p], nodes[o]
+
+    def to_graph(self, graph=None):
+        """Add all triples to an rdflib Graph, a new one unless given, and return it."""
+        from rdflib import Graph
+
+        graph = Graph() if graph is None else graph
+        for prefix, namespace in self.namespaces.items():
+            graph.bind(prefix, namespace)
+        for triple in self.rdf_triples():
+            graph.add(triple)
+        return graph
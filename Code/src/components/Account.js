@@ -4,6 +4,71 @@ import axios from 'axios';
 import '../styling/Account.css';
 import { useUser } from '../context/UserContext';
 
+// A SPARQL store without the login endpoints of sparql_service.py, like GraphDB, answers them with 404 or 405
+const isNotServed = (error) => [404, 405].includes(error.response?.status);
+
+// Login with a SPARQL query, on a store without the login endpoints. GraphDB keeps the plaintext passwords that
+// Products.py generates and insertUser writes, the local service hashes them at the first login.
+const findUser = async (username, password, role) => {
+  const query = `
+    PREFIX base: <http://www.semanticweb.org/My_Super/>
+    SELECT ?user
+    WHERE {
+      ?user a base:${role === "customer" ? "NormalUser" : "AdminUser"} ;
+            base:hasUsername "${username}"^^xsd:string ;
+            base:hasPassword "${password}"^^xsd:string .
+    }
+  `;
+
+  const response = await axios.get('/repositories/Super_Market', {
+    params: { query },
+    headers: { Accept: 'application/sparql-results+json' },
+  });
+
+  const results = response.data.results.bindings;
+  return results.length > 0 ? results[0].user.value.split('/').pop() : null;
+};
+
+// Account creation with SPARQL, on a store without the login endpoints
+const insertUser = async ({ username, password, name, surname, address }) => {
+  // Fetch the current count of NormalUser instances
+  const countQuery = `
+    PREFIX base: <http://www.semanticweb.org/My_Super/>
+    SELECT (COUNT(?user) AS ?userCount)
+    WHERE {
+      ?user a base:NormalUser .
+    }
+  `;
+
+  const countResponse = await axios.get('/repositories/Super_Market', {
+    params: { query: countQuery },
+    headers: { Accept: 'application/sparql-results+json' },
+  });
+
+  const userCount = parseInt(countResponse.data.results.bindings[0].userCount.value, 10);
+  const newUserId = `NormalUser${userCount + 1}`;
+
+  // Insert the new NormalUser instance
+  const insertQuery = `
+    PREFIX base: <http://www.semanticweb.org/My_Super/>
+    PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
+
+    INSERT DATA {
+      <http://www.semanticweb.org/My_Super/${newUserId}> a base:NormalUser ;
+                    base:hasUsername "${username}"^^xsd:string ;
+                    base:hasPassword "${password}"^^xsd:string ;
+                    base:hasName "${name}"^^xsd:string ;
+                    base:hasSurname "${surname}"^^xsd:string ;
+                    base:hasAddress "${address}"^^xsd:string .
+    }
+  `;
+
+  const insertResponse = await axios.post('/repositories/Super_Market/statements', insertQuery, {
+    headers: { 'Content-Type': 'application/sparql-update' },
+  });
+  return insertResponse.status === 204;
+};
+
 const Account = () => {
   const [step, setStep] = useState(1); // Step 1: Role Selection | Step 2: Login or Create Account Form
   const [role, setRole] = useState(""); // Role: "customer" or "shopOwner"
@@ -30,36 +95,34 @@ const Account = () => {
       return;
     }
 
-    const query = `
-      PREFIX base: <http://www.semanticweb.org/My_Super/>
-      SELECT ?user
-      WHERE {
-        ?user a base:${role === "customer" ? "NormalUser" : "AdminUser"} ;
-              base:hasUsername "${username}"^^xsd:string ;
-              base:hasPassword "${password}"^^xsd:string .
-      }
-    `;
-
     try {
-      const response = await axios.get('/repositories/Super_Market', {
-        params: { query },
-        headers: { Accept: 'application/sparql-results+json' },
-      });
-
-      const results = response.data.results.bindings;
-
-      if (results.length > 0) {
-        const userInstance = results[0].user.value.split('/').pop();
-        const loggedInUser = { username, userInstance, role };
+      let loggedInUser;
+      try {
+        // The service checks the password hash and answers with a session token and the user
+        const response = await axios.post('/repositories/Super_Market/login', { username, password, role });
+        const { token, userInstance } = response.data;
+        loggedInUser = { username, userInstance, role, token };
+      } catch (error) {
+        if (!isNotServed(error)) {
+          throw error;
+        }
+        const userInstance = await findUser(username, password, role);
+        if (!userInstance) {
+          alert("Invalid username or password. Please try again.");
+          return;
+        }
+        loggedInUser = { username, userInstance, role };
+      }
 
-        localStorage.setItem('loggedInUser', JSON.stringify(loggedInUser));
-        setLoggedInUser(loggedInUser);
-        alert(`✅ Welcome, ${role === "customer" ? username : "Shop Owner"}!`);
-        navigate(role === "customer" ? "/account-details" : "/dashboard");
-      } else {
+      localStorage.setItem('loggedInUser', JSON.stringify(loggedInUser));
+      setLoggedInUser(loggedInUser);
+      alert(`✅ Welcome, ${role === "customer" ? username : "Shop Owner"}!`);
+      navigate(role === "customer" ? "/account-details" : "/dashboard");
+    } catch (error) {
+      if (error.response?.status === 401) {
         alert("Invalid username or password. Please try again.");
+        return;
       }
-    } catch (error) {
       console.error("Error during login:", error);
       alert("An error occurred while logging in. Please try again later.");
     }
@@ -73,49 +136,31 @@ const Account = () => {
     }
 
     try {
-      // Fetch the current count of NormalUser instances
-      const countQuery = `
-        PREFIX base: <http://www.semanticweb.org/My_Super/>
-        SELECT (COUNT(?user) AS ?userCount)
-        WHERE {
-          ?user a base:NormalUser .
-        }
-      `;
-
-      const countResponse = await axios.get('/repositories/Super_Market', {
-        params: { query: countQuery },
-        headers: { Accept: 'application/sparql-results+json' },
-      });
-
-      const userCount = parseInt(countResponse.data.results.bindings[0].userCount.value, 10);
-      const newUserId = `NormalUser${userCount + 1}`;
-
-      // Insert the new NormalUser instance
-      const insertQuery = `
-        PREFIX base: <http://www.semanticweb.org/My_Super/>
-        PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
-
-        INSERT DATA {
-          <http://www.semanticweb.org/My_Super/${newUserId}> a base:NormalUser ;
-                        base:hasUsername "${username}"^^xsd:string ;
-                        base:hasPassword "${password}"^^xsd:string ;
-                        base:hasName "${name}"^^xsd:string ;
-                        base:hasSurname "${surname}"^^xsd:string ;
-                        base:hasAddress "${address}"^^xsd:string .
+      let created;
+      try {
+        // The service names the new NormalUser and stores a salted hash of the password
+        const createResponse = await axios.post('/repositories/Super_Market/users', {
+          username, password, name, surname, address,
+        });
+        created = createResponse.status === 201;
+      } catch (error) {
+        if (!isNotServed(error)) {
+          throw error;
         }
-      `;
-
-      const insertResponse = await axios.post('/repositories/Super_Market/statements', insertQuery, {
-        headers: { 'Content-Type': 'application/sparql-update' },
-      });
+        created = await insertUser({ username, password, name, surname, address });
+      }
 
-      if (insertResponse.status === 204) {
+      if (created) {
         alert("Account created successfully! Please log in.");
         setStep(1); // Go back to the login screen
       } else {
         alert("Failed to create account. Please try again.");
       }
     } catch (error) {
+      if (error.response?.status === 409) {
+        alert("This username is already taken. Please choose another one.");
+        return;
+      }
       console.error("Error during account creation:", error);
       alert("An error occurred while creating your account. Please try again later.");
     }
@@ -3,9 +3,48 @@ import axios from 'axios';
 import '../styling/AccountDetails.css';
 import { useUser } from '../context/UserContext';
 
+// Fetch the logged in user with its IRI, details and addresses. The service resolves it from the session
+// token, a login without one (on a store without the login endpoints, like GraphDB) is looked up by username.
+const fetchUser = async (loggedInUser) => {
+  if (loggedInUser.token) {
+    const response = await axios.get('/repositories/Super_Market/session', {
+      headers: { 'Authorization': `Bearer ${loggedInUser.token}` },
+    });
+    return response.data;
+  }
+
+  const userQuery = `
+    PREFIX base: <http://www.semanticweb.org/My_Super/>
+    SELECT ?user ?name ?surname ?address WHERE {
+      ?user a base:NormalUser ;
+            base:hasUsername "${loggedInUser.username}" ;
+            base:hasName ?name ;
+            base:hasSurname ?surname .
+      OPTIONAL { ?user base:hasAddress ?address . }
+    }
+  `;
+
+  const response = await axios.get('/repositories/Super_Market', {
+    params: { query: userQuery },
+    headers: { 'Accept': 'application/sparql-results+json' },
+  });
+
+  const rows = response.data.results.bindings;
+  if (rows.length === 0) {
+    throw new Error(`User not found: ${loggedInUser.username}`);
+  }
+  return {
+    user: rows[0].user.value,
+    name: rows[0].name.value,
+    surname: rows[0].surname.value,
+    addresses: rows.filter((row) => row.address).map((row) => row.address.value),
+  };
+};
+
 const AccountDetails = () => {
   const { loggedInUser } = useUser();
   const [isEditing, setIsEditing] = useState(false);
+  const [userIri, setUserIri] = useState(null); // IRI of the logged in user, the subject of its updates
   const [userDetails, setUserDetails] = useState({});
   const [editedDetails, setEditedDetails] = useState({ ...userDetails });
   const [addresses, setAddresses] = useState([]);
@@ -16,16 +55,6 @@ const AccountDetails = () => {
   const [orderDetails, setOrderDetails] = useState([]);
   const [isLoading, setIsLoading] = useState(true);
 
-  // Define addressQuery outside of useEffect so it can be reused
-  const addressQuery = `
-    PREFIX base: <http://www.semanticweb.org/My_Super/>
-    SELECT ?address WHERE {
-      ?user a base:NormalUser ;
-            base:hasUsername "${loggedInUser?.username}" ;
-            base:hasAddress ?address .
-    }
-  `;
-
   // Handle input changes for personal details
   const handleChange = (e) => {
     const { name, value } = e.target;
@@ -34,21 +63,21 @@ const AccountDetails = () => {
 
   // Save updated name and surname
   const saveChanges = async () => {
+    if (!userIri) return;
+
     const updateQuery = `
       PREFIX base: <http://www.semanticweb.org/My_Super/>
       DELETE {
-        ?user base:hasName ?oldName ;
-              base:hasSurname ?oldSurname .
+        <${userIri}> base:hasName ?oldName ;
+                     base:hasSurname ?oldSurname .
       }
       INSERT {
-        ?user base:hasName "${editedDetails.name}" ;
-              base:hasSurname "${editedDetails.surname}" .
+        <${userIri}> base:hasName "${editedDetails.name}" ;
+                     base:hasSurname "${editedDetails.surname}" .
       }
       WHERE {
-        ?user a base:NormalUser ;
-              base:hasUsername "${loggedInUser.username}" ;
-              base:hasName ?oldName ;
-              base:hasSurname ?oldSurname .
+        <${userIri}> base:hasName ?oldName ;
+                     base:hasSurname ?oldSurname .
       }
     `;
 
@@ -71,20 +100,20 @@ const AccountDetails = () => {
 
   // Save edited address
   const saveEditedAddress = async (index) => {
+    if (!userIri) return;
+
     const updatedAddress = addresses[index];
 
     const updateQuery = `
       PREFIX base: <http://www.semanticweb.org/My_Super/>
       DELETE {
-        ?user base:hasAddress ?oldAddress .
+        <${userIri}> base:hasAddress ?oldAddress .
       }
       INSERT {
-        ?user base:hasAddress "${updatedAddress}" .
+        <${userIri}> base:hasAddress "${updatedAddress}" .
       }
       WHERE {
-        ?user a base:NormalUser ;
-              base:hasUsername "${loggedInUser.username}" ;
-              base:hasAddress ?oldAddress .
+        <${userIri}> base:hasAddress ?oldAddress .
       }
     `;
 
@@ -94,14 +123,10 @@ const AccountDetails = () => {
       });
 
       // Refresh addresses after saving
-      const addressResponse = await axios.get('/repositories/Super_Market', {
-        params: { query: addressQuery },
-        headers: { 'Accept': 'application/sparql-results+json' },
-      });
+      const user = await fetchUser(loggedInUser);
 
-      if (addressResponse.data.results.bindings.length > 0) {
-        const addressList = addressResponse.data.results.bindings.map((row) => row.address.value);
-        setAddresses(addressList);
+      if (user.addresses.length > 0) {
+        setAddresses(user.addresses);
       }
 
       setEditingAddress(null);
@@ -159,44 +184,22 @@ const AccountDetails = () => {
 
       setIsLoading(true); // Start loading
 
-      const userQuery = `
-        PREFIX base: <http://www.semanticweb.org/My_Super/>
-        SELECT ?name ?surname WHERE {
-          ?user a base:NormalUser ;
-                base:hasUsername "${loggedInUser.username}" ;
-                base:hasName ?name ;
-                base:hasSurname ?surname .
-        }
-      `;
-
       try {
-        // Fetch user details
-        const userResponse = await axios.get('/repositories/Super_Market', {
-          params: { query: userQuery },
-          headers: { 'Accept': 'application/sparql-results+json' },
-        });
-
-        if (userResponse.data.results.bindings.length > 0) {
-          const result = userResponse.data.results.bindings[0];
-          setUserDetails({
-            name: result.name.value,
-            surname: result.surname.value,
-          });
-          setEditedDetails({
-            name: result.name.value,
-            surname: result.surname.value,
-          });
-        }
+        // Fetch user details and addresses
+        const user = await fetchUser(loggedInUser);
 
-        // Fetch addresses
-        const addressResponse = await axios.get('/repositories/Super_Market', {
-          params: { query: addressQuery },
-          headers: { 'Accept': 'application/sparql-results+json' },
+        setUserIri(user.user);
+        setUserDetails({
+          name: user.name,
+          surname: user.surname,
+        });
+        setEditedDetails({
+          name: user.name,
+          surname: user.surname,
         });
 
-        if (addressResponse.data.results.bindings.length > 0) {
-          const addressList = addressResponse.data.results.bindings.map((row) => row.address.value);
-          setAddresses(addressList);
+        if (user.addresses.length > 0) {
+          setAddresses(user.addresses);
         }
       } catch (error) {
         console.error("Error fetching user details or addresses:", error);
@@ -206,7 +209,7 @@ const AccountDetails = () => {
     };
 
     fetchUserDetails();
-  }, [loggedInUser, addressQuery]);
+  }, [loggedInUser]);
 
   // Fetch orders
   useEffect(() => {
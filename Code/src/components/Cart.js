@@ -30,29 +30,53 @@ const Cart = () => {
         return;
       }
 
-      // Βήμα 1: Εύρεση του NormalUser instance με βάση το username
-      const fetchUserQuery = `
-        PREFIX base: <http://www.semanticweb.org/My_Super/>
-        PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
-        PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-  
-        SELECT ?user WHERE {
-          ?user a base:NormalUser ;
-                base:hasUsername "${currentUser.username}"^^xsd:string .
+      let normalUserInstance;
+      if (currentUser.token) {
+        // Βήμα 1: Εύρεση του NormalUser instance από τη συνεδρία (session token) του χρήστη
+        let sessionResponse;
+        try {
+          sessionResponse = await axios.get('/repositories/Super_Market/session', {
+            headers: { Authorization: `Bearer ${currentUser.token}` },
+          });
+        } catch (error) {
+          if (error.response?.status === 401) {
+            alert('Your session has expired. Please log in again.');
+            return;
+          }
+          throw error;
         }
-      `;
 
-      const userResponse = await axios.get('/repositories/Super_Market', {
-        params: { query: fetchUserQuery },
-        headers: { 'Accept': 'application/sparql-results+json' },
-      });
+        if (sessionResponse.data.role !== 'customer') {
+          alert('Only customers can place orders.');
+          return;
+        }
 
-      if (!userResponse.data.results.bindings.length || !userResponse.data.results.bindings[0].user) {
-        alert('User not found or invalid response from the database.');
-        return;
-      }
+        normalUserInstance = sessionResponse.data.user;
+      } else {
+        // Βήμα 1: Εύρεση του NormalUser instance με βάση το username, χωρίς συνεδρία (π.χ. σύνδεση μέσω GraphDB)
+        const fetchUserQuery = `
+          PREFIX base: <http://www.semanticweb.org/My_Super/>
+          PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
+          PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+  
+          SELECT ?user WHERE {
+            ?user a base:NormalUser ;
+                  base:hasUsername "${currentUser.username}"^^xsd:string .
+          }
+        `;
 
-      const normalUserInstance = userResponse.data.results.bindings[0].user.value;
+        const userResponse = await axios.get('/repositories/Super_Market', {
+          params: { query: fetchUserQuery },
+          headers: { 'Accept': 'application/sparql-results+json' },
+        });
+
+        if (!userResponse.data.results.bindings.length || !userResponse.data.results.bindings[0].user) {
+          alert('User not found or invalid response from the database.');
+          return;
+        }
+
+        normalUserInstance = userResponse.data.results.bindings[0].user.value;
+      }
       console.log('Normal User Instance:', normalUserInstance);
 
       // Βήμα 2: Ανάκτηση του τρέχοντος stock για τα προϊόντα στο καλάθι
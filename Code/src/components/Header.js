@@ -14,29 +14,42 @@ const Header = () => {
   const handleSearch = async (e) => {
     if (e.key === 'Enter' && searchQuery.trim() !== '') {
       try {
-        const query = `
-          PREFIX base: <http://www.semanticweb.org/My_Super/>
-          PREFIX gr: <http://purl.org/goodrelations/v1#>
-
-          SELECT ?instance ?name ?brand ?price ?discountPrice ?productId 
-                 ?quantity ?stock ?available
-          WHERE {
-            ?instance gr:name ?name ;
-                      base:hasBrand ?brand ;
-                      base:hasPrice ?price ;
-                      base:hasDiscountPrice ?discountPrice ;
-                      base:hasProductID ?productId ;
-                      base:hasQuantity ?quantity ;
-                      base:hasStock ?stock ;
-                      base:isAvailable ?available .
-            FILTER(CONTAINS(LCASE(?name), LCASE("${searchQuery.trim()}")))
+        let response;
+        try {
+          // The name and brand search index of the local SPARQL service
+          response = await axios.get('/repositories/Super_Market/search', {
+            params: { q: searchQuery.trim() },
+            headers: { 'Accept': 'application/sparql-results+json' },
+          });
+        } catch (error) {
+          // A SPARQL store without the search endpoint, like GraphDB, answers it with 404 or 405
+          if (![404, 405].includes(error.response?.status)) {
+            throw error;
           }
-        `;
+          const query = `
+            PREFIX base: <http://www.semanticweb.org/My_Super/>
+            PREFIX gr: <http://purl.org/goodrelations/v1#>
+
+            SELECT ?instance ?name ?brand ?price ?discountPrice ?productId 
+                   ?quantity ?stock ?available
+            WHERE {
+              ?instance gr:name ?name ;
+                        base:hasBrand ?brand ;
+                        base:hasPrice ?price ;
+                        base:hasDiscountPrice ?discountPrice ;
+                        base:hasProductID ?productId ;
+                        base:hasQuantity ?quantity ;
+                        base:hasStock ?stock ;
+                        base:isAvailable ?available .
+              FILTER(CONTAINS(LCASE(?name), LCASE("${searchQuery.trim()}")))
+            }
+          `;
 
-        const response = await axios.get('/repositories/Super_Market', {
-          params: { query },
-          headers: { 'Accept': 'application/sparql-results+json' },
-        });
+          response = await axios.get('/repositories/Super_Market', {
+            params: { query },
+            headers: { 'Accept': 'application/sparql-results+json' },
+          });
+        }
 
         const products = response.data.results.bindings.map((item) => ({
           instance: item.instance?.value,